@@ -1,51 +1,152 @@
 # app_a.py
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import json
-import gspread
-# CAMBIO CLAVE: Usar la forma moderna de credenciales de Google Auth
-from google.oauth2.service_account import Credentials 
-import boto3
 import re
 import os
-import gspread.utils
 import time
 import uuid
+import threading
+import atexit
+import random
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import io
+import math
+import unicodedata
+import sqlite3
+import tempfile
+import heapq
+from contextlib import closing
+from bisect import bisect_left
+# Acceso a Google Sheets y S3: gspread, google-auth y boto3 se cargan en su primer uso
+from data_access import (
+    LazyModule, LazyClient, optional_module, create_gspread_client, create_s3_client,
+    trace_span, record_api_call, api_calls_per_minute, latency_percentiles, export_metrics,
+    get_trace_metrics, current_rerun_trace, set_current_rerun_trace, finish_rerun_trace,
+    SHEETS_READ_QUOTA_PER_MINUTE, SHEETS_WRITE_QUOTA_PER_MINUTE, sheets_quota_lane, sheets_quota_state,
+)
+
+gspread = LazyModule('gspread')
+
+# --- Tracing and API Metrics ---
+# Las métricas y el regulador de cuota viven en data_access.py; aquí solo la traza de cada rerun y los paneles
+METRICS_EXPORT_FILE = 'metricas.prom' # Formato de texto de Prometheus, en LOCAL_CACHE_DIR
+
+def begin_rerun_trace():
+    """
+    Inicia la traza de este rerun. Un rerun cortado por st.rerun() o st.stop() no llega a
+    end_rerun_trace(): se cierra aquí, con la hora de su última actividad medida.
+    """
+    if "trace_session_id" not in st.session_state:
+        st.session_state["trace_session_id"] = uuid.uuid4().hex[:8]
+    previous = st.session_state.get("rerun_trace")
+    if previous is not None and previous['finished_at'] is None:
+        finish_rerun_trace(previous, previous['last_activity'])
+    trace = {
+        'session_id': st.session_state["trace_session_id"],
+        'started_at': time.time(),
+        'last_activity': time.time(),
+        'finished_at': None,
+        'spans': Counter(),      # nombre -> segundos acumulados en este rerun
+        'api_calls': Counter(),  # servicio -> llamadas hechas desde el hilo del script
+    }
+    st.session_state["rerun_trace"] = trace
+    set_current_rerun_trace(trace)
+
+def end_rerun_trace():
+    """Cierra la traza del rerun (al final del script) y exporta las métricas si toca."""
+    trace = current_rerun_trace()
+    set_current_rerun_trace(None)
+    if trace is not None and trace['finished_at'] is None:
+        finish_rerun_trace(trace, time.time())
+        st.session_state["last_rerun_trace"] = trace
+    export_metrics(os.path.join(LOCAL_CACHE_DIR, METRICS_EXPORT_FILE))
+
+def render_metrics_panel():
+    """Panel de rendimiento: latencia de los reruns, uso de la cuota de Google Sheets y spans más costosos."""
+    metrics = get_trace_metrics()
+    with metrics['lock']:
+        reruns = list(metrics['reruns'])
+        spans = {name: list(samples) for name, samples in metrics['spans'].items()}
+        span_counts = dict(metrics['span_counts'])
+        session_count = len(metrics['sessions'])
+        api_errors = dict(metrics['api_errors'])
+    with st.sidebar.expander("📈 Rendimiento"):
+        p50, p95 = latency_percentiles(reruns)
+        col_p50, col_p95 = st.columns(2)
+        col_p50.metric("Rerun p50", f"{p50 * 1000:.0f} ms" if reruns else "—")
+        col_p95.metric("Rerun p95", f"{p95 * 1000:.0f} ms" if reruns else "—")
+        st.caption(f"Últimos {len(reruns)} reruns de {session_count} sesiones de este proceso.")
+
+        lecturas = api_calls_per_minute('sheets', write=False)
+        escrituras = api_calls_per_minute('sheets', write=True)
+        st.progress(min(lecturas / SHEETS_READ_QUOTA_PER_MINUTE, 1.0), text=f"Lecturas de Sheets: {lecturas}/{SHEETS_READ_QUOTA_PER_MINUTE} por minuto")
+        st.progress(min(escrituras / SHEETS_WRITE_QUOTA_PER_MINUTE, 1.0), text=f"Escrituras de Sheets: {escrituras}/{SHEETS_WRITE_QUOTA_PER_MINUTE} por minuto")
+        quota = sheets_quota_state()
+        en_espera = ", ".join(f"{kind}/{lane}: {count}" for (kind, lane), count in sorted(quota['waiting'].items()) if count)
+        st.caption(
+            f"Tokens disponibles: lectura {quota['read'][0]:.0f}/{quota['read'][1]:.0f}, escritura {quota['write'][0]:.0f}/{quota['write'][1]:.0f}"
+            f" · ritmo {quota['rate_factor']:.0%} · 429 recibidos: {quota['total_429']}"
+            + (f" · pausa {quota['paused_for']:.0f} s" if quota['paused_for'] > 0 else "")
+            + (f" · en espera: {en_espera}" if en_espera else "")
+        )
+        st.caption(f"S3: {api_calls_per_minute('s3')} llamadas en el último minuto.")
+        if api_errors:
+            st.caption("Errores: " + ", ".join(f"{name}: {count}" for name, count in sorted(api_errors.items())))
+
+        # La tabla de spans solo se arma a pedido: el panel se dibuja en cada rerun
+        if spans and st.toggle("Ver detalle por span", key="metrics_span_detail"):
+            rows = []
+            for name, samples in spans.items():
+                span_p50, span_p95 = latency_percentiles(samples)
+                rows.append({'Span': name, 'Veces': span_counts[name], 'p50 (ms)': round(span_p50 * 1000, 1),
+                             'p95 (ms)': round(span_p95 * 1000, 1), 'Total reciente (s)': round(sum(samples), 2)})
+            st.dataframe(pd.DataFrame(rows).sort_values('Total reciente (s)', ascending=False), hide_index=True)
+
+        last_trace = st.session_state.get("last_rerun_trace")
+        if last_trace:
+            total = last_trace['finished_at'] - last_trace['started_at']
+            top_spans = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in last_trace['spans'].most_common(5))
+            st.caption(f"Último rerun de esta sesión: {total * 1000:.0f} ms ({top_spans or 'sin spans'}).")
+        st.caption(f"Métricas exportadas en `{os.path.join(LOCAL_CACHE_DIR, METRICS_EXPORT_FILE)}`.")
+
+def render_sheets_quota_notice():
+    """Aviso en la barra lateral mientras Google Sheets tiene pausadas las solicitudes por cuota."""
+    state = sheets_quota_state()
+    if state['paused_for'] > 0:
+        st.sidebar.warning(
+            f"⏳ Google Sheets limitó las solicitudes (cuota por minuto). Se reanudan en {state['paused_for']:.0f} s; "
+            "los cambios siguen en cola y se guardarán solos."
+        )
+    elif state['rate_factor'] < 1.0:
+        st.sidebar.caption(f"🐢 Solicitudes a Google Sheets al {state['rate_factor']:.0%} del ritmo normal tras un límite de cuota.")
 
 st.set_page_config(page_title="Recepción de Pedidos TD", layout="wide")
 
 st.title("📬 Bandeja de Pedidos TD")
+begin_rerun_trace()
 
 # --- Google Sheets Configuration ---
 GOOGLE_SHEET_ID = '1aWkSelodaz0nWfQx7FZAysGnIYGQFJxAN7RO3YgCiZY' # Asegúrate de que este ID sea correcto
 GOOGLE_SHEET_WORKSHEET_NAME = 'datos_pedidos' # Asegúrate de que este nombre sea correcto
 
-def get_google_sheets_client():
+def get_google_credentials_info():
     """
-    Función para obtener el cliente de gspread usando credenciales de Streamlit secrets
-    con la librería google-auth.
+    Lee las credenciales de la cuenta de servicio de Google desde Streamlit secrets.
+    Solo valida el JSON: el cliente se autentica en su primer uso (ver get_google_sheets_client).
     """
     try:
-        credentials_json_str = st.secrets["google_credentials"]
-        creds_dict = json.loads(credentials_json_str)
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        
-        # CAMBIO CLAVE: Crear credenciales usando google.oauth2.service_account.Credentials
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        
-        return gspread.authorize(creds)
+        return json.loads(st.secrets["google_credentials"])
     except KeyError:
         st.error("❌ Error: Las credenciales de Google Sheets no se encontraron en Streamlit secrets. Asegúrate de que 'google_credentials' esté en tus secretos de Streamlit.")
         st.stop()
     except json.JSONDecodeError:
         st.error("❌ Error: Las credenciales de Google Sheets en Streamlit secrets no son un JSON válido. Revisa el formato.")
         st.stop()
-    except Exception as e:
-        st.error(f"❌ Error al autenticar con Google Sheets: {e}")
-        st.info("ℹ️ Verifica que las APIs de Google Sheets y Drive estén habilitadas para tu proyecto de Google Cloud y que tu archivo de credenciales sea válido.")
-        st.stop()
 
 # --- AWS S3 Configuration ---
 try:
@@ -58,6 +159,21 @@ except KeyError as e:
     st.stop()
 
 S3_ATTACHMENT_PREFIX = 'adjuntos_pedidos/'
+S3_THUMBNAIL_PREFIX = 'miniaturas/' # Miniaturas de imágenes: miniaturas/<clave original>.webp
+
+@st.cache_resource
+def get_s3_upload_config():
+    """
+    Configuración de las subidas: multipart a partir de 8 MB, con partes de 8 MB enviadas en paralelo.
+    Se crea en la primera subida para no importar boto3 al arrancar.
+    """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=8,
+        use_threads=True,
+    )
 
 # --- Initialize Session State for tab persistence ---
 if "active_main_tab_index" not in st.session_state:
@@ -75,231 +191,2812 @@ if "active_date_tab_t_index" not in st.session_state:
 if "expanded_attachments" not in st.session_state:
     st.session_state["expanded_attachments"] = {}
 
+if "page_cursors" not in st.session_state:
+    st.session_state["page_cursors"] = {} # Página actual de cada lista de pedidos (pestaña y turno)
+
+if "history_cursors" not in st.session_state:
+    st.session_state["history_cursors"] = {} # Cursor con el que empieza cada página vista del historial
+
+if "requested_downloads" not in st.session_state:
+    st.session_state["requested_downloads"] = set() # Adjuntos cuya descarga pidió el usuario
+
+if "bulk_results" not in st.session_state:
+    st.session_state["bulk_results"] = {} # Resultado de la última acción masiva de cada lista de pedidos
+
 
 # --- Cached Clients for Google Sheets and AWS S3 ---
+@st.cache_resource
+def get_google_sheets_client(credentials_info):
+    """
+    Retorna el cliente de gspread del proceso. Se autentica en su primer uso, normalmente desde
+    el hilo de actualización de la copia, así que abrir la app con la copia en disco no espera a
+    gspread ni a google-auth. Un error de autenticación aparece al cargar los datos.
+    """
+    return LazyClient(lambda: create_gspread_client(credentials_info))
+
 @st.cache_resource
 def get_s3_client():
     """
-    Inicializa y retorna un cliente de S3, usando credenciales globales.
+    Retorna el cliente de S3 del proceso, usando credenciales globales. boto3 se importa y el
+    cliente se crea la primera vez que se usa (por ejemplo, al mostrar o subir un adjunto).
     """
-    try:
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
-        )
-        return s3
-    except Exception as e:
-        st.error(f"❌ Error al inicializar el cliente S3: {e}")
-        st.info("ℹ️ Revisa tus credenciales de AWS en `st.secrets` y la configuración de la región.")
-        st.stop()
+    return LazyClient(lambda: create_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION))
 
-# Initialize clients globally
-try:
-    gc = get_google_sheets_client()
-    s3_client = get_s3_client()
-except Exception as e:
-    st.error(f"❌ Error general al autenticarse o inicializar clientes: {e}")
-    st.info("ℹ️ Asegúrate de que las APIs de Google Sheets y Drive estén habilitadas para tu proyecto de Google Cloud y que tus secretos estén configurados correctamente.")
-    st.stop()
+# Initialize clients globally (sin conectarse todavía)
+gc = get_google_sheets_client(get_google_credentials_info())
+s3_client = get_s3_client()
 
 
 # --- Data Loading from Google Sheets ---
-@st.cache_resource(ttl=60) # Volvemos a usar la caché de recursos
-def load_data_from_gsheets(sheet_id, worksheet_name):
+GSHEET_SYNC_INTERVAL_SECONDS = 60 # Cada cuánto se sincronizan los cambios de la hoja (antes era el ttl de la caché)
+GSHEET_FULL_RESYNC_INTERVAL_SECONDS = 15 * 60 # Recarga completa periódica como verificación de consistencia
+GSHEET_VERSION_COLUMN = 'Ultima_Modificacion' # Columna opcional con la versión/fecha de modificación de cada fila (la app la marca al escribir)
+# Sin GSHEET_VERSION_COLUMN, la sincronización parcial detecta las filas modificadas por otros usuarios o
+# aplicaciones comparando un hash de estas columnas (las que cambian después de registrar un pedido)
+GSHEET_WATCH_COLUMNS = ('Estado', 'Estado_Pago', 'Surtidor', 'Turno', 'Tipo_Envio', 'Fecha_Entrega', 'Fecha_Completado', 'Hora_Proceso', 'Notas')
+
+# Copia local de la hoja para arrancar sin esperar a Google Sheets después de un reinicio
+LOCAL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+SNAPSHOT_FORMAT_VERSION = 2 # Cambiarlo descarta las copias guardadas con otro formato
+SNAPSHOT_STATUS_POLL_SECONDS = 2 # Cada cuánto se revisa si terminó la actualización en segundo plano
+SNAPSHOT_CHANGE_LOG_SIZE = 1000 # Generaciones recientes cuyos pedidos modificados se recuerdan
+LIVE_FEED_POLL_SECONDS = 15 # Cada cuánto revisa cada sesión si la copia cambió (ver render_live_feed)
+
+try:
+    import pyarrow # Motor de Parquet para la copia local
+except ImportError:
+    st.warning("⚠️ La librería 'pyarrow' no está instalada. No se guardará la copia local de los pedidos y cada reinicio esperará a Google Sheets.")
+    pyarrow = None
+
+# Define las columnas esperadas y asegúrate de que existan
+EXPECTED_COLUMNS = [
+    'ID_Pedido', 'Folio_Factura', 'Hora_Registro', 'Vendedor_Registro', 'Cliente',
+    'Tipo_Envio', 'Fecha_Entrega', 'Comentario', 'Notas', 'Modificacion_Surtido',
+    'Adjuntos', 'Adjuntos_Surtido', 'Estado', 'Estado_Pago', 'Fecha_Completado',
+    'Hora_Proceso', 'Turno', 'Surtidor'
+]
+
+# Columnas de texto largo que las listas no necesitan: la copia en caché no las lee y se cargan solo
+# para los pedidos de la página que se está mostrando (ver load_order_details). Notas y Comentario
+# también son largas, pero el buscador las necesita de todos los pedidos, así que siguen en la copia.
+DETAIL_COLUMNS = ('Modificacion_Surtido', 'Adjuntos', 'Adjuntos_Surtido')
+SNAPSHOT_COLUMNS = [col for col in EXPECTED_COLUMNS if col not in DETAIL_COLUMNS]
+ORDER_DETAILS_CACHE_SIZE = 5000 # Pedidos cuyas DETAIL_COLUMNS se conservan en memoria
+
+# --- Esquema tipado de la copia de pedidos ---
+# Columnas con pocos valores distintos: se guardan como categorías (códigos enteros) en lugar de cadenas
+CATEGORICAL_COLUMNS = ('Estado', 'Tipo_Envio', 'Turno', 'Estado_Pago', 'Surtidor', 'Vendedor_Registro')
+
+# Formato con el que se escribe cada columna de fecha/hora; solo las filas que no cumplen
+# el formato pasan por el análisis flexible (más lento) de pandas
+DATETIME_COLUMN_FORMATS = {
+    'Hora_Registro': '%Y-%m-%d %H:%M:%S',
+    'Fecha_Completado': '%Y-%m-%d', # Al completar un pedido se guarda solo la fecha
+    'Hora_Proceso': '%Y-%m-%d %H:%M:%S',
+}
+FECHA_ENTREGA_FORMAT = '%Y-%m-%d'
+
+# Orden personalizado para 'Tipo_Envio'
+ORDEN_TIPO_ENVIO = {
+    "📍 Pedido Local": 0,
+    "🚚 Pedido Foráneo": 1,
+    "🛠 Garantía": 2,
+    "🔁 Devolución": 3,
+    "📬 Solicitud de guía": 4
+}
+ORDEN_TIPO_ENVIO_DESCONOCIDO = len(ORDEN_TIPO_ENVIO) # Los tipos no reconocidos van al final
+
+def _factorize_stripped(values):
     """
-    Carga todos los datos de una hoja de cálculo de Google Sheets en un DataFrame de Pandas
-    y añade el índice de fila de la hoja de cálculo.
-    Retorna el DataFrame, el objeto worksheet y los encabezados.
+    Factoriza una columna de texto quitando los espacios a cada valor distinto (no a cada fila).
+    Retorna los códigos enteros por fila y los valores distintos ya limpios.
     """
-    try:
-        spreadsheet = gc.open_by_key(sheet_id) 
-        worksheet = spreadsheet.worksheet(worksheet_name)
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object).fillna(''))
+    stripped_codes, categories = pd.factorize(pd.Index(uniques, dtype=object).astype(str).str.strip())
+    return stripped_codes[codes], categories
 
-        # Obtener todos los valores incluyendo los encabezados para poder calcular el índice de fila
-        all_data = worksheet.get_all_values()
-        if not all_data:
-            return pd.DataFrame(), worksheet, [] # Devolver también los encabezados vacíos
+def to_category_column(values):
+    """Columna de texto (sin espacios al inicio/fin) con tipo categórico."""
+    codes, categories = _factorize_stripped(values)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def parse_datetime_column(values, fmt):
+    """
+    Convierte una columna de texto a datetime con el formato explícito `fmt`.
+    Solo las celdas no vacías que no cumplen el formato se analizan de forma flexible; las vacías quedan en NaT.
+    """
+    values = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(values, format=fmt, errors='coerce')
+    failed = values[parsed.isna() & values.notna() & (values != '')].astype(str).str.strip()
+    failed = failed[failed != '']
+    if not failed.empty:
+        parsed[failed.index] = pd.to_datetime(failed, format='mixed', errors='coerce')
+    return parsed
+
+def tipo_envio_orden(tipo_envio):
+    """Clave de orden (entera) de un Tipo_Envio."""
+    return ORDEN_TIPO_ENVIO.get(tipo_envio, ORDEN_TIPO_ENVIO_DESCONOCIDO)
+
+def tipo_envio_orden_column(tipo_envio):
+    """Claves de orden de una columna categórica de Tipo_Envio, calculadas una vez por categoría."""
+    orden_por_categoria = np.array(
+        [tipo_envio_orden(tipo) for tipo in tipo_envio.cat.categories], dtype=np.int8
+    )
+    return pd.Series(orden_por_categoria[tipo_envio.cat.codes.to_numpy()], index=tipo_envio.index)
+
+def unify_categories(*frames):
+    """
+    Unifica, en el lugar, las categorías de las columnas categóricas de varios DataFrames
+    para poder copiar valores entre ellos o concatenarlos sin volver a tipo object.
+    """
+    for col in CATEGORICAL_COLUMNS:
+        series = [frame[col] for frame in frames if col in frame.columns]
+        if len(series) < 2:
+            continue
+        categories = pd.api.types.union_categoricals(series, ignore_order=True).categories
+        for frame in frames:
+            if col in frame.columns:
+                frame[col] = frame[col].cat.set_categories(categories)
+
+def build_orders_dataframe(headers, data_rows, row_indices, expected_columns=EXPECTED_COLUMNS):
+    """
+    Construye el DataFrame de pedidos a partir de filas crudas de Google Sheets.
+    `row_indices` es la lista de índices de fila de la hoja (base 1) de cada fila de `data_rows`.
+    Las columnas de `expected_columns` que no vengan en `headers` se crean vacías.
+    Las columnas de CATEGORICAL_COLUMNS quedan como categorías y las fechas se analizan una sola vez;
+    además se precalculan 'Fecha_Entrega_dt' y 'Tipo_Envio_Orden' para filtrar y ordenar.
+    """
+    # Las lecturas por rango omiten las celdas vacías al final de cada fila; se rellenan para alinear columnas
+    width = len(headers)
+    if any(len(r) != width for r in data_rows):
+        data_rows = [list(r[:width]) + [''] * (width - len(r)) for r in data_rows]
+
+    df = pd.DataFrame(data_rows, columns=headers)
+
+    # Añadir el índice de fila de Google Sheet (basado en 1)
+    df['_gsheet_row_index'] = list(row_indices)
+
+    for col in expected_columns:
+        if col not in df.columns:
+            df[col] = '' # Inicializa columnas faltantes como cadena vacía
+
+    # Fecha_Entrega se conserva como texto (se muestra tal cual) junto con su versión analizada
+    codes, fechas = _factorize_stripped(df['Fecha_Entrega'])
+    df['Fecha_Entrega'] = fechas.to_numpy()[codes]
+    df['Fecha_Entrega_dt'] = parse_datetime_column(df['Fecha_Entrega'], FECHA_ENTREGA_FORMAT)
+
+    # Asegura que las columnas de fecha/hora se manejen correctamente
+    for col, fmt in DATETIME_COLUMN_FORMATS.items():
+        df[col] = parse_datetime_column(df[col], fmt)
+
+    # IMPORTANT: Strip whitespace from key columns to ensure correct filtering and finding
+    df['ID_Pedido'] = df['ID_Pedido'].astype(str).str.strip()
+    for col in CATEGORICAL_COLUMNS:
+        df[col] = to_category_column(df[col])
+
+    df['Tipo_Envio_Orden'] = tipo_envio_orden_column(df['Tipo_Envio'])
+
+    return df
+
+def _column_letter(col_index):
+    """Convierte un índice de columna (base 1) a su letra en notación A1 (ej. 1 -> 'A')."""
+    return re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, col_index))
+
+def _key_column_values(values, row_count):
+    """Normaliza el resultado de una columna leída por rango a una lista de `row_count` cadenas."""
+    cells = [row[0].strip() if row else '' for row in values]
+    return cells + [''] * (row_count - len(cells))
+
+def _version_columns(headers):
+    """Columnas que forman la versión de cada fila: GSHEET_VERSION_COLUMN o, si la hoja no la tiene, GSHEET_WATCH_COLUMNS."""
+    if GSHEET_VERSION_COLUMN in headers:
+        return [GSHEET_VERSION_COLUMN]
+    return [col for col in headers if col in GSHEET_WATCH_COLUMNS]
+
+def _row_versions(rows):
+    """
+    Versión de cada fila: hash de 64 bits de sus celdas de _version_columns, tal como las devuelve
+    la hoja (listas de cadenas del mismo largo). Dos lecturas de una fila sin cambios dan la misma versión.
+    """
+    if not rows or not rows[0]:
+        return [0] * len(rows)
+    return pd.util.hash_pandas_object(pd.DataFrame(rows, dtype=object), index=False).tolist()
+
+@st.cache_resource
+def get_sheet_snapshot_cache(sheet_id, worksheet_name):
+    """
+    Estado compartido por todas las sesiones con la última copia de la hoja.
+    Se mantiene en su propia entrada de caché para poder invalidarla sin afectar a los clientes.
+    """
+    return {
+        'lock': threading.Lock(),
+        'df': None,
+        'worksheet': None,
+        'headers': [],
+        'ids': [],        # ID_Pedido por fila, en el orden de la hoja
+        'versions': [],   # Versión de cada fila (ver _row_versions)
+        'rows_by_id': {}, # ID_Pedido -> fila de la hoja (None si el ID está repetido); ver _build_row_locator
+        'last_sync': 0.0,
+        'last_full_sync': 0.0,
+        'generation': 0,           # Aumenta con cada cambio de la copia (sincronización o escritura)
+        'partition_generation': 0, # Aumenta solo con cambios que afectan al índice de particiones
+        'partitions': None,
+        'source': None,        # 'sheets' o 'disco' (copia local aún sin actualizar)
+        'cond': threading.Condition(), # Despierta al hilo de actualización y a quien espera la primera carga
+        'refresher': None,           # Hilo de actualización (uno por proceso)
+        'refreshing': False,         # Hay una lectura de la hoja en curso
+        'refresh_requested': False,  # Actualizar sin esperar al intervalo
+        'stale': False,              # La copia no es confiable: la siguiente actualización es completa
+        'refresh_error': None,       # Error del último intento de actualización
+        'last_attempt': 0.0,
+        'sync_attempts': 0,
+        'change_log': [],        # (generación, IDs que cambiaron o None = todos, (insertados, modificados, eliminados) o None)
+        'change_log_start': 0,   # El registro está completo a partir de esta generación
+        'search': _empty_search_index(),
+        'details': OrderedDict(), # ID_Pedido -> (versión, {columna de DETAIL_COLUMNS: valor}), LRU
+    }
 
-        headers = all_data[0]
-        data_rows = all_data[1:]
+def _log_snapshot_change(cache, ids, feed=None):
+    """
+    Registra qué pedidos cambiaron en la generación actual de la copia (None = todos, p. ej. tras
+    una recarga completa) y, si se conoce, la tupla `feed` (insertados, modificados, eliminados)
+    por ID_Pedido para el aviso de cambios. Debe llamarse con cache['lock'] tomado.
+    """
+    cache['change_log'].append((
+        cache['generation'],
+        None if ids is None else frozenset(ids),
+        None if feed is None else tuple(frozenset(feed_ids) for feed_ids in feed),
+    ))
+    if len(cache['change_log']) > SNAPSHOT_CHANGE_LOG_SIZE:
+        dropped_generation, _, _ = cache['change_log'].pop(0)
+        cache['change_log_start'] = dropped_generation
+
+def snapshot_changes_since(cache, generation):
+    """
+    IDs de los pedidos que cambiaron después de `generation`, o None si hay que revisarlos todos
+    (recarga completa o registro ya recortado). Debe llamarse con cache['lock'] tomado.
+    """
+    if generation < cache['change_log_start']:
+        return None
+    changed = set()
+    for change_generation, ids, _ in reversed(cache['change_log']):
+        if change_generation <= generation:
+            break
+        if ids is None:
+            return None
+        changed |= ids
+    return changed
+
+def snapshot_feed_since(cache, generation):
+    """
+    Pedidos insertados, modificados y eliminados después de `generation`, combinando las generaciones
+    intermedias (un pedido insertado y luego modificado cuenta como insertado), junto con la última
+    generación en que cambió cada uno: {'inserted', 'updated', 'removed', 'last_changed'}.
+    Retorna None si el registro ya no cubre `generation` o alguna generación no tiene diferencias
+    (p. ej. la copia cargada desde disco). Debe llamarse con cache['lock'] tomado.
+    """
+    if generation < cache['change_log_start']:
+        return None
+    entries = []
+    for entry in reversed(cache['change_log']):
+        if entry[0] <= generation:
+            break
+        if entry[2] is None:
+            return None
+        entries.append(entry)
+    inserted, removed, last_changed = set(), set(), {}
+    for change_generation, _, (entry_inserted, entry_updated, entry_removed) in reversed(entries):
+        for id_pedido in entry_removed:
+            if id_pedido in inserted:
+                inserted.discard(id_pedido)
+                last_changed.pop(id_pedido, None)
+            else:
+                removed.add(id_pedido)
+                last_changed[id_pedido] = change_generation
+        for id_pedido in entry_inserted:
+            if id_pedido in removed:
+                removed.discard(id_pedido) # Eliminado y vuelto a agregar: para quien lo veía, se modificó
+            else:
+                inserted.add(id_pedido)
+            last_changed[id_pedido] = change_generation
+        for id_pedido in entry_updated:
+            last_changed[id_pedido] = change_generation
+    return {
+        'inserted': inserted,
+        'updated': set(last_changed) - inserted - removed,
+        'removed': removed,
+        'last_changed': last_changed,
+    }
 
-        df = pd.DataFrame(data_rows, columns=headers)
+def diff_order_snapshots(old_df, new_df, candidates=None):
+    """
+    Compara dos copias de la hoja por ID_Pedido y retorna (insertados, modificados, eliminados).
+    Un pedido está modificado si cambió algún valor de su fila (se comparan hashes por fila, sin
+    tomar en cuenta la fila de la hoja); con `candidates` solo se comparan esos pedidos.
+    """
+    old_ids = set() if old_df is None or old_df.empty else set(old_df['ID_Pedido'])
+    new_ids = set() if new_df is None or new_df.empty else set(new_df['ID_Pedido'])
+    old_ids.discard('')
+    new_ids.discard('')
+    common = old_ids & new_ids
+    if candidates is not None:
+        common &= set(candidates)
+    if not common:
+        return new_ids - old_ids, set(), old_ids - new_ids
+
+    columns = [col for col in new_df.columns if col != '_gsheet_row_index']
+    if set(columns) != set(old_df.columns) - {'_gsheet_row_index'}:
+        updated = common # Cambió la estructura de la hoja: todos los pedidos se vuelven a dibujar
+    else:
+        row_hashes = []
+        for df in (old_df, new_df):
+            rows = df[df['ID_Pedido'].isin(common)]
+            row_hashes.append(dict(zip(rows['ID_Pedido'], pd.util.hash_pandas_object(rows[columns], index=False))))
+        updated = {id_pedido for id_pedido in common if row_hashes[0].get(id_pedido) != row_hashes[1].get(id_pedido)}
+    return new_ids - old_ids, updated, old_ids - new_ids
+
+def _build_row_locator(ids):
+    """
+    Ubicador ID_Pedido -> fila de la hoja (base 1 de gspread) a partir de los ID en el orden de la hoja.
+    Los ID repetidos quedan con None: no se puede saber a cuál de sus filas se refiere una escritura.
+    """
+    locator = {}
+    for row_index, id_pedido in enumerate(ids, start=2):
+        if id_pedido:
+            locator[id_pedido] = None if id_pedido in locator else row_index
+    return locator
+
+def _set_snapshot_keys(cache, versions):
+    """Guarda las columnas clave (ID_Pedido y la versión de cada fila) y el ubicador de filas de la copia en caché."""
+    cache['ids'] = cache['df']['ID_Pedido'].tolist() if cache['headers'] else []
+    cache['versions'] = list(versions)
+    cache['rows_by_id'] = _build_row_locator(cache['ids'])
+
+def locate_order_row(sheet_id, worksheet_name, id_pedido):
+    """Fila actual del pedido en la hoja según la copia en caché, o None si no se puede ubicar."""
+    return get_sheet_snapshot_cache(sheet_id, worksheet_name)['rows_by_id'].get(id_pedido)
+
+def _position_runs(positions, max_gap=1):
+    """
+    Agrupa posiciones ordenadas en tramos consecutivos [(inicio, fin), ...] para leerlos por rango.
+    Con `max_gap` > 1 también se unen posiciones separadas por menos de `max_gap` (se leen las intermedias).
+    """
+    runs = []
+    for pos in positions:
+        if runs and pos - runs[-1][1] <= max_gap:
+            runs[-1] = (runs[-1][0], pos)
+        else:
+            runs.append((pos, pos))
+    return runs
+
+def _snapshot_column_runs(headers):
+    """
+    Tramos de columnas contiguas (posiciones base 0 en `headers`) que guarda la copia en caché,
+    es decir, todas menos DETAIL_COLUMNS, y los encabezados de esas columnas.
+    """
+    positions = [pos for pos, col in enumerate(headers) if col not in DETAIL_COLUMNS]
+    return _position_runs(positions), [headers[pos] for pos in positions]
 
-        # Añadir el índice de fila de Google Sheet (basado en 1)
+def _column_ranges(col_runs, row_runs):
+    """
+    Rangos A1 para leer solo los tramos de columnas `col_runs` de los tramos de filas `row_runs`
+    [(primera, última), ...] (filas base 1; última None = hasta el final de la hoja).
+    """
+    return [
+        f"{_column_letter(first_col + 1)}{first_row}:{_column_letter(last_col + 1)}{last_row or ''}"
+        for first_row, last_row in row_runs
+        for first_col, last_col in col_runs
+    ]
+
+def _join_column_ranges(results, col_runs, row_runs):
+    """
+    Une los rangos leídos con _column_ranges en filas con una celda por columna leída.
+    Retorna la lista de filas de cada tramo de `row_runs`.
+    """
+    widths = [last_col - first_col + 1 for first_col, last_col in col_runs]
+    rows_by_run = []
+    for run, (first_row, last_row) in enumerate(row_runs):
+        parts = results[run * len(col_runs):(run + 1) * len(col_runs)]
+        # Las lecturas por rango omiten las filas vacías al final; sin última fila, manda el tramo más largo
+        row_count = last_row - first_row + 1 if last_row else max((len(values) for values in parts), default=0)
+        rows = [[] for _ in range(row_count)]
+        for values, width in zip(parts, widths):
+            for row, cells in zip(rows, list(values) + [[]] * (row_count - len(values))):
+                row.extend(cells)
+                row.extend([''] * (width - len(cells)))
+        rows_by_run.append(rows)
+    return rows_by_run
+
+def _full_sync_snapshot(cache, sheet_id, worksheet_name):
+    """
+    Recarga completa de la hoja: lee en una sola solicitud los encabezados y las columnas de la copia
+    (sin DETAIL_COLUMNS), por tramos de columnas contiguas.
+    """
+    spreadsheet = gc.open_by_key(sheet_id)
+    worksheet = spreadsheet.worksheet(worksheet_name)
+
+    # Los tramos se calculan con los encabezados conocidos; si la hoja cambió de estructura
+    # (o es la primera carga) se vuelve a leer con los encabezados nuevos
+    headers = cache['headers']
+    while True:
+        col_runs, key_headers = _snapshot_column_runs(headers)
+        results = worksheet.batch_get(['1:1'] + _column_ranges(col_runs, [(2, None)]))
+        current_headers = list(results[0][0]) if results[0] else []
+        if current_headers == headers:
+            break
+        headers = current_headers
+
+    if headers:
         # Asumiendo que el encabezado está en la fila 1, la primera fila de datos es la fila 2.
-        df['_gsheet_row_index'] = df.index + 2
-
-        # Define las columnas esperadas y asegúrate de que existan
-        expected_columns = [
-            'ID_Pedido', 'Folio_Factura', 'Hora_Registro', 'Vendedor_Registro', 'Cliente',
-            'Tipo_Envio', 'Fecha_Entrega', 'Comentario', 'Notas', 'Modificacion_Surtido',
-            'Adjuntos', 'Adjuntos_Surtido', 'Estado', 'Estado_Pago', 'Fecha_Completado',
-            'Hora_Proceso', 'Turno', 'Surtidor'
-        ]
+        data_rows = _join_column_ranges(results[1:], col_runs, [(2, None)])[0]
+        df = build_orders_dataframe(key_headers, data_rows, range(2, len(data_rows) + 2), SNAPSHOT_COLUMNS)
+        version_positions = [key_headers.index(col) for col in _version_columns(headers)]
+        versions = _row_versions([[row[pos] for pos in version_positions] for row in data_rows])
+    else:
+        df = pd.DataFrame()
+        versions = []
+
+    cache['worksheet'] = worksheet
+    cache['headers'] = headers
+    cache['df'] = df
+    _set_snapshot_keys(cache, versions)
+    cache['last_full_sync'] = time.time()
+    cache['generation'] += 1
+    cache['partition_generation'] += 1
+
+def _delta_sync_snapshot(cache):
+    """
+    Sincroniza solo los cambios desde la última lectura: lee los encabezados y las columnas
+    clave (ID_Pedido y las de _version_columns) en una sola solicitud, y después descarga
+    únicamente las filas nuevas o cuya versión cambió (sin DETAIL_COLUMNS).
+    Si otra aplicación insertó, eliminó o movió filas, reubica la copia por ID_Pedido
+    (ver _relocate_snapshot_rows). Retorna False si detecta un cambio que requiere una recarga
+    completa (encabezados distintos o ID_Pedido vacíos o repetidos en filas movidas).
+    """
+    worksheet = cache['worksheet']
+    headers = cache['headers']
+    if not headers or 'ID_Pedido' not in headers:
+        return False
 
-        for col in expected_columns:
-            if col not in df.columns:
-                df[col] = '' # Inicializa columnas faltantes como cadena vacía
+    last_col = _column_letter(len(headers))
+    id_col = _column_letter(headers.index('ID_Pedido') + 1)
+    version_runs = _position_runs([headers.index(col) for col in _version_columns(headers)])
+    ranges = [f"A1:{last_col}1", f"{id_col}2:{id_col}"] + _column_ranges(version_runs, [(2, None)])
 
-        # Asegura que las columnas de fecha/hora se manejen correctamente
-        df['Fecha_Entrega'] = df['Fecha_Entrega'].apply(
-            lambda x: str(x) if pd.notna(x) and str(x).strip() != '' else ''
-        )
+    results = worksheet.batch_get(ranges)
+    current_headers = list(results[0][0]) if results[0] else []
+    current_headers += [''] * (len(headers) - len(current_headers))
+    if current_headers != headers:
+        return False
 
-        df['Hora_Registro'] = pd.to_datetime(df['Hora_Registro'], errors='coerce')
-        df['Fecha_Completado'] = pd.to_datetime(df['Fecha_Completado'], errors='coerce')
-        df['Hora_Proceso'] = pd.to_datetime(df['Hora_Proceso'], errors='coerce') # Ensure Hora_Proceso is datetime
+    version_rows = _join_column_ranges(results[2:], version_runs, [(2, None)])[0]
+    row_count = max(len(results[1]), len(version_rows))
+    version_width = sum(last - first + 1 for first, last in version_runs)
+    version_rows += [[''] * version_width] * (row_count - len(version_rows))
+    new_ids = _key_column_values(results[1], row_count)
+    new_versions = _row_versions(version_rows)
 
-        # IMPORTANT: Strip whitespace from key columns to ensure correct filtering and finding
-        df['ID_Pedido'] = df['ID_Pedido'].astype(str).str.strip()
-        df['Tipo_Envio'] = df['Tipo_Envio'].astype(str).str.strip()
-        df['Turno'] = df['Turno'].astype(str).str.strip()
-        df['Estado'] = df['Estado'].astype(str).str.strip()
+    old_ids = cache['ids']
+    old_count = len(old_ids)
+    if row_count < old_count or new_ids[:old_count] != old_ids:
+        return _relocate_snapshot_rows(cache, new_ids, new_versions)
 
-        return df, worksheet, headers # Devolver también los encabezados
+    changed_positions = [
+        pos for pos in range(old_count) if new_versions[pos] != cache['versions'][pos]
+    ]
+    appended = row_count > old_count
+    if not changed_positions and not appended:
+        return True
 
-    except gspread.exceptions.SpreadsheetNotFound:
-        st.error(f"❌ Error: La hoja de cálculo con ID '{sheet_id}' no se encontró. Verifica el ID.")
-        st.stop()
-    except gspread.exceptions.WorksheetNotFound:
-        st.error(f"❌ Error: La pestaña '{worksheet_name}' no se encontró en la hoja de cálculo. Verifica el nombre de la pestaña.")
-        st.stop()
-    except Exception as e:
-        st.error(f"❌ Error al cargar los datos desde Google Sheets: {e}")
-        st.stop()
+    col_runs, key_headers = _snapshot_column_runs(headers)
+    row_runs = [(start + 2, end + 2) for start, end in _position_runs(changed_positions)]
+    if appended:
+        row_runs.append((old_count + 2, row_count + 1))
+    fetched = _join_column_ranges(worksheet.batch_get(_column_ranges(col_runs, row_runs)), col_runs, row_runs)
+
+    with cache['lock']:
+        df = cache['df'].copy() # Copia para no alterar el DataFrame que otras sesiones están leyendo
+    if changed_positions:
+        changed_rows = [row for rows in (fetched[:-1] if appended else fetched) for row in rows]
+        changed_df = build_orders_dataframe(key_headers, changed_rows, [pos + 2 for pos in changed_positions], SNAPSHOT_COLUMNS)
+        unify_categories(df, changed_df)
+        for col in changed_df.columns:
+            df.loc[changed_positions, col] = changed_df[col].values
+    if appended:
+        appended_df = build_orders_dataframe(key_headers, fetched[-1], range(old_count + 2, row_count + 2), SNAPSHOT_COLUMNS)
+        appended_df.index = range(old_count, row_count)
+        unify_categories(df, appended_df)
+        df = pd.concat([df, appended_df])
+
+    cache['df'] = df
+    cache['ids'] = new_ids
+    cache['versions'] = new_versions
+    if appended:
+        cache['rows_by_id'] = _build_row_locator(new_ids)
+    cache['changed_ids'] = {new_ids[pos] for pos in changed_positions} | set(new_ids[old_count:])
+    cache['generation'] += 1
+    cache['partition_generation'] += 1
+    return True
+
+def _relocate_snapshot_rows(cache, new_ids, new_versions):
+    """
+    Actualiza la copia cuando las filas de la hoja cambiaron de posición (filas insertadas, eliminadas
+    o movidas por otra aplicación) sin recargarla completa: las filas cuyo ID_Pedido ya estaba en la
+    copia con la misma versión solo cambian de número de fila, y las nuevas o modificadas se descargan
+    en una sola solicitud, agrupadas en tramos consecutivos.
+    Retorna False si hay ID_Pedido vacíos o repetidos, con los que no se puede ubicar una fila con certeza.
+    """
+    headers = cache['headers']
+    new_locator = _build_row_locator(new_ids)
+    if len(new_locator) != len(new_ids) or None in new_locator.values():
+        return False
+
+    old_locator = cache['rows_by_id']
+    sources = [old_locator.get(id_pedido) for id_pedido in new_ids]
+    kept, fetch = [], []
+    for pos, source in enumerate(sources):
+        if source is not None and new_versions[pos] == cache['versions'][source - 2]:
+            kept.append(pos)
+        else:
+            fetch.append(pos)
+
+    fetched_rows = []
+    if fetch:
+        col_runs, key_headers = _snapshot_column_runs(headers)
+        row_runs = [(start + 2, end + 2) for start, end in _position_runs(fetch)]
+        results = cache['worksheet'].batch_get(_column_ranges(col_runs, row_runs))
+        for rows in _join_column_ranges(results, col_runs, row_runs):
+            fetched_rows += rows
+
+    with cache['lock']:
+        base = cache['df']
+    df = base.take([sources[pos] - 2 for pos in kept])
+    df.index = kept
+    df['_gsheet_row_index'] = [pos + 2 for pos in kept]
+    if fetch:
+        fetched_df = build_orders_dataframe(key_headers, fetched_rows, [pos + 2 for pos in fetch], SNAPSHOT_COLUMNS)
+        fetched_df.index = fetch
+        unify_categories(df, fetched_df)
+        df = pd.concat([df, fetched_df]).sort_index()
+
+    cache['df'] = df
+    cache['ids'] = new_ids
+    cache['versions'] = new_versions
+    cache['rows_by_id'] = new_locator
+    cache['changed_ids'] = None # Cambiaron las posiciones de todos los pedidos
+    cache['generation'] += 1
+    cache['partition_generation'] += 1
+    return True
+
+def _snapshot_paths(sheet_id, worksheet_name):
+    """Rutas del archivo Parquet con la copia local y de su marca de sincronización (JSON)."""
+    base = os.path.join(LOCAL_CACHE_DIR, f"pedidos_{re.sub(r'[^0-9A-Za-z_-]+', '_', f'{sheet_id}_{worksheet_name}')}")
+    return f"{base}.parquet", f"{base}.json"
+
+def _save_snapshot_to_disk(snapshot, sheet_id, worksheet_name, data_changed=True):
+    """
+    Guarda la copia sincronizada (escritura atómica) junto con su marca de sincronización.
+    Si los datos no cambiaron solo se actualiza la marca. `snapshot` tiene las claves de
+    SNAPSHOT_SYNC_KEYS tal como se leyeron de la hoja, sin las escrituras pendientes, para no
+    guardar valores aún no confirmados. Se llama sin cache['lock']: los DataFrames publicados no
+    se modifican (copy-on-write), así que escribir el archivo no bloquea a lectores ni escrituras.
+    La copia local es solo una optimización: los errores se ignoran.
+    """
+    if pyarrow is None or snapshot['df'] is None:
+        return
+    data_path, meta_path = _snapshot_paths(sheet_id, worksheet_name)
+    meta = {
+        'version': SNAPSHOT_FORMAT_VERSION,
+        'sheet_id': sheet_id,
+        'worksheet': worksheet_name,
+        'headers': snapshot['headers'],
+        'rows': len(snapshot['df']),
+        'synced_at': time.time(),
+        'full_synced_at': snapshot['last_full_sync'],
+    }
+    try:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        if data_changed or not os.path.exists(data_path):
+            # La versión de cada fila se guarda con la copia para que la siguiente sincronización sea parcial
+            snapshot['df'].assign(_version=np.array(snapshot['versions'], dtype=np.uint64)).to_parquet(f"{data_path}.tmp", engine='pyarrow')
+            os.replace(f"{data_path}.tmp", data_path)
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+    except (OSError, ValueError, TypeError, pyarrow.ArrowException):
+        pass
+
+def _load_snapshot_from_disk(cache, sheet_id, worksheet_name):
+    """
+    Carga en la caché la copia local guardada por _save_snapshot_to_disk.
+    Retorna False si no existe, es de otro formato u otra hoja, o no corresponde con su marca.
+    """
+    if pyarrow is None:
+        return False
+    data_path, meta_path = _snapshot_paths(sheet_id, worksheet_name)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if (
+            meta.get('version') != SNAPSHOT_FORMAT_VERSION
+            or meta.get('sheet_id') != sheet_id
+            or meta.get('worksheet') != worksheet_name
+        ):
+            return False
+        # pyarrow entrega arreglos de solo lectura; la copia en caché se modifica con las escrituras
+        df = pd.read_parquet(data_path, engine='pyarrow').copy()
+    except (OSError, ValueError, pyarrow.ArrowException):
+        return False
+    if len(df) != meta['rows'] or not meta['headers']:
+        return False
+
+    versions = df.pop('_version').tolist()
+    cache['df'] = df
+    cache['headers'] = meta['headers']
+    _set_snapshot_keys(cache, versions)
+    cache['last_sync'] = meta['synced_at']
+    cache['last_full_sync'] = meta['full_synced_at']
+    cache['generation'] += 1
+    cache['partition_generation'] += 1
+    _log_snapshot_change(cache, None)
+    cache['source'] = 'disco'
+    return True
+
+# Campos de la copia que reemplaza cada sincronización (el resto del estado vive solo en la caché)
+SNAPSHOT_SYNC_KEYS = ('df', 'worksheet', 'headers', 'ids', 'versions', 'rows_by_id', 'last_full_sync')
+
+def _sync_snapshot(cache, sheet_id, worksheet_name, force_full=False):
+    """
+    Sincroniza la copia en caché con la hoja: solo los cambios (filas nuevas o modificadas) o, al
+    inicio, cada GSHEET_FULL_RESYNC_INTERVAL_SECONDS, si la hoja cambió de estructura o con
+    `force_full`, recarga completa.
+    Las lecturas a Google Sheets se hacen sobre una copia de trabajo sin tomar cache['lock'];
+    el lock solo se toma para publicar el resultado y la copia local se guarda después de soltarlo,
+    así que lectores y escrituras no esperan a la red ni al disco.
+    Solo debe llamarla el hilo de actualización. No usa st.*: los errores se propagan a quien llama.
+    """
+    now = time.time()
+    staged = {key: cache[key] for key in SNAPSHOT_SYNC_KEYS}
+    staged.update(lock=cache['lock'], generation=0, partition_generation=0, changed_ids=None)
+    if staged['df'] is not None and staged['worksheet'] is None:
+        # Copia cargada desde disco: basta con abrir la hoja para aplicar solo los cambios
+        staged['worksheet'] = gc.open_by_key(sheet_id).worksheet(worksheet_name)
+    needs_full_sync = (
+        force_full
+        or staged['df'] is None
+        or now - staged['last_full_sync'] >= GSHEET_FULL_RESYNC_INTERVAL_SECONDS
+    )
+    if needs_full_sync or not _delta_sync_snapshot(staged):
+        _full_sync_snapshot(staged, sheet_id, worksheet_name)
+    data_changed = staged['generation'] > 0
+    if data_changed:
+        # Diferencias por pedido con la copia anterior para el aviso de cambios, fuera del lock
+        feed = diff_order_snapshots(cache['df'], staged['df'], staged['changed_ids'])
+
+    with cache['lock']:
+        if data_changed:
+            for key in SNAPSHOT_SYNC_KEYS:
+                cache[key] = staged[key]
+            cache['generation'] += 1
+            cache['partition_generation'] += 1
+            _log_snapshot_change(cache, staged['changed_ids'], feed) # IDs: None tras una recarga completa
+            _discard_order_details(cache, staged['changed_ids'])
+        else:
+            cache['worksheet'] = staged['worksheet']
+            cache['last_full_sync'] = staged['last_full_sync']
+        if data_changed:
+            # Las escrituras aplicadas a la copia anterior mientras se leía la hoja siguen en la cola
+            # o se confirmaron después de la lectura
+            _overlay_pending_writes(cache, sheet_id, worksheet_name, now)
+        cache['last_sync'] = now
+        cache['source'] = 'sheets'
+        # El índice de particiones se calcula una sola vez por copia, aquí y no en cada pestaña
+        _ensure_order_partitions(cache)
+
+    # Fuera del lock: `staged` tiene referencias a lo publicado, que no cambia (copy-on-write)
+    _save_snapshot_to_disk(staged, sheet_id, worksheet_name, data_changed=data_changed)
+
+def _snapshot_refresh_wait(cache):
+    """Segundos que faltan para la siguiente actualización (0 si ya toca). Requiere cache['cond']."""
+    if cache['stale'] or cache['refresh_requested']:
+        return 0
+    last = max(cache['last_sync'], cache['last_attempt'])
+    return max(0.0, last + GSHEET_SYNC_INTERVAL_SECONDS - time.time())
+
+def _snapshot_refresher_loop(cache, sheet_id, worksheet_name):
+    """
+    Hilo de actualización de la copia: es el único que lee la hoja, así que nunca hay más de
+    una lectura en curso (single-flight). Se despierta cada GSHEET_SYNC_INTERVAL_SECONDS o al
+    pedirse una actualización, y termina si la caché se descartó (por ejemplo, con "Clear cache").
+    """
+    # Con la copia cargada desde disco, el índice de búsqueda queda listo sin esperar a la hoja
+    update_search_index(cache)
+    while get_sheet_snapshot_cache(sheet_id, worksheet_name) is cache:
+        with cache['cond']:
+            wait = _snapshot_refresh_wait(cache)
+            if wait > 0:
+                cache['cond'].wait(timeout=wait)
+                continue
+            force_full = cache['stale']
+            cache['stale'] = cache['refresh_requested'] = False
+            cache['refreshing'] = True
+
+        try:
+            with sheets_quota_lane('fondo'): # Las escrituras y lecturas del usuario van primero
+                _sync_snapshot(cache, sheet_id, worksheet_name, force_full=force_full)
+            update_search_index(cache) # Deja el índice de búsqueda listo antes de que alguien busque
+            error = None
+        except Exception as e:
+            error = e
+            if force_full:
+                cache['stale'] = True # La copia sigue sin confirmarse; se reintenta en el siguiente ciclo
+
+        with cache['cond']:
+            cache['refresh_error'] = error
+            cache['refreshing'] = False
+            cache['last_attempt'] = time.time()
+            cache['sync_attempts'] += 1
+            cache['cond'].notify_all()
+
+def _ensure_snapshot_refresher(cache, sheet_id, worksheet_name):
+    """Inicia, una sola vez por proceso, el hilo de actualización de la copia."""
+    with cache['cond']:
+        if cache['refresher'] is None or not cache['refresher'].is_alive():
+            cache['refresher'] = threading.Thread(
+                target=_snapshot_refresher_loop,
+                args=(cache, sheet_id, worksheet_name),
+                name=f"gsheet-snapshot-{worksheet_name}",
+                daemon=True,
+            )
+            cache['refresher'].start()
+
+def request_snapshot_refresh(sheet_id, worksheet_name, full=False):
+    """Despierta al hilo de actualización para sincronizar ya (con `full`, recarga completa)."""
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    with cache['cond']:
+        cache['refresh_requested'] = True
+        cache['stale'] = cache['stale'] or full
+        cache['cond'].notify_all()
+
+def get_snapshot_worksheet(sheet_id, worksheet_name):
+    """
+    Retorna el worksheet de la copia en caché. Si la copia se cargó desde disco y la hoja
+    todavía no se abrió, la abre ahora (solo ocurre al escribir antes de terminar la actualización).
+    """
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    worksheet = cache['worksheet']
+    if worksheet is None:
+        worksheet = gc.open_by_key(sheet_id).worksheet(worksheet_name)
+        cache['worksheet'] = worksheet
+    return worksheet
+
+def _wait_for_first_snapshot(cache, sheet_id, worksheet_name):
+    """Espera a que el hilo de actualización termine un intento de carga. Retorna su error o None."""
+    request_snapshot_refresh(sheet_id, worksheet_name)
+    with cache['cond']:
+        attempts = cache['sync_attempts']
+        while cache['df'] is None and cache['sync_attempts'] == attempts and cache['refresher'].is_alive():
+            cache['cond'].wait(timeout=1)
+        return cache['refresh_error'] if cache['df'] is None else None
+
+@trace_span('carga.pedidos')
+def load_data_from_gsheets(sheet_id, worksheet_name):
+    """
+    Retorna la copia en caché de la hoja de cálculo como DataFrame de Pandas (con el índice
+    de fila de la hoja), el objeto worksheet y los encabezados.
+    Nunca lee la hoja: la copia la mantiene un único hilo de actualización por proceso
+    (ver _snapshot_refresher_loop), que cada GSHEET_SYNC_INTERVAL_SECONDS aplica solo los cambios
+    y cada GSHEET_FULL_RESYNC_INTERVAL_SECONDS o ante cambios de estructura recarga completa.
+    Al arrancar el proceso se sirve la copia guardada en disco (si existe) mientras se actualiza;
+    mientras tanto el worksheet puede ser None (ver get_snapshot_worksheet). Solo la primera carga
+    sin copia en disco espera a Google Sheets.
+    """
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    if cache['df'] is None:
+        with cache['lock']:
+            if cache['df'] is None and _load_snapshot_from_disk(cache, sheet_id, worksheet_name):
+                _overlay_pending_writes(cache, sheet_id, worksheet_name, cache['last_sync'])
+                _ensure_order_partitions(cache)
+    _ensure_snapshot_refresher(cache, sheet_id, worksheet_name)
+
+    if cache['df'] is None:
+        try:
+            error = _wait_for_first_snapshot(cache, sheet_id, worksheet_name)
+            if error is not None:
+                raise error
+
+        except gspread.exceptions.SpreadsheetNotFound:
+            st.error(f"❌ Error: La hoja de cálculo con ID '{sheet_id}' no se encontró. Verifica el ID.")
+            st.stop()
+        except gspread.exceptions.WorksheetNotFound:
+            st.error(f"❌ Error: La pestaña '{worksheet_name}' no se encontró en la hoja de cálculo. Verifica el nombre de la pestaña.")
+            st.stop()
+        except Exception as e:
+            st.error(f"❌ Error al cargar los datos desde Google Sheets: {e}")
+            st.stop()
+
+    return cache['df'], cache['worksheet'], cache['headers'] # Devolver también los encabezados
+
+@st.fragment(run_every=SNAPSHOT_STATUS_POLL_SECONDS)
+def _render_disk_snapshot_badge(sheet_id, worksheet_name):
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    if cache['source'] != 'disco':
+        st.rerun() # La actualización terminó: volver a dibujar la página con los datos nuevos
+    synced_at = datetime.fromtimestamp(cache['last_sync']).strftime('%d/%m/%Y %H:%M')
+    if cache['refresh_error'] is not None:
+        st.badge(f"Datos al {synced_at} (copia local)", icon="⚠️", color="red")
+        st.caption(f"No se pudo actualizar desde Google Sheets: {cache['refresh_error']}")
+    else:
+        st.badge(f"Datos al {synced_at} (copia local) · actualizando desde Google Sheets…", icon="🕒", color="orange")
+
+def render_snapshot_status(sheet_id, worksheet_name):
+    """Muestra la antigüedad de los datos mientras se sirven desde la copia local."""
+    if get_sheet_snapshot_cache(sheet_id, worksheet_name)['source'] == 'disco':
+        _render_disk_snapshot_badge(sheet_id, worksheet_name)
+
+@st.fragment(run_every=LIVE_FEED_POLL_SECONDS)
+def render_live_feed(sheet_id, worksheet_name):
+    """
+    Aviso de cambios de la sesión, en lugar de recargar la página a mano. Cada LIVE_FEED_POLL_SECONDS
+    compara la generación de la copia con la vista (st.session_state["feed_generation"]) usando el
+    registro de cambios (snapshot_feed_since), sin leer la hoja. Si llegaron pedidos nuevos muestra
+    un aviso. Solo vuelve a ejecutar la página si cambiaron los conteos de las pestañas o un pedido
+    que se está mostrando; si no, únicamente avanza la generación vista.
+    Streamlit no permite volver a ejecutar otro fragmento, así que las tarjetas afectadas se
+    actualizan con la página.
+    """
+    pending_toast = st.session_state.pop("feed_toast", None)
+    if pending_toast:
+        st.toast(pending_toast, icon="🆕")
+    seen = st.session_state.get("feed_generation")
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    with cache['lock']:
+        generation = cache['generation']
+        if seen is None or generation == seen or cache['df'] is None:
+            return
+        feed = snapshot_feed_since(cache, seen)
+        counts = partition_counts(_ensure_order_partitions(cache))
+    st.session_state["feed_generation"] = generation
+    if feed is None:
+        st.rerun() # Sin diferencias por pedido (p. ej. registro recortado): se vuelve a dibujar todo
+
+    toast = f"{len(feed['inserted'])} pedido(s) nuevo(s)" if feed['inserted'] else None
+    card_generations = st.session_state["card_generations"]
+    stale_cards = any(
+        feed['last_changed'][id_pedido] > card_generations.get(id_pedido, seen)
+        for id_pedido in st.session_state["visible_orders"] if id_pedido in feed['last_changed']
+    )
+    if stale_cards or counts != st.session_state.get("feed_counts"):
+        st.session_state["feed_toast"] = toast # Se muestra al volver a dibujar la página
+        st.rerun()
+    if toast:
+        st.toast(toast, icon="🆕")
+
+# --- Order Details (DETAIL_COLUMNS bajo demanda) ---
+def _discard_order_details(cache, changed_ids):
+    """
+    Descarta de la caché de detalles los pedidos que cambiaron en la hoja. Con changed_ids=None
+    (recarga completa) solo se conservan los que siguen en la misma versión, y solo si la hoja tiene
+    GSHEET_VERSION_COLUMN (el hash de GSHEET_WATCH_COLUMNS no cubre DETAIL_COLUMNS).
+    Debe llamarse con cache['lock'] tomado.
+    """
+    details = cache['details']
+    if changed_ids is not None:
+        for id_pedido in changed_ids:
+            details.pop(id_pedido, None)
+        return
+    versions = dict(zip(cache['ids'], cache['versions'])) if GSHEET_VERSION_COLUMN in cache['headers'] else {}
+    for id_pedido, (version, _) in list(details.items()):
+        if versions.get(id_pedido) != version:
+            del details[id_pedido]
+
+DETAIL_READ_MAX_GAP_ROWS = 20 # Filas intermedias que se leen de más para unir dos tramos en un solo rango
+DETAIL_READ_MAX_RANGES = 100 # Rangos por solicitud (van en la URL de values:batchGet)
+
+def _read_order_details(worksheet, headers, row_indices):
+    """
+    Lee de la hoja ID_Pedido y DETAIL_COLUMNS de las filas `row_indices`: una sola solicitud para una
+    página de pedidos y una por cada DETAIL_READ_MAX_RANGES rangos para listas más largas.
+    Retorna {fila: (ID_Pedido, {columna: valor})}; el ID permite descartar filas que se movieron.
+    """
+    positions = [pos for pos, col in enumerate(headers) if col == 'ID_Pedido' or col in DETAIL_COLUMNS]
+    columns = [headers[pos] for pos in positions]
+    col_runs = _position_runs(positions)
+    row_runs = _position_runs(sorted(set(row_indices)), max_gap=DETAIL_READ_MAX_GAP_ROWS + 1)
+    runs_per_request = max(1, DETAIL_READ_MAX_RANGES // len(col_runs))
+    fetched = {}
+    for start in range(0, len(row_runs), runs_per_request):
+        request_runs = row_runs[start:start + runs_per_request]
+        results = worksheet.batch_get(_column_ranges(col_runs, request_runs))
+        for (first_row, _), rows in zip(request_runs, _join_column_ranges(results, col_runs, request_runs)):
+            for row_index, row in enumerate(rows, start=first_row):
+                values = dict(zip(columns, row))
+                fetched[row_index] = (values.pop('ID_Pedido').strip(), values)
+    return fetched
+
+def get_order_row(sheet_id, worksheet_name, id_pedido):
+    """
+    Fila actual de un pedido en la copia en caché, ya con DETAIL_COLUMNS (ver load_order_details),
+    o None si el pedido ya no está en la copia.
+    """
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    with cache['lock']:
+        df = cache['df']
+        row_index = cache['rows_by_id'].get(id_pedido)
+    if df is None or row_index is None or not 0 <= row_index - 2 < len(df):
+        return None
+    df_row = df.iloc[[row_index - 2]]
+    if df_row['ID_Pedido'].iat[0] != id_pedido:
+        return None
+    return load_order_details(sheet_id, worksheet_name, df_row).iloc[0]
+
+@trace_span('carga.detalles')
+def load_order_details(sheet_id, worksheet_name, df_orders):
+    """
+    Retorna `df_orders` (filas de la copia en caché) con las columnas DETAIL_COLUMNS.
+    Los pedidos que no están en la caché de detalles se leen de la hoja en una sola solicitud y
+    se guardan por ID_Pedido; encima se aplican sus escrituras aún en la cola. Si la lectura falla
+    o la fila ya no corresponde al pedido, sus detalles quedan vacíos (sin guardarse).
+    """
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    ids = df_orders['ID_Pedido'].tolist()
+    row_indices = df_orders['_gsheet_row_index'].tolist()
+    values_by_id = {}
+    with cache['lock']:
+        details = cache['details']
+        for id_pedido in ids:
+            if id_pedido in details:
+                details.move_to_end(id_pedido)
+                values_by_id[id_pedido] = details[id_pedido][1]
+        headers = cache['headers']
+        generation = cache['generation']
+        versions = dict(zip(cache['ids'], cache['versions']))
+
+    missing = [(row_index, id_pedido) for row_index, id_pedido in zip(row_indices, ids) if id_pedido not in values_by_id]
+    if missing and 'ID_Pedido' in headers:
+        try:
+            worksheet = get_snapshot_worksheet(sheet_id, worksheet_name)
+            fetched = _read_order_details(worksheet, headers, [row_index for row_index, _ in missing])
+        except Exception as e:
+            st.warning(f"⚠️ No se pudieron cargar los adjuntos y modificaciones de surtido de algunos pedidos: {e}")
+            fetched = {}
+        pending = _pending_detail_writes(cache, sheet_id, worksheet_name, headers)
+        moved = False
+        for row_index, id_pedido in missing:
+            fetched_id, values = fetched.get(row_index, ('', None))
+            if values is None:
+                continue
+            if fetched_id != id_pedido:
+                moved = True
+                continue
+            values.update(pending.get(id_pedido, {}))
+            values_by_id[id_pedido] = values
+        if moved:
+            request_snapshot_refresh(sheet_id, worksheet_name) # La hoja cambió desde la última sincronización
+
+        with cache['lock']:
+            # Lo leído no se guarda si el pedido cambió en la copia mientras se leía la hoja
+            changed = snapshot_changes_since(cache, generation)
+            if changed is not None:
+                details = cache['details']
+                for _, id_pedido in missing:
+                    if id_pedido in values_by_id and id_pedido not in changed:
+                        details[id_pedido] = (versions.get(id_pedido), values_by_id[id_pedido])
+                while len(details) > ORDER_DETAILS_CACHE_SIZE:
+                    details.popitem(last=False)
+
+    return df_orders.assign(**{
+        col: [values_by_id.get(id_pedido, {}).get(col, '') for id_pedido in ids] for col in DETAIL_COLUMNS
+    })
+
+# --- Order Partition Index ---
+PARTITION_COLUMNS = ('Estado', 'Fecha_Entrega', 'Tipo_Envio', 'Turno')
+ESTADOS_ACTIVOS = ('pendiente', 'en_proceso') # Pedidos que no están Completados ni Cancelados
+
+def build_order_partitions(df, today=None):
+    """
+    Agrupa las filas de una copia de la hoja por (estado, fecha de entrega, Tipo_Envio, Turno).
+    Cada grupo guarda las posiciones de sus filas ya en el orden de presentación
+    (tipo de envío y fecha de entrega, igual que ordenar_pedidos_custom), de modo que las
+    pestañas obtienen sus pedidos y conteos sin volver a filtrar ni copiar el DataFrame.
+    Estados: 'pendiente', 'en_proceso', 'completado', 'cancelado'.
+    Fechas: 'pasado', 'hoy', 'manana', 'futuro', 'sin_fecha'. Un Turno vacío se agrupa como 'N/A'.
+    """
+    today = today or datetime.now().date()
+    partitions = {'date': today, 'groups': {}, 'rank': np.empty(0, dtype=np.int64)}
+    if df.empty:
+        return partitions
+
+    estado = df['Estado'] # Categórica: las comparaciones se hacen sobre los códigos enteros
+    estado_bucket = np.select(
+        [(estado == '✅ Completado').to_numpy(), (estado == '❌ Cancelado').to_numpy(), (estado == '🟡 En Proceso').to_numpy()],
+        ['completado', 'cancelado', 'en_proceso'],
+        default='pendiente'
+    )
+    fecha_entrega = df['Fecha_Entrega_dt']
+    dias = fecha_entrega.dt.normalize()
+    today_ts = pd.Timestamp(today)
+    fecha_bucket = np.select(
+        [fecha_entrega.isna().to_numpy(), (dias < today_ts).to_numpy(), (dias == today_ts).to_numpy(),
+         (dias == today_ts + pd.Timedelta(days=1)).to_numpy()],
+        ['sin_fecha', 'pasado', 'hoy', 'manana'],
+        default='futuro'
+    )
+    turno = df['Turno'].to_numpy(dtype=object)
+    turno[turno == ''] = 'N/A'
+
+    # Orden de presentación global: por tipo de envío y luego por fecha de entrega
+    sort_keys = pd.DataFrame({
+        'tipo': df['Tipo_Envio_Orden'].to_numpy(),
+        'fecha': fecha_entrega.to_numpy(),
+    })
+    display_order = sort_keys.sort_values(['tipo', 'fecha'], kind='stable').index.to_numpy()
+    rank = np.empty(len(df), dtype=np.int64)
+    rank[display_order] = np.arange(len(df))
+
+    keys = pd.DataFrame({
+        'estado': estado_bucket[display_order],
+        'fecha': fecha_bucket[display_order],
+        'tipo': df['Tipo_Envio'].to_numpy(dtype=object)[display_order],
+        'turno': turno[display_order],
+    })
+    partitions['groups'] = {
+        key: display_order[indices]
+        for key, indices in keys.groupby(['estado', 'fecha', 'tipo', 'turno'], sort=False).indices.items()
+    }
+    partitions['rank'] = rank
+    return partitions
+
+def partition_counts(partitions):
+    """Cantidad de pedidos de cada grupo del índice de particiones (de ella salen los conteos de las pestañas)."""
+    return {key: len(positions) for key, positions in partitions['groups'].items()}
+
+def _ensure_order_partitions(cache):
+    """Retorna el índice de particiones de la copia en caché, recalculándolo solo si cambió. Requiere cache['lock']."""
+    today = datetime.now().date()
+    partitions = cache['partitions']
+    if (
+        partitions is None
+        or partitions['generation'] != cache['partition_generation']
+        or partitions['date'] != today
+    ):
+        partitions = build_order_partitions(cache['df'], today)
+        partitions['generation'] = cache['partition_generation']
+        cache['partitions'] = partitions
+    return partitions
+
+def get_order_partitions(sheet_id, worksheet_name, df):
+    """Retorna el índice de particiones correspondiente al DataFrame `df` devuelto por load_data_from_gsheets."""
+    cache = get_sheet_snapshot_cache(sheet_id, worksheet_name)
+    with cache['lock']:
+        if cache['df'] is df:
+            return _ensure_order_partitions(cache)
+    # La copia en caché se reemplazó entre llamadas; el índice se calcula solo para esta ejecución
+    return build_order_partitions(df)
+
+def _matching_groups(partitions, estados=None, fechas=None, tipo_envio=None, turno=None):
+    return [
+        positions
+        for (estado, fecha, tipo, turno_key), positions in partitions['groups'].items()
+        if (estados is None or estado in estados)
+        and (fechas is None or fecha in fechas)
+        and (tipo_envio is None or tipo == tipo_envio)
+        and (turno is None or turno_key == turno)
+    ]
+
+def select_order_positions(partitions, estados=None, fechas=None, tipo_envio=None, turno=None):
+    """Posiciones (en orden de presentación) de los pedidos que cumplen los filtros; None = sin filtro."""
+    groups = _matching_groups(partitions, estados, fechas, tipo_envio, turno)
+    if not groups:
+        return np.empty(0, dtype=np.int64)
+    if len(groups) == 1:
+        return groups[0]
+    positions = np.concatenate(groups)
+    return positions[np.argsort(partitions['rank'][positions], kind='stable')]
+
+def count_orders(partitions, estados=None, fechas=None, tipo_envio=None, turno=None):
+    """Número de pedidos que cumplen los filtros, sin materializar sus posiciones."""
+    return sum(len(positions) for positions in _matching_groups(partitions, estados, fechas, tipo_envio, turno))
+
+# --- Order Search Index ---
+SEARCH_COLUMNS = ('ID_Pedido', 'Folio_Factura', 'Cliente', 'Notas', 'Comentario')
+_SEARCH_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def normalize_search_text(text):
+    """Texto en minúsculas y sin acentos (NFKD), para comparar sin distinguir mayúsculas ni acentos."""
+    return unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii').lower()
+
+def search_tokens(text):
+    """Palabras (letras y números) del texto normalizado."""
+    return set(_SEARCH_TOKEN_RE.findall(normalize_search_text(text)))
+
+def _empty_search_index():
+    return {
+        'lock': threading.Lock(),
+        'generation': -1,  # Generación de la copia reflejada en el índice
+        'postings': {},    # palabra -> IDs de los pedidos que la contienen
+        'tokens': [],      # Palabras ordenadas, para buscar por prefijo con bisect
+        'doc_tokens': {},  # ID_Pedido -> palabras del pedido
+        'doc_text': {},    # ID_Pedido -> texto indexado (para detectar cambios tras una recarga completa)
+        'positions': {},   # ID_Pedido -> posición en `df`
+        'df': None,        # DataFrame al que corresponden las posiciones
+    }
+
+def _search_documents(df):
+    """Texto indexable (SEARCH_COLUMNS unidas) de cada fila, por ID_Pedido."""
+    text = df[SEARCH_COLUMNS[0]].astype(str)
+    for col in SEARCH_COLUMNS[1:]:
+        text = text + ' ' + df[col].astype(str)
+    return dict(zip(df['ID_Pedido'], text))
+
+SEARCH_BULK_REINDEX_DOCS = 1000 # A partir de aquí se reordena la lista de palabras una vez al final
+
+def _index_search_document(index, id_pedido, text, keep_sorted=True):
+    """
+    Actualiza las palabras de un pedido en el índice (text=None lo elimina). Con keep_sorted=False
+    no mantiene index['tokens'], que debe reconstruirse al terminar.
+    """
+    postings, tokens = index['postings'], index['tokens']
+    old_tokens = index['doc_tokens'].pop(id_pedido, set())
+    index['doc_text'].pop(id_pedido, None)
+    new_tokens = search_tokens(text) if text is not None else set()
+    for token in old_tokens - new_tokens:
+        postings[token].discard(id_pedido)
+        if not postings[token]:
+            del postings[token]
+            if keep_sorted:
+                del tokens[bisect_left(tokens, token)]
+    for token in new_tokens - old_tokens:
+        if token not in postings:
+            postings[token] = set()
+            if keep_sorted:
+                tokens.insert(bisect_left(tokens, token), token)
+        postings[token].add(id_pedido)
+    if text is not None:
+        index['doc_tokens'][id_pedido] = new_tokens
+        index['doc_text'][id_pedido] = text
+
+def update_search_index(cache, rebuild=True):
+    """
+    Pone el índice de búsqueda al día con la copia en caché. Solo vuelve a indexar los pedidos del
+    registro de cambios; tras una recarga completa compara el texto de cada pedido y reindexa los distintos.
+    Con rebuild=False (desde una búsqueda) esa comparación completa no se hace si ya hay un índice:
+    la hace el hilo de actualización justo después de sincronizar, y mientras tanto se usa el anterior.
+    """
+    index = cache['search']
+    with index['lock']:
+        with cache['lock']:
+            generation = cache['generation']
+            if index['generation'] == generation or cache['df'] is None:
+                return index
+            changed = snapshot_changes_since(cache, index['generation']) if index['generation'] >= 0 else None
+            if changed is None and not rebuild and index['generation'] >= 0:
+                return index
+            df = cache['df']
+        # La copia no se modifica en su lugar (copy-on-write), así que se lee sin cache['lock']
+        # y la tokenización no detiene lecturas ni escrituras
+        if changed is None:
+            docs = _search_documents(df)
+            removed = set(index['doc_text']) - set(docs)
+            index['positions'] = dict(zip(df['ID_Pedido'], df.index))
+        else:
+            changed_rows = df[df['ID_Pedido'].isin(changed)]
+            docs = _search_documents(changed_rows)
+            removed = changed - set(docs)
+            for id_pedido in removed:
+                index['positions'].pop(id_pedido, None)
+            index['positions'].update(zip(changed_rows['ID_Pedido'], changed_rows.index))
+        index['df'] = df
+        outdated = [(id_pedido, text) for id_pedido, text in docs.items() if index['doc_text'].get(id_pedido) != text]
+        keep_sorted = len(outdated) + len(removed) < SEARCH_BULK_REINDEX_DOCS
+        for id_pedido in removed:
+            _index_search_document(index, id_pedido, None, keep_sorted)
+        for id_pedido, text in outdated:
+            _index_search_document(index, id_pedido, text, keep_sorted)
+        if not keep_sorted:
+            index['tokens'] = sorted(index['postings'])
+        index['generation'] = generation
+    return index
+
+def _search_token_ids(index, prefix):
+    """IDs de los pedidos con alguna palabra que empieza con `prefix`."""
+    tokens = index['tokens']
+    position = bisect_left(tokens, prefix)
+    matches = []
+    while position < len(tokens) and tokens[position].startswith(prefix):
+        matches.append(index['postings'][tokens[position]])
+        position += 1
+    if len(matches) == 1:
+        return matches[0]
+    return set().union(*matches)
+
+@trace_span('busqueda')
+def search_orders(sheet_id, worksheet_name, df, query):
+    """
+    Posiciones en `df` de los pedidos que contienen todas las palabras de `query` (cada una como
+    prefijo, sin distinguir mayúsculas ni acentos), de la más reciente a la más antigua.
+    """
+    query_tokens = search_tokens(query)
+    if not query_tokens:
+        return np.empty(0, dtype=np.int64)
+    # Si el hilo de actualización está construyendo el índice, se espera a que termine (ver index['lock'])
+    index = update_search_index(get_sheet_snapshot_cache(sheet_id, worksheet_name), rebuild=False)
+    with index['lock']:
+        # Se intersecta empezando por el conjunto más pequeño para no copiar los grandes
+        matches = sorted((_search_token_ids(index, token) for token in query_tokens), key=len)
+        ids = set(matches[0])
+        for token_ids in matches[1:]:
+            if not ids:
+                break
+            ids &= token_ids
+        if index['df'] is df:
+            positions = np.fromiter((index['positions'][id_pedido] for id_pedido in ids), dtype=np.int64, count=len(ids))
+            return np.sort(positions)[::-1]
+    # `df` es de otra generación que el índice: ubicar los pedidos por ID
+    return np.flatnonzero(df['ID_Pedido'].isin(ids))[::-1]
 
 # --- Data Saving/Updating to Google Sheets ---
-def update_gsheet_cell(worksheet, headers, row_index, col_name, value):
+def _version_stamp():
+    """Valor de GSHEET_VERSION_COLUMN para una fila que se acaba de escribir."""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def invalidate_sheet_snapshot(sheet_id, worksheet_name):
+    """
+    Marca la copia en caché como no confiable y despierta al hilo de actualización para que la
+    recargue completa. Las sesiones siguen viendo la copia actual hasta que llegue la nueva.
+    """
+    request_snapshot_refresh(sheet_id, worksheet_name, full=True)
+
+def _normalize_cell_value(col_name, value):
+    """Aplica a un valor escrito la misma normalización que build_orders_dataframe."""
+    if col_name in DATETIME_COLUMN_FORMATS:
+        return parse_datetime_column([value], DATETIME_COLUMN_FORMATS[col_name]).iloc[0]
+    if col_name == 'Fecha_Entrega' or col_name == 'ID_Pedido' or col_name in CATEGORICAL_COLUMNS:
+        return str(value).strip() if pd.notna(value) else ''
+    return value
+
+def _derived_cell_values(col_name, value):
+    """Columnas precalculadas que dependen de la celda escrita, con su nuevo valor."""
+    if col_name == 'Fecha_Entrega':
+        return {'Fecha_Entrega_dt': parse_datetime_column([value], FECHA_ENTREGA_FORMAT).iloc[0]}
+    if col_name == 'Tipo_Envio':
+        return {'Tipo_Envio_Orden': tipo_envio_orden(value)}
+    return {}
+
+def _apply_cells_to_snapshot(cache, cell_updates):
+    """
+    Escribe las celdas indicadas en la copia en caché. Debe llamarse con cache['lock'] tomado.
+    Copy-on-write: las columnas que cambian se copian y se publica un DataFrame nuevo en cache['df'];
+    el anterior no se modifica, porque otras sesiones pueden estar recorriéndolo sin el lock.
+    Retorna False si alguna fila no corresponde con la copia en caché.
+    """
+    df = cache['df']
+    headers = cache['headers']
+    if df is None or df.empty:
+        return True
+    changed_ids = set()
+    patched = {} # Columna -> copia con los valores nuevos
+    applied = True
+    for (row_index, col_index), value in cell_updates:
+        pos = row_index - 2 # La primera fila de datos es la fila 2 de la hoja
+        if (
+            col_index > len(headers)
+            or pos not in df.index
+            or df.at[pos, '_gsheet_row_index'] != row_index
+        ):
+            applied = False
+            break
+        changed_ids.add(cache['ids'][pos])
+        col_name = headers[col_index - 1]
+        cache['generation'] += 1
+        if col_name in DETAIL_COLUMNS:
+            # No está en la copia: solo se actualiza si el pedido está en la caché de detalles
+            details = cache['details'].get(cache['ids'][pos])
+            if details is not None:
+                details[1][col_name] = value
+            continue
+        value = _normalize_cell_value(col_name, value)
+        for target_col, target_value in {col_name: value, **_derived_cell_values(col_name, value)}.items():
+            if target_col not in patched:
+                patched[target_col] = df[target_col].copy()
+            column = patched[target_col]
+            if target_col in CATEGORICAL_COLUMNS and target_value not in column.cat.categories:
+                column = patched[target_col] = column.cat.add_categories([target_value])
+            column.at[pos] = target_value
+        if col_name in PARTITION_COLUMNS:
+            cache['partition_generation'] += 1
+        if col_name == 'ID_Pedido':
+            cache['rows_by_id'].pop(cache['ids'][pos], None)
+            cache['ids'][pos] = str(value).strip()
+            cache['rows_by_id'][cache['ids'][pos]] = row_index
+            changed_ids.add(cache['ids'][pos])
+    if patched:
+        df = df.copy(deep=False) # Comparte con la copia anterior las columnas que no cambiaron
+        for col, column in patched.items():
+            df[col] = column
+        cache['df'] = df
+    if changed_ids:
+        _log_snapshot_change(cache, changed_ids, (set(), changed_ids, set()))
+    return applied
+
+def patch_snapshot_cells(worksheet, cell_updates):
+    """
+    Aplica en el DataFrame en caché las celdas que se acaban de escribir en Google Sheets
+    (write-through), sin descartar la caché.
+    cell_updates: Lista de tuplas (row_index, col_index) en base 1 de gspread con su valor: [((2, 5), 'valor'), ...]
+    Si alguna fila no corresponde con la copia en caché, se invalida la copia para recargarla.
+    """
+    cache = get_sheet_snapshot_cache(worksheet.spreadsheet.id, worksheet.title)
+    with cache['lock']:
+        if not _apply_cells_to_snapshot(cache, cell_updates):
+            invalidate_sheet_snapshot(worksheet.spreadsheet.id, worksheet.title)
+
+# --- Write-behind Queue for Google Sheets ---
+GSHEET_WRITE_FLUSH_SECONDS = 2.0 # Ventana para agrupar las escrituras de todas las sesiones en una sola solicitud
+GSHEET_WRITE_MAX_RETRIES = 6
+GSHEET_WRITE_BACKOFF_BASE_SECONDS = 1.0
+GSHEET_WRITE_BACKOFF_MAX_SECONDS = 64.0
+GSHEET_WRITE_STATUS_TTL_SECONDS = 120 # Tiempo durante el que se muestra "guardado" en un pedido
+GSHEET_WRITE_RECENT_SECONDS = 600 # Tiempo durante el que se recuerdan las escrituras confirmadas (más que la sincronización más lenta)
+
+@st.cache_resource
+def get_gsheet_write_queue():
+    """
+    Cola de escrituras compartida por todas las sesiones del proceso. Un hilo en segundo plano
+    agrupa las celdas pendientes (la última escritura de cada celda gana) y las envía en un
+    solo values_batch_update por ventana de GSHEET_WRITE_FLUSH_SECONDS.
+    """
+    queue = {
+        'cond': threading.Condition(),
+        'flush_lock': threading.Lock(),
+        'pending': {},  # (spreadsheet_id, worksheet_title, rango A1) -> entrada
+        'inflight': {}, # Entradas que se están enviando en este momento
+        'recent': [],   # Entradas confirmadas hace menos de GSHEET_WRITE_RECENT_SECONDS, con su 'committed_at'
+        'status': {},   # ID_Pedido -> {'committed_at': timestamp, 'error': mensaje o None}
+        'pending_ids': {}, # ID_Pedido -> entradas en 'pending' o 'inflight' (ver _put_pending_write)
+        'attempt': 0,
+    }
+    threading.Thread(
+        target=_gsheet_write_worker, args=(queue,), name="gsheet-write-behind", daemon=True
+    ).start()
+    # Enviar lo pendiente al apagar el proceso
+    atexit.register(flush_gsheet_write_queue, queue)
+    return queue
+
+def _snapshot_id_for_row(worksheet, row_index):
+    """Retorna el ID_Pedido que la copia en caché tiene en la fila indicada (o None)."""
+    cache = get_sheet_snapshot_cache(worksheet.spreadsheet.id, worksheet.title)
+    pos = row_index - 2
+    if 0 <= pos < len(cache['ids']):
+        return cache['ids'][pos]
+    return None
+
+def _count_pending_write(queue, entry, delta):
+    """Suma `delta` a las entradas pendientes del pedido de `entry` en queue['pending_ids']. Requiere queue['cond']."""
+    id_pedido = entry['id_pedido']
+    if not id_pedido:
+        return
+    count = queue['pending_ids'].get(id_pedido, 0) + delta
+    if count > 0:
+        queue['pending_ids'][id_pedido] = count
+    else:
+        queue['pending_ids'].pop(id_pedido, None)
+
+def _put_pending_write(queue, key, entry, replace=True):
+    """
+    Pone `entry` en queue['pending'] y lleva la cuenta de queue['pending_ids']. Sin `replace`
+    (reintentos) no pisa una escritura más reciente de la misma celda. Requiere queue['cond'].
+    """
+    previous = queue['pending'].get(key)
+    if previous is not None:
+        if not replace:
+            return
+        _count_pending_write(queue, previous, -1)
+    queue['pending'][key] = entry
+    _count_pending_write(queue, entry, 1)
+
+def enqueue_gsheet_writes(worksheet, updates_list, value_input_option, id_pedido=None):
+    """
+    Añade celdas a la cola de escritura diferida.
+    updates_list: Mismo formato que batch_update_gsheet_cells: [{'range': 'A1', 'values': [['valor']]}, ...]
+    id_pedido: Pedido al que pertenecen las celdas (o el 'id_pedido' de cada elemento); si se omite
+    se toma de la copia en caché. Antes de
+    escribir se verifica que la fila siga teniendo ese ID (ver _verify_write_targets).
+    Si la hoja tiene GSHEET_VERSION_COLUMN, también se marca en cada fila escrita para que las
+    sincronizaciones parciales (de esta y otras instancias de la app) vean el cambio.
+    """
+    headers = get_sheet_snapshot_cache(worksheet.spreadsheet.id, worksheet.title)['headers']
+    version_col = headers.index(GSHEET_VERSION_COLUMN) + 1 if GSHEET_VERSION_COLUMN in headers else None
+    stamp = _version_stamp()
+    queue = get_gsheet_write_queue()
+    with queue['cond']:
+        stamped_rows = {}
+        for update_item in updates_list:
+            row, _ = gspread.utils.a1_to_rowcol(update_item['range'])
+            key = (worksheet.spreadsheet.id, worksheet.title, update_item['range'])
+            row_id = update_item.get('id_pedido') or id_pedido or _snapshot_id_for_row(worksheet, row)
+            _put_pending_write(queue, key, {
+                'worksheet': worksheet,
+                'range': update_item['range'],
+                'value': update_item['values'][0][0],
+                'value_input_option': value_input_option,
+                'id_pedido': row_id,
+            })
+            if version_col:
+                stamped_rows[row] = row_id
+        for row, row_id in stamped_rows.items():
+            cell = gspread.utils.rowcol_to_a1(row, version_col)
+            _put_pending_write(queue, (worksheet.spreadsheet.id, worksheet.title, cell), {
+                'worksheet': worksheet,
+                'range': cell,
+                'value': stamp,
+                'value_input_option': value_input_option,
+                'id_pedido': row_id,
+            })
+        queue['cond'].notify()
+
+def _gsheet_write_worker(queue):
+    """Hilo que envía la cola de escrituras cada GSHEET_WRITE_FLUSH_SECONDS."""
+    while True:
+        with queue['cond']:
+            while not queue['pending']:
+                queue['cond'].wait()
+        time.sleep(GSHEET_WRITE_FLUSH_SECONDS) # Ventana de agrupación
+        delay = flush_gsheet_write_queue(queue)
+        if delay:
+            time.sleep(delay)
+
+def _is_retryable_gsheet_error(e):
+    """True para errores de cuota (429) o temporales (5xx) de la API de Google Sheets."""
+    if isinstance(e, gspread.exceptions.APIError):
+        status_code = getattr(e.response, 'status_code', None)
+        return status_code == 429 or (status_code is not None and status_code >= 500)
+    return False
+
+def _moved_write_targets(spreadsheet, entries):
+    """
+    Lee en una sola solicitud el ID_Pedido de cada fila destino de `entries` y retorna
+    (filas (hoja, fila) que ya no tienen el ID con el que se encolaron, hoja -> letra de la columna ID_Pedido).
+    """
+    id_columns = {} # Hoja -> letra de la columna ID_Pedido
+    checks = {}     # (hoja, fila) -> ID_Pedido esperado
+    for entry in entries:
+        title = entry['worksheet'].title
+        if title not in id_columns:
+            headers = get_sheet_snapshot_cache(spreadsheet.id, title)['headers']
+            id_columns[title] = _column_letter(headers.index('ID_Pedido') + 1) if 'ID_Pedido' in headers else None
+        if entry['id_pedido'] and id_columns[title]:
+            row, _ = gspread.utils.a1_to_rowcol(entry['range'])
+            checks[(title, row)] = entry['id_pedido']
+    if not checks:
+        return set(), id_columns
+
+    keys = list(checks)
+    response = spreadsheet.values_batch_get([
+        gspread.utils.absolute_range_name(title, f"{id_columns[title]}{row}") for title, row in keys
+    ])
+    moved_keys = {
+        key for key, value_range in zip(keys, response.get('valueRanges', []))
+        if _key_column_values(value_range.get('values', []), 1)[0] != checks[key]
+    }
+    return moved_keys, id_columns
+
+def _verify_write_targets(spreadsheet, entries):
+    """
+    Concurrencia optimista: antes de escribir, confirma con una sola lectura que cada fila destino
+    sigue teniendo el ID_Pedido con el que se encoló la escritura. Si otra aplicación insertó o
+    eliminó filas, las escrituras afectadas se reubican con la columna ID_Pedido de la hoja (una
+    lectura más) y se pide a la copia en caché que se ponga al día; las de pedidos que ya no están
+    en la hoja, o cuyo ID aparece repetido, se descartan.
+    La API de Sheets no tiene escrituras condicionales: la lectura y la escritura son solicitudes
+    distintas, así que después de escribir se vuelve a comprobar (ver _misplaced_writes).
+    Retorna (entradas a escribir, entradas descartadas).
+    """
+    moved_keys, id_columns = _moved_write_targets(spreadsheet, entries)
+    if not moved_keys:
+        return entries, []
+
+    moved_titles = sorted({title for title, _ in moved_keys})
+    response = spreadsheet.values_batch_get([
+        gspread.utils.absolute_range_name(title, f"{id_columns[title]}2:{id_columns[title]}") for title in moved_titles
+    ])
+    locators = {
+        title: _build_row_locator(_key_column_values(value_range.get('values', []), 0))
+        for title, value_range in zip(moved_titles, response.get('valueRanges', []))
+    }
+    verified, discarded = [], []
+    for entry in entries:
+        title = entry['worksheet'].title
+        row, col = gspread.utils.a1_to_rowcol(entry['range'])
+        if (title, row) not in moved_keys:
+            verified.append(entry)
+            continue
+        new_row = locators[title].get(entry['id_pedido'])
+        if new_row is None:
+            discarded.append(entry)
+        else:
+            verified.append(dict(entry, range=gspread.utils.rowcol_to_a1(new_row, col)))
+    # Las filas de la copia en caché también se movieron: la siguiente sincronización las reubica
+    for title in moved_titles:
+        request_snapshot_refresh(spreadsheet.id, title)
+    return verified, discarded
+
+def _misplaced_writes(spreadsheet, entries):
+    """
+    Comprobación posterior a la escritura: si otra aplicación movió filas entre _verify_write_targets
+    y values_batch_update, algunas celdas cayeron en otro pedido. Esas entradas se vuelven a encolar
+    (el siguiente envío las reubica) y se pide a la copia en caché que se ponga al día, porque la fila
+    equivocada también cambió en la hoja.
+    Retorna (entradas confirmadas, entradas que cayeron en otra fila).
+    """
+    moved_keys, _ = _moved_write_targets(spreadsheet, entries)
+    if not moved_keys:
+        return entries, []
+    for title in sorted({title for title, _ in moved_keys}):
+        request_snapshot_refresh(spreadsheet.id, title)
+    confirmed, misplaced = [], []
+    for entry in entries:
+        row, _ = gspread.utils.a1_to_rowcol(entry['range'])
+        (misplaced if (entry['worksheet'].title, row) in moved_keys else confirmed).append(entry)
+    return confirmed, misplaced
+
+def flush_gsheet_write_queue(queue):
+    """
+    Envía todas las escrituras pendientes: una solicitud values_batch_update por hoja de cálculo
+    y opción de entrada de valores.
+    Retorna los segundos de espera antes del siguiente intento si la API rechazó la solicitud
+    por cuota, o 0.
+    """
+    with queue['flush_lock']:
+        return _flush_pending_gsheet_writes(queue)
+
+def _flush_pending_gsheet_writes(queue):
+    """Cuerpo de flush_gsheet_write_queue. Debe llamarse con queue['flush_lock'] tomado."""
+    with queue['cond']:
+        batch = queue['pending']
+        queue['pending'] = {}
+        queue['inflight'] = batch
+    if not batch:
+        return 0
+
+    groups = {}
+    for key, entry in batch.items():
+        group_key = (key[0], entry['value_input_option'])
+        groups.setdefault(group_key, []).append(entry)
+
+    failed = {}
+    committed = []
+    discarded = []
+    misplaced = []
+    retry = False
+    error_message = None
+    for (_, value_input_option), entries in groups.items():
+        spreadsheet = entries[0]['worksheet'].spreadsheet
+        try:
+            entries, lost = _verify_write_targets(spreadsheet, entries)
+        except Exception as e:
+            retry = retry or _is_retryable_gsheet_error(e)
+            error_message = str(e)
+            for entry in entries:
+                failed[(spreadsheet.id, entry['worksheet'].title, entry['range'])] = entry
+            continue
+        discarded += lost
+        if not entries:
+            continue
+        body = {
+            'valueInputOption': value_input_option,
+            'data': [
+                {
+                    'range': gspread.utils.absolute_range_name(entry['worksheet'].title, entry['range']),
+                    'values': [[entry['value']]],
+                }
+                for entry in entries
+            ],
+        }
+        try:
+            spreadsheet.values_batch_update(body=body)
+        except Exception as e:
+            retry = retry or _is_retryable_gsheet_error(e)
+            error_message = str(e)
+            for entry in entries:
+                failed[(spreadsheet.id, entry['worksheet'].title, entry['range'])] = entry
+            continue
+        try:
+            entries, lost = _misplaced_writes(spreadsheet, entries)
+        except Exception:
+            lost = [] # La escritura ya se hizo; sin la comprobación se da por confirmada
+        committed += entries
+        misplaced += lost
+
+    now = time.time()
+    with queue['cond']:
+        # Todo el lote termina aquí; lo que se vuelve a encolar se cuenta de nuevo
+        for entry in batch.values():
+            _count_pending_write(queue, entry, -1)
+        queue['inflight'] = {}
+        queue['recent'] = [entry for entry in queue['recent'] if now - entry['committed_at'] < GSHEET_WRITE_RECENT_SECONDS]
+        for entry in committed:
+            queue['recent'].append({**entry, 'committed_at': now})
+            if entry['id_pedido']:
+                queue['status'][entry['id_pedido']] = {'committed_at': now, 'error': None}
+        for entry in discarded:
+            queue['status'][entry['id_pedido']] = {
+                'committed_at': None, 'error': "El pedido ya no está en la hoja (otra aplicación lo movió o eliminó)."
+            }
+        for entry in misplaced:
+            # Sin pisar escrituras más recientes de la misma celda
+            _put_pending_write(queue, (entry['worksheet'].spreadsheet.id, entry['worksheet'].title, entry['range']), entry, replace=False)
+
+        if not failed:
+            queue['attempt'] = 0
+            return 0
+
+        if retry and queue['attempt'] < GSHEET_WRITE_MAX_RETRIES:
+            # Reintentar con backoff exponencial sin pisar escrituras más recientes de la misma celda
+            for key, entry in failed.items():
+                _put_pending_write(queue, key, entry, replace=False)
+            queue['attempt'] += 1
+            delay = min(GSHEET_WRITE_BACKOFF_BASE_SECONDS * 2 ** (queue['attempt'] - 1), GSHEET_WRITE_BACKOFF_MAX_SECONDS)
+            return delay + random.uniform(0, 1)
+
+        queue['attempt'] = 0
+        for entry in failed.values():
+            if entry['id_pedido']:
+                queue['status'][entry['id_pedido']] = {'committed_at': None, 'error': error_message}
+    # Los valores ya se aplicaron a la copia en caché; al fallar hay que recargarla desde la hoja
+    for sheet_id, worksheet_name in {(key[0], key[1]) for key in failed}:
+        invalidate_sheet_snapshot(sheet_id, worksheet_name)
+    return 0
+
+def get_gsheet_write_status(id_pedido):
+    """
+    Retorna el estado de guardado de un pedido: ('pending', None), ('committed', None),
+    ('error', mensaje) o (None, None) si no hay escrituras recientes.
+    """
+    queue = get_gsheet_write_queue()
+    with queue['cond']:
+        if id_pedido in queue['pending_ids']:
+            return 'pending', None
+        status = queue['status'].get(id_pedido)
+    if not status:
+        return None, None
+    if status['error']:
+        return 'error', status['error']
+    if time.time() - status['committed_at'] < GSHEET_WRITE_STATUS_TTL_SECONDS:
+        return 'committed', None
+    return None, None
+
+def _pending_write_entries(sheet_id, worksheet_name, since=None):
+    """
+    Escrituras de la hoja que aún no se confirman (primero las que se están enviando). Con `since`,
+    también las confirmadas desde ese momento, antes que las demás: una lectura de la hoja que empezó
+    en `since` puede no incluirlas.
+    """
+    queue = get_gsheet_write_queue()
+    with queue['cond']:
+        entries = list(queue['inflight'].values()) + list(queue['pending'].values())
+        if since is not None:
+            entries = [entry for entry in queue['recent'] if entry['committed_at'] >= since] + entries
+    return [
+        entry for entry in entries
+        if entry['worksheet'].spreadsheet.id == sheet_id and entry['worksheet'].title == worksheet_name
+    ]
+
+def _pending_detail_writes(cache, sheet_id, worksheet_name, headers):
+    """Valores de DETAIL_COLUMNS aún sin confirmar en la hoja: {ID_Pedido: {columna: valor}}."""
+    pending = {}
+    for entry in _pending_write_entries(sheet_id, worksheet_name):
+        row, col = gspread.utils.a1_to_rowcol(entry['range'])
+        if col > len(headers) or headers[col - 1] not in DETAIL_COLUMNS:
+            continue
+        id_pedido = entry['id_pedido'] or (cache['ids'][row - 2] if 0 <= row - 2 < len(cache['ids']) else None)
+        if id_pedido:
+            pending.setdefault(id_pedido, {})[headers[col - 1]] = entry['value']
+    return pending
+
+def _overlay_pending_writes(cache, sheet_id, worksheet_name, read_started):
+    """
+    Vuelve a aplicar sobre una copia recién sincronizada las escrituras que aún no se envían y las
+    confirmadas después de `read_started` (cuando empezó la lectura de la hoja), para que la recarga
+    no muestre valores anteriores. Debe llamarse con cache['lock'] tomado.
     """
-    Actualiza una celda específica en Google Sheets.
+    cell_updates = []
+    for entry in _pending_write_entries(sheet_id, worksheet_name, since=read_started):
+        row, col = gspread.utils.a1_to_rowcol(entry['range'])
+        if entry['id_pedido']:
+            # La copia nueva puede tener el pedido en otra fila
+            row = cache['rows_by_id'].get(entry['id_pedido'])
+            if row is None:
+                continue
+        cell_updates.append(((row, col), entry['value']))
+    if cell_updates:
+        _apply_cells_to_snapshot(cache, cell_updates)
+
+def update_gsheet_cell(worksheet, headers, row_index, col_name, value, id_pedido=None):
+    """
+    Actualiza una celda específica en Google Sheets a través de la cola de escritura diferida.
     `row_index` es el índice de fila de gspread (base 1).
     `col_name` es el nombre de la columna.
     `headers` es la lista de encabezados obtenida previamente.
+    `id_pedido` (recomendado): la fila se ubica por el ID del pedido en lugar de confiar en `row_index`,
+    que puede venir de una copia anterior de la hoja.
     """
     try:
+        if worksheet is None:
+            worksheet = get_snapshot_worksheet(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+        if id_pedido:
+            row_index = locate_order_row(worksheet.spreadsheet.id, worksheet.title, id_pedido) or row_index
         if col_name not in headers:
             st.error(f"❌ Error: La columna '{col_name}' no se encontró en Google Sheets para la actualización. Verifica los encabezados.")
             return False
         col_index = headers.index(col_name) + 1 # Convertir a índice base 1 de gspread
-        worksheet.update_cell(row_index, col_index, value)
-        # Invalida la caché de recursos para que la próxima carga sea fresca
-        st.cache_resource.clear() 
+        range_str = gspread.utils.rowcol_to_a1(row_index, col_index)
+        # Misma opción de entrada que worksheet.update_cell()
+        enqueue_gsheet_writes(worksheet, [{'range': range_str, 'values': [[value]]}], 'USER_ENTERED', id_pedido)
+        # Refleja el cambio en la copia en caché en lugar de invalidarla
+        patch_snapshot_cells(worksheet, [((row_index, col_index), value)])
         return True
     except Exception as e:
         st.error(f"❌ Error al actualizar la celda ({row_index}, {col_name}) en Google Sheets: {e}")
         return False
 
-def batch_update_gsheet_cells(worksheet, updates_list):
+def batch_update_gsheet_cells(worksheet, updates_list, id_pedido=None):
     """
-    Realiza múltiples actualizaciones de celdas en una sola solicitud por lotes a Google Sheets utilizando worksheet.update_cells().
+    Realiza múltiples actualizaciones de celdas a través de la cola de escritura diferida, que las
+    envía junto con las de otras sesiones en una sola solicitud por lotes a Google Sheets.
     updates_list: Lista de diccionarios, cada uno con las claves 'range' y 'values'. Ej: [{'range': 'A1', 'values': [['nuevo_valor']]}, ...]
+    id_pedido (recomendado): Pedido al que pertenecen todas las celdas; sus filas se ubican por el ID
+    (ver update_gsheet_cell). Para celdas de varios pedidos, cada elemento puede traer su 'id_pedido'.
     """
     try:
         if not updates_list:
             return False
-        cell_list = []
+        if worksheet is None:
+            worksheet = get_snapshot_worksheet(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+        cell_updates = []
+        cell_ids = []
         for update_item in updates_list:
             range_str = update_item['range']
             value = update_item['values'][0][0] # Asumiendo un único valor como [['valor']]
             # Convertir la notación A1 (ej. 'A1') a índice de fila y columna (base 1)
             row, col = gspread.utils.a1_to_rowcol(range_str)
-            # Crear un objeto Cell y añadirlo a la lista
-            cell_list.append(gspread.Cell(row=row, col=col, value=value))
-        
-        if cell_list:
-            worksheet.update_cells(cell_list)
-            st.cache_resource.clear() # Limpiar la caché después de una actualización
-            return True
-        return False
+            item_id = update_item.get('id_pedido') or id_pedido
+            if item_id:
+                row = locate_order_row(worksheet.spreadsheet.id, worksheet.title, item_id) or row
+            cell_updates.append(((row, col), value))
+            cell_ids.append(item_id)
+        updates_list = [
+            {'range': gspread.utils.rowcol_to_a1(*cell), 'values': [[value]], 'id_pedido': item_id}
+            for (cell, value), item_id in zip(cell_updates, cell_ids)
+        ]
+
+        # Misma opción de entrada que worksheet.update_cells()
+        enqueue_gsheet_writes(worksheet, updates_list, 'RAW', id_pedido)
+        # Refleja los cambios en la copia en caché en lugar de invalidarla
+        patch_snapshot_cells(worksheet, cell_updates)
+        return True
     except Exception as e:
         st.error(f"❌ Error al realizar la actualización por lotes en Google Sheets: {e}")
         return False
 
+# --- Archive of Closed Orders ---
+ARCHIVE_WORKSHEET_NAME = 'datos_pedidos_archivo' # Pestaña con los pedidos archivados (fuente de verdad del archivo)
+ARCHIVE_AFTER_DAYS = 30 # Antigüedad (desde el cierre) a partir de la cual se archiva un pedido
+ARCHIVE_DB_PATH = os.path.join(LOCAL_CACHE_DIR, 'archivo_pedidos.sqlite') # Copia local indexada del archivo
+ARCHIVE_STORE_REFRESH_SECONDS = 15 * 60 # Cada cuánto se traen las filas que otro proceso haya archivado
+ESTADOS_CERRADOS = {'completado': '✅ Completado', 'cancelado': '❌ Cancelado'} # Estados que se archivan
+HISTORY_COLUMNS = [
+    'ID_Pedido', 'Folio_Factura', 'Cliente', 'Estado', 'Vendedor_Registro',
+    'Tipo_Envio', 'Fecha_Entrega', 'Fecha_Completado', 'Notas', 'Modificacion_Surtido',
+    'Adjuntos', 'Adjuntos_Surtido', 'Turno'
+]
+
+def fecha_cierre(df):
+    """
+    Fecha de cierre de cada pedido: Fecha_Completado o, si está vacía (p. ej. pedidos cancelados),
+    Hora_Proceso y después Hora_Registro.
+    """
+    return df['Fecha_Completado'].fillna(df['Hora_Proceso']).fillna(df['Hora_Registro'])
+
+def _open_archive_db():
+    """Abre la copia local del archivo (SQLite) creando sus tablas e índices si no existen."""
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=30)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS pedidos_archivados (
+            id_pedido TEXT PRIMARY KEY,
+            fecha_completado TEXT,   -- Fecha de cierre (ver fecha_cierre) en formato ISO
+            estado TEXT,
+            datos TEXT NOT NULL      -- Fila completa como JSON {encabezado: valor}
+        );
+        CREATE INDEX IF NOT EXISTS idx_archivados_fecha ON pedidos_archivados (fecha_completado, id_pedido);
+        CREATE TABLE IF NOT EXISTS archivo_meta (clave TEXT PRIMARY KEY, valor TEXT);
+    """)
+    return conn
+
+def _archive_meta(conn, clave, default=None):
+    row = conn.execute("SELECT valor FROM archivo_meta WHERE clave = ?", (clave,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def _set_archive_meta(conn, clave, valor):
+    conn.execute("INSERT OR REPLACE INTO archivo_meta (clave, valor) VALUES (?, ?)", (clave, json.dumps(valor)))
+
+def _store_archived_rows(conn, headers, rows):
+    """Guarda en la copia local filas crudas de la hoja de archivo (listas alineadas con `headers`)."""
+    if not rows:
+        return
+    df = build_orders_dataframe(headers, rows, range(len(rows)))
+    cierre = fecha_cierre(df)
+    conn.executemany(
+        "INSERT OR REPLACE INTO pedidos_archivados (id_pedido, fecha_completado, estado, datos) VALUES (?, ?, ?, ?)",
+        [
+            (
+                id_pedido,
+                None if pd.isna(fecha) else fecha.isoformat(sep=' '),
+                estado,
+                json.dumps(dict(zip(headers, row)), ensure_ascii=False),
+            )
+            for id_pedido, fecha, estado, row in zip(df['ID_Pedido'], cierre, df['Estado'], rows)
+        ]
+    )
+
+def refresh_archive_store(spreadsheet, force=False):
+    """
+    Trae a la copia local las filas de la hoja de archivo que aún no tiene (la hoja solo crece por
+    el final), en una sola solicitud. Se hace como mucho cada ARCHIVE_STORE_REFRESH_SECONDS.
+    """
+    with closing(_open_archive_db()) as conn, conn:
+        if not force and time.time() - _archive_meta(conn, 'last_refresh', 0) < ARCHIVE_STORE_REFRESH_SECONDS:
+            return
+        synced_rows = _archive_meta(conn, 'synced_rows', 0)
+        width = max(len(_archive_meta(conn, 'headers', [])), len(EXPECTED_COLUMNS))
+        try:
+            archive_ws = spreadsheet.worksheet(ARCHIVE_WORKSHEET_NAME)
+            header_values, new_rows = archive_ws.batch_get(
+                ['1:1', f"A{synced_rows + 2}:{_column_letter(width)}"]
+            )
+        except gspread.exceptions.WorksheetNotFound:
+            header_values, new_rows = [], []
+        headers = list(header_values[0]) if header_values else []
+        if len(headers) > width:
+            # La hoja de archivo ganó columnas: volver a leerla completa con el nuevo ancho
+            synced_rows = 0
+            new_rows = archive_ws.batch_get([f"A2:{_column_letter(len(headers))}"])[0]
+        _store_archived_rows(conn, headers, new_rows)
+        _set_archive_meta(conn, 'synced_rows', synced_rows + len(new_rows))
+        _set_archive_meta(conn, 'headers', headers)
+        _set_archive_meta(conn, 'last_refresh', time.time())
+
+def _shift_pending_writes_after_delete(queue, sheet_id, worksheet_name, deleted_rows):
+    """
+    Ajusta las escrituras pendientes de una hoja después de eliminar filas: las de filas eliminadas
+    se descartan (con error en el estado del pedido) y las demás se mueven a su nueva fila.
+    Debe llamarse con queue['flush_lock'] tomado.
+    """
+    deleted_rows = sorted(deleted_rows)
+    deleted = set(deleted_rows)
+    with queue['cond']:
+        pending = {}
+        for key, entry in queue['pending'].items():
+            if key[:2] != (sheet_id, worksheet_name):
+                pending[key] = entry
+                continue
+            row, col = gspread.utils.a1_to_rowcol(entry['range'])
+            if row in deleted:
+                _count_pending_write(queue, entry, -1)
+                if entry['id_pedido']:
+                    queue['status'][entry['id_pedido']] = {
+                        'committed_at': None, 'error': "El pedido se archivó antes de guardar el cambio."
+                    }
+                continue
+            new_range = gspread.utils.rowcol_to_a1(row - bisect_left(deleted_rows, row), col)
+            pending[(sheet_id, worksheet_name, new_range)] = dict(entry, range=new_range)
+        queue['pending'] = pending
+
+def _get_or_create_archive_worksheet(spreadsheet, headers):
+    try:
+        return spreadsheet.worksheet(ARCHIVE_WORKSHEET_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        archive_ws = spreadsheet.add_worksheet(title=ARCHIVE_WORKSHEET_NAME, rows=1, cols=len(headers))
+        archive_ws.append_rows([headers], value_input_option='RAW')
+        return archive_ws
+
+def closed_orders_to_archive(df, days=ARCHIVE_AFTER_DAYS):
+    """Pedidos Completados o Cancelados de `df` cuya fecha de cierre tiene más de `days` días."""
+    cutoff = pd.Timestamp(datetime.now() - timedelta(days=days))
+    return df[df['Estado'].isin(list(ESTADOS_CERRADOS.values())) & (fecha_cierre(df) < cutoff)]
+
+def _missing_archived_ids(conn, ids, chunk_size=500):
+    """IDs de `ids` que no están en la copia local del archivo (consultados por lotes)."""
+    ids = list(ids)
+    stored = set()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        stored.update(
+            row[0] for row in conn.execute(
+                f"SELECT id_pedido FROM pedidos_archivados WHERE id_pedido IN ({','.join('?' * len(chunk))})", chunk
+            )
+        )
+    return [id_pedido for id_pedido in ids if id_pedido not in stored]
+
+def archive_closed_orders(sheet_id, worksheet_name, days=ARCHIVE_AFTER_DAYS):
+    """
+    Mueve a la hoja de archivo (y a su copia local indexada) los pedidos Completados o Cancelados
+    cuya fecha de cierre tiene más de `days` días, y los elimina de la hoja de pedidos.
+    Pasos: envía las escrituras pendientes y bloquea la cola mientras dura el proceso; lee la hoja
+    completa; agrega al archivo las filas que aún no estén ahí y todas a su copia local; verifica que
+    cada pedido esté en la copia local y que los ID_Pedido sigan en las mismas filas, y las elimina
+    en una sola solicitud (de abajo hacia arriba); ajusta las filas de
+    las escrituras encoladas mientras tanto y pide una recarga completa de la copia.
+    Retorna el número de pedidos archivados. Los errores se propagan a quien llama.
+    """
+    queue = get_gsheet_write_queue()
+    with queue['flush_lock']:
+        # Las escrituras ya encoladas se refieren a números de fila que van a cambiar
+        _flush_pending_gsheet_writes(queue)
+        with queue['cond']:
+            if any(key[:2] == (sheet_id, worksheet_name) for key in queue['pending']):
+                raise RuntimeError("Hay cambios sin guardar en Google Sheets; intenta de nuevo en unos segundos.")
+
+        worksheet = gc.open_by_key(sheet_id).worksheet(worksheet_name)
+        all_data = worksheet.get_all_values()
+        if len(all_data) < 2:
+            return 0
+        headers, data_rows = all_data[0], all_data[1:]
+        df = build_orders_dataframe(headers, data_rows, range(2, len(data_rows) + 2))
+        candidates = closed_orders_to_archive(df, days)
+        if candidates.empty:
+            return 0
+
+        # 1. Agregar al archivo (sin duplicar pedidos de un intento anterior que no llegó a eliminarlos)
+        spreadsheet = worksheet.spreadsheet
+        archive_ws = _get_or_create_archive_worksheet(spreadsheet, headers)
+        archive_headers = list(archive_ws.batch_get(['1:1'])[0][0])
+        missing_headers = [h for h in headers if h not in archive_headers]
+        if missing_headers:
+            archive_ws.add_cols(len(missing_headers))
+            archive_headers += missing_headers
+            spreadsheet.values_batch_update(body={
+                'valueInputOption': 'RAW',
+                'data': [{'range': gspread.utils.absolute_range_name(ARCHIVE_WORKSHEET_NAME, 'A1'), 'values': [archive_headers]}],
+            })
+        archive_id_col = _column_letter(archive_headers.index('ID_Pedido') + 1)
+        archived_ids = {
+            row[0].strip() for row in archive_ws.batch_get([f"{archive_id_col}2:{archive_id_col}"])[0] if row
+        }
+        candidate_rows = [] # Filas de los candidatos alineadas con archive_headers
+        new_archive_rows = []
+        for id_pedido, row_index in zip(candidates['ID_Pedido'], candidates['_gsheet_row_index']):
+            row = dict(zip(headers, data_rows[row_index - 2]))
+            candidate_rows.append([row.get(h, '') for h in archive_headers])
+            if id_pedido not in archived_ids:
+                new_archive_rows.append(candidate_rows[-1])
+        if new_archive_rows:
+            archive_ws.append_rows(new_archive_rows, value_input_option='RAW')
+
+        # 2. Copia local indexada por fecha de cierre (también los que un intento anterior ya agregó a la hoja)
+        with closing(_open_archive_db()) as conn:
+            with conn:
+                _store_archived_rows(conn, archive_headers, candidate_rows)
+                _set_archive_meta(conn, 'last_refresh', 0) # Las filas agregadas se cuentan en la próxima lectura
+            missing_ids = _missing_archived_ids(conn, candidates['ID_Pedido'])
+        if missing_ids:
+            raise RuntimeError(
+                f"{len(missing_ids)} pedidos no quedaron en la copia local del archivo; no se eliminó ninguna fila."
+            )
+
+        # 3. Verificar que las filas no se movieron y eliminarlas de la hoja de pedidos
+        id_col = _column_letter(headers.index('ID_Pedido') + 1)
+        current_ids = _key_column_values(worksheet.batch_get([f"{id_col}2:{id_col}"])[0], len(data_rows))
+        for id_pedido, row_index in zip(candidates['ID_Pedido'], candidates['_gsheet_row_index']):
+            if current_ids[row_index - 2] != id_pedido:
+                raise RuntimeError(
+                    "La hoja de pedidos cambió durante el archivado; no se eliminó ninguna fila. "
+                    "Los pedidos ya copiados al archivo no se duplicarán al reintentar."
+                )
+        deleted_rows = sorted(candidates['_gsheet_row_index'].tolist())
+        runs = [] # Rangos contiguos [inicio, fin] de filas a eliminar
+        for row_index in deleted_rows:
+            if runs and runs[-1][1] == row_index - 1:
+                runs[-1][1] = row_index
+            else:
+                runs.append([row_index, row_index])
+        spreadsheet.batch_update({'requests': [
+            {'deleteDimension': {'range': {
+                'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': first - 1, 'endIndex': last,
+            }}}
+            for first, last in reversed(runs) # De abajo hacia arriba para no desplazar los rangos siguientes
+        ]})
+
+        _shift_pending_writes_after_delete(queue, sheet_id, worksheet_name, deleted_rows)
+    invalidate_sheet_snapshot(sheet_id, worksheet_name)
+    return len(deleted_rows)
+
+def _live_history_positions(df_main, partitions, desde, hasta, estados, tipo_envio=None):
+    """Posiciones de los pedidos cerrados de la copia viva en el rango, de la más reciente a la más antigua."""
+    positions = select_order_positions(partitions, estados=estados, tipo_envio=tipo_envio)
+    cierre = fecha_cierre(df_main).to_numpy()[positions]
+    in_range = (cierre >= np.datetime64(desde)) & (cierre < np.datetime64(hasta))
+    positions, cierre = positions[in_range], cierre[in_range]
+    # Fecha de cierre descendente y, en empates (Fecha_Completado no tiene hora), ID_Pedido descendente
+    ids = df_main['ID_Pedido'].to_numpy()[positions]
+    return positions[np.lexsort((ids, cierre))[::-1]]
+
+def _archive_history_filter(desde, hasta, estados, tipo_envio=None):
+    clauses = "fecha_completado >= ? AND fecha_completado < ? AND estado IN ({})".format(','.join('?' * len(estados)))
+    params = [pd.Timestamp(desde).isoformat(sep=' '), pd.Timestamp(hasta).isoformat(sep=' ')] + [
+        ESTADOS_CERRADOS[estado] for estado in estados
+    ]
+    if tipo_envio is not None:
+        clauses += " AND TRIM(json_extract(datos, '$.Tipo_Envio')) = ?"
+        params.append(tipo_envio)
+    return clauses, params
+
+def count_order_history(df_main, partitions, desde, hasta, estados=('completado',), tipo_envio=None):
+    """
+    Número de pedidos cerrados entre `desde` (incluido) y `hasta` (excluido), en la hoja y en el
+    archivo (solo los de `tipo_envio`, si se indica).
+    """
+    where, params = _archive_history_filter(desde, hasta, estados, tipo_envio)
+    with closing(_open_archive_db()) as conn:
+        archived = conn.execute(f"SELECT COUNT(*) FROM pedidos_archivados WHERE {where}", params).fetchone()[0]
+    return len(_live_history_positions(df_main, partitions, desde, hasta, estados, tipo_envio)) + archived
+
+def _history_cursor_key(cierre, id_pedido):
+    """Cursor de página del historial: (fecha de cierre en el formato ISO del archivo, ID_Pedido)."""
+    return pd.Timestamp(cierre).isoformat(sep=' '), id_pedido
+
+@trace_span('historial.consulta')
+def query_order_history(df_main, partitions, desde, hasta, estados=('completado',), after=None, limit=20):
+    """
+    Página del historial (pedidos de la hoja y del archivo) ordenada por fecha de cierre y ID_Pedido
+    descendentes, paginada por cursor: `after` es el cursor que retornó la página anterior (None
+    para la primera). El archivo se consulta con el índice (fecha_completado, id_pedido) desde el
+    cursor, así que cada página lee como mucho `limit` filas de cada fuente, sin importar su número.
+    Retorna (DataFrame con HISTORY_COLUMNS y la columna 'Archivado', cursor de la página siguiente
+    o None si es la última).
+    """
+    all_live_positions = _live_history_positions(df_main, partitions, desde, hasta, estados)
+    live_positions = all_live_positions
+    if after is not None:
+        after_cierre, after_id = np.datetime64(pd.Timestamp(after[0])), after[1]
+        cierre = fecha_cierre(df_main).to_numpy()[live_positions]
+        ids = df_main['ID_Pedido'].to_numpy()[live_positions]
+        live_positions = live_positions[(cierre < after_cierre) | ((cierre == after_cierre) & (ids < after_id))]
+    live_rows = df_main.iloc[live_positions[:limit]]
+    live = live_rows[[col for col in HISTORY_COLUMNS if col not in DETAIL_COLUMNS]].astype(
+        {col: object for col in CATEGORICAL_COLUMNS if col in HISTORY_COLUMNS}
+    ).assign(Archivado=False)
+    live['_cierre'] = fecha_cierre(live_rows).to_numpy()
+
+    # Un pedido copiado al archivo que aún no se elimina de la hoja se muestra una sola vez
+    live_ids = set(df_main['ID_Pedido'].to_numpy()[all_live_positions])
+    where, params = _archive_history_filter(desde, hasta, estados)
+    archived_rows = []
+    archive_after = after
+    with closing(_open_archive_db()) as conn:
+        while len(archived_rows) < limit:
+            keyset, keyset_params = "", []
+            if archive_after is not None:
+                keyset = " AND (fecha_completado < ? OR (fecha_completado = ? AND id_pedido < ?))"
+                keyset_params = [archive_after[0], archive_after[0], archive_after[1]]
+            rows = conn.execute(
+                f"SELECT fecha_completado, id_pedido, datos FROM pedidos_archivados WHERE {where}{keyset} "
+                "ORDER BY fecha_completado DESC, id_pedido DESC LIMIT ?",
+                params + keyset_params + [limit]
+            ).fetchall()
+            archived_rows += [row for row in rows if row[1] not in live_ids]
+            if len(rows) < limit:
+                break
+            archive_after = rows[-1][:2]
+    archived_rows = archived_rows[:limit]
+    archived = pd.DataFrame(
+        [json.loads(datos) for _, _, datos in archived_rows], columns=HISTORY_COLUMNS
+    ).fillna('').assign(Archivado=True)
+    archived['Fecha_Completado'] = parse_datetime_column(archived['Fecha_Completado'], DATETIME_COLUMN_FORMATS['Fecha_Completado'])
+    archived['_cierre'] = pd.to_datetime([fecha for fecha, _, _ in archived_rows])
+
+    history = pd.concat([live, archived])
+    history = history.sort_values(['_cierre', 'ID_Pedido'], ascending=False).iloc[:limit]
+    page = history[HISTORY_COLUMNS + ['Archivado']].copy()
+    cursor = None
+    if len(history) == limit:
+        cursor = _history_cursor_key(history['_cierre'].iat[-1], history['ID_Pedido'].iat[-1])
+
+    # DETAIL_COLUMNS de los pedidos de la hoja: solo los de esta página
+    live_page = live_rows[live_rows['ID_Pedido'].isin(page.loc[~page['Archivado'], 'ID_Pedido'])]
+    details = load_order_details(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, live_page)
+    for col in DETAIL_COLUMNS:
+        page[col] = page[col].where(page['Archivado'], page['ID_Pedido'].map(dict(zip(details['ID_Pedido'], details[col]))))
+    return page, cursor
+
+# --- Excel Export of Order History ---
+xlsxwriter = optional_module('xlsxwriter') # Se importa en la primera exportación
+
+EXPORT_COLUMNS = EXPECTED_COLUMNS + ['Archivado']
+EXPORT_CHUNK_ROWS = 5000 # Filas que se preparan a la vez (de la copia o del archivo) antes de escribirlas
+EXPORT_DATE_FORMATS = { # Columnas que se escriben como fecha de Excel, con su formato de celda
+    'Hora_Registro': 'yyyy-mm-dd hh:mm:ss',
+    'Fecha_Entrega': 'yyyy-mm-dd',
+    'Fecha_Completado': 'yyyy-mm-dd',
+    'Hora_Proceso': 'yyyy-mm-dd hh:mm:ss',
+}
+
+def _live_export_chunks(df_main, positions, worksheet, headers, detail_errors):
+    """
+    Filas de la copia viva para exportar, por bloques de EXPORT_CHUNK_ROWS: tuplas (cierre, ID_Pedido, valores)
+    en el orden de `positions`. Las fechas ya vienen analizadas; DETAIL_COLUMNS se lee de la hoja para
+    cada bloque, justo antes de escribirlo, y se usa si la fila sigue correspondiendo al pedido. Sin
+    `worksheet`, o si la lectura falla (el error se agrega a `detail_errors`), esas columnas quedan vacías.
+    """
+    for start in range(0, len(positions), EXPORT_CHUNK_ROWS):
+        chunk = df_main.iloc[positions[start:start + EXPORT_CHUNK_ROWS]]
+        details = {}
+        if worksheet is not None and 'ID_Pedido' in headers:
+            try:
+                details = _read_order_details(worksheet, headers, chunk['_gsheet_row_index'].tolist())
+            except Exception as e:
+                detail_errors.append(str(e))
+        cierre = fecha_cierre(chunk)
+        columns = {
+            col: chunk['Fecha_Entrega_dt'] if col == 'Fecha_Entrega' else chunk[col].astype(object)
+            for col in EXPORT_COLUMNS if col in chunk.columns
+        }
+        for i, (id_pedido, row_index) in enumerate(zip(chunk['ID_Pedido'], chunk['_gsheet_row_index'])):
+            detail_id, detail_values = details.get(row_index, ('', {}))
+            values = {col: series.iat[i] for col, series in columns.items()}
+            values.update(detail_values if detail_id == id_pedido else {})
+            values['Archivado'] = 'No'
+            yield cierre.iat[i], id_pedido, values
+
+def _archive_export_chunks(conn, desde, hasta, estados, tipo_envio, skip_ids):
+    """
+    Filas del archivo (SQLite) para exportar, de la más reciente a la más antigua, leídas de
+    EXPORT_CHUNK_ROWS en EXPORT_CHUNK_ROWS. Se omiten los pedidos de `skip_ids` (aún en la hoja).
+    """
+    where, params = _archive_history_filter(desde, hasta, estados, tipo_envio)
+    cursor = conn.execute(
+        f"SELECT fecha_completado, datos FROM pedidos_archivados WHERE {where} "
+        "ORDER BY fecha_completado DESC, id_pedido DESC",
+        params
+    )
+    while True:
+        archived_rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not archived_rows:
+            return
+        chunk = pd.DataFrame([json.loads(datos) for _, datos in archived_rows]).reindex(columns=EXPECTED_COLUMNS).fillna('')
+        for col in EXPORT_DATE_FORMATS:
+            chunk[col] = parse_datetime_column(chunk[col], DATETIME_COLUMN_FORMATS.get(col, FECHA_ENTREGA_FORMAT))
+        chunk['Archivado'] = 'Sí'
+        cierre = pd.to_datetime([fecha for fecha, _ in archived_rows])
+        for i, values in enumerate(chunk.to_dict('records')):
+            id_pedido = str(values['ID_Pedido']).strip()
+            if id_pedido in skip_ids:
+                continue
+            yield cierre[i], id_pedido, values
+
+@trace_span('historial.exportacion')
+def export_order_history_xlsx(df_main, partitions, path, desde, hasta, estados=('completado',), tipo_envio=None,
+                              worksheet=None, headers=None, detail_errors=None, progress_callback=None):
+    """
+    Escribe en `path` un .xlsx con los pedidos cerrados entre `desde` y `hasta` (de la hoja y del
+    archivo), ordenados como el historial. XlsxWriter trabaja en modo constant_memory: cada fila se
+    escribe al disco al pasar a la siguiente, así que la memoria no crece con el número de pedidos.
+    Las filas se preparan por bloques y se mezclan ya ordenadas; las fechas se escriben como fechas
+    de Excel. DETAIL_COLUMNS de los pedidos de la hoja se leen de `worksheet` (con sus `headers`)
+    bloque por bloque; sin él quedan vacías, igual que en los bloques cuya lectura falla (los errores
+    se agregan a la lista `detail_errors`).
+    progress_callback(filas escritas, total estimado) se llama después de cada bloque.
+    Retorna el número de pedidos exportados. No usa st.*.
+    """
+    live_positions = _live_history_positions(df_main, partitions, desde, hasta, estados, tipo_envio)
+    live_ids = set(df_main['ID_Pedido'].to_numpy()[live_positions])
+    total = count_order_history(df_main, partitions, desde, hasta, estados, tipo_envio)
+    detail_errors = [] if detail_errors is None else detail_errors
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        xlsx_sheet = workbook.add_worksheet("Historial")
+        date_formats = {col: workbook.add_format({'num_format': fmt}) for col, fmt in EXPORT_DATE_FORMATS.items()}
+        xlsx_sheet.write_row(0, 0, EXPORT_COLUMNS, workbook.add_format({'bold': True}))
+        xlsx_sheet.freeze_panes(1, 0)
+        row_number = 0
+        with closing(_open_archive_db()) as conn:
+            rows = heapq.merge(
+                _live_export_chunks(df_main, live_positions, worksheet, headers or [], detail_errors),
+                _archive_export_chunks(conn, desde, hasta, estados, tipo_envio, live_ids),
+                key=lambda row: (row[0], row[1]),
+                reverse=True,
+            )
+            for _, _, values in rows:
+                row_number += 1
+                for col_number, col in enumerate(EXPORT_COLUMNS):
+                    value = values.get(col, '')
+                    if col in date_formats:
+                        if pd.isna(value):
+                            continue
+                        xlsx_sheet.write_datetime(row_number, col_number, value, date_formats[col])
+                    elif value != '' and not pd.isna(value):
+                        xlsx_sheet.write_string(row_number, col_number, str(value))
+                if progress_callback and row_number % EXPORT_CHUNK_ROWS == 0:
+                    progress_callback(row_number, max(total, row_number))
+    finally:
+        workbook.close()
+    if progress_callback:
+        progress_callback(row_number, row_number)
+    return row_number
+
+def _discard_history_export():
+    """Elimina el archivo temporal de la exportación de la sesión (también al pedir su descarga)."""
+    export = st.session_state.pop("history_export", None)
+    if export and os.path.exists(export['path']):
+        os.remove(export['path'])
+
+def render_history_export(df_main, partitions, desde, hasta, estados):
+    """
+    Exportación a Excel del historial con el rango y los estados elegidos (más un filtro por
+    Tipo_Envio). El archivo se genera en un temporal del servidor y queda en disco hasta que se
+    descarga: el botón recibe el archivo abierto y, al pedir la descarga, el temporal se elimina y
+    el botón deja de dibujarse, así que Streamlit ya no conserva su contenido. El de la exportación
+    anterior de la sesión también se elimina.
+    """
+    with st.expander("📥 Exportar historial a Excel"):
+        if xlsxwriter is None:
+            st.warning("⚠️ La librería 'XlsxWriter' no está instalada. No se puede exportar a Excel.")
+            return
+        tipo_envio_export = st.selectbox("Tipo de Envío", TIPO_ENVIO_FILTER_OPTIONS, key="export_tipo_envio")
+        if st.button("Generar archivo de Excel", key="export_history_btn"):
+            _discard_history_export()
+            try:
+                worksheet = get_snapshot_worksheet(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+            except Exception as e:
+                st.warning(f"⚠️ No se pudieron leer los adjuntos de los pedidos de la hoja; se exportan sin ellos: {e}")
+                worksheet = None
+            detail_errors = []
+            fd, path = tempfile.mkstemp(prefix="historial_pedidos_", suffix=".xlsx")
+            os.close(fd)
+            export_progress = st.progress(0.0, text="Generando archivo de Excel...")
+            try:
+                exported = export_order_history_xlsx(
+                    df_main, partitions, path, desde, hasta, estados,
+                    tipo_envio=None if tipo_envio_export == "Todos" else tipo_envio_export,
+                    worksheet=worksheet,
+                    headers=get_sheet_snapshot_cache(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)['headers'],
+                    detail_errors=detail_errors,
+                    progress_callback=lambda done, total: export_progress.progress(
+                        min(done / total, 1.0) if total else 1.0, text=f"Generando archivo de Excel... {done} de {total} pedidos"
+                    )
+                )
+            except Exception as e:
+                os.remove(path)
+                st.error(f"❌ Error al generar el archivo de Excel: {e}")
+                return
+            export_progress.empty()
+            if detail_errors:
+                st.warning(f"⚠️ No se pudieron leer los adjuntos de algunos pedidos de la hoja; se exportaron sin ellos: {detail_errors[0]}")
+            st.session_state["history_export"] = {
+                'path': path,
+                'rows': exported,
+                'file_name': f"historial_pedidos_{desde:%Y%m%d}_{(hasta - timedelta(days=1)):%Y%m%d}.xlsx",
+            }
+
+        export = st.session_state.get("history_export")
+        if export and os.path.exists(export['path']):
+            st.caption(f"{export['rows']} pedidos exportados.")
+            with open(export['path'], 'rb') as export_file:
+                st.download_button(
+                    "Descargar Excel",
+                    data=export_file,
+                    file_name=export['file_name'],
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key="export_history_download",
+                    on_click=_discard_history_export,
+                )
+
 # --- Helper Functions ---
+requests = optional_module('requests') # Se importa en la primera descarga por URL
+if requests is None:
+    st.warning("⚠️ La librería 'requests' no está instalada. Algunas funcionalidades de adjuntos podrían no funcionar.")
+
 try:
-    import requests
+    from PIL import Image, ImageOps
 except ImportError:
-    st.warning("⚠️ La librería 'requests' no está instalada. Algunas funcionalidades de adjuntos podrían no funcionar.")
-    requests = None 
+    st.warning("⚠️ La librería 'Pillow' no está instalada. No se generarán miniaturas de las imágenes adjuntas.")
+    Image = None
+
 
+S3_PRESIGNED_URL_EXPIRES_SECONDS = 3600 # URL válida por 1 hora
+S3_PRESIGNED_URL_RENEW_MARGIN_SECONDS = 5 * 60 # Se firma una nueva URL cuando a la actual le queda menos que esto
+S3_PRESIGN_MAX_WORKERS = 8
+
+@st.cache_resource
+def get_presigned_url_cache():
+    """
+    URLs pre-firmadas compartidas por todas las sesiones (clave de S3 -> (url, vencimiento)).
+    Reutilizar la misma URL mientras es válida permite que el navegador conserve en caché las miniaturas.
+    """
+    return {'lock': threading.Lock(), 'urls': {}}
+
+def _sign_s3_download_url(s3_client_instance, object_key):
+    """Firma una URL de descarga y la guarda en la caché de URLs pre-firmadas."""
+    expires_at = time.time() + S3_PRESIGNED_URL_EXPIRES_SECONDS
+    url = s3_client_instance.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={'Bucket': S3_BUCKET_NAME, 'Key': object_key},
+        ExpiresIn=S3_PRESIGNED_URL_EXPIRES_SECONDS
+    )
+    cache = get_presigned_url_cache()
+    with cache['lock']:
+        cache['urls'][object_key] = (url, expires_at)
+    return url
+
+def _cached_s3_download_url(object_key):
+    """Retorna la URL pre-firmada en caché si todavía no está por vencer, o None."""
+    cache = get_presigned_url_cache()
+    with cache['lock']:
+        cached = cache['urls'].get(object_key)
+    if cached and cached[1] - time.time() > S3_PRESIGNED_URL_RENEW_MARGIN_SECONDS:
+        return cached[0]
+    return None
 
 def get_s3_file_download_url(s3_client_instance, object_key):
-    """Genera una URL de pre-firma para descargar un archivo de S3."""
+    """Genera (o reutiliza mientras sea válida) una URL de pre-firma para descargar un archivo de S3."""
     try:
-        url = s3_client_instance.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={'Bucket': S3_BUCKET_NAME, 'Key': object_key},
-            ExpiresIn=3600 # URL válida por 1 hora
-        )
-        return url
+        return _cached_s3_download_url(object_key) or _sign_s3_download_url(s3_client_instance, object_key)
     except Exception as e:
         st.error(f"❌ Error al generar URL de descarga para '{object_key}': {e}")
         return None
 
-def find_pedido_subfolder_prefix(s3_client_instance, parent_prefix, folder_name):
+@trace_span('s3.firmar_urls')
+def presign_s3_download_urls(s3_client_instance, object_keys):
     """
-    Intenta encontrar el prefijo correcto de una subcarpeta de pedido en S3.
-    Considera varias posibilidades para la estructura de carpetas.
+    Firma en paralelo las URLs de descarga que no estén en caché (o estén por vencer).
+    Retorna un diccionario clave de S3 -> URL (las claves que fallen no se incluyen).
+    """
+    urls = {}
+    missing_keys = []
+    for object_key in dict.fromkeys(object_keys):
+        cached_url = _cached_s3_download_url(object_key)
+        if cached_url:
+            urls[object_key] = cached_url
+        else:
+            missing_keys.append(object_key)
+
+    if missing_keys:
+        with ThreadPoolExecutor(max_workers=S3_PRESIGN_MAX_WORKERS) as executor:
+            futures = {executor.submit(_sign_s3_download_url, s3_client_instance, key): key for key in missing_keys}
+            for future, object_key in futures.items():
+                try:
+                    urls[object_key] = future.result()
+                except Exception:
+                    continue # display_attachments mostrará el error al intentar firmarla de nuevo
+
+        # Descartar las URLs vencidas para que la caché no crezca sin límite
+        cache = get_presigned_url_cache()
+        now = time.time()
+        with cache['lock']:
+            for object_key in [k for k, (_, expires_at) in cache['urls'].items() if expires_at <= now]:
+                del cache['urls'][object_key]
+    return urls
+
+def split_attachment_urls(attachments_value):
+    """Convierte el texto de una columna de adjuntos (URLs separadas por comas) en una lista de URLs."""
+    if not attachments_value:
+        return []
+    return [url.strip() for url in attachments_value.split(',') if url.strip()]
+
+def s3_key_from_url(url):
+    """Intenta obtener la clave de S3 de la URL de un adjunto (None si no es una URL de S3)."""
+    s3_key_match = re.search(r'\.amazonaws\.com/([^?]+)', url)
+    return s3_key_match.group(1) if s3_key_match else None
+
+@trace_span('s3.prefetch_urls')
+def prefetch_attachment_urls(s3_client_instance, df_orders):
     """
-    if not s3_client_instance:
+    Firma en una sola pasada paralela las URLs de todos los adjuntos que se van a mostrar
+    (los de los pedidos con adjuntos expandidos en esta sesión), antes de dibujar las tarjetas.
+    """
+    if not s3_client_instance or df_orders.empty:
+        return
+    expanded = st.session_state["expanded_attachments"]
+    object_keys = []
+    for seccion, column in (("pedido", 'Adjuntos'), ("surtido", 'Adjuntos_Surtido')):
+        for id_pedido, attachments_value in zip(df_orders['ID_Pedido'], df_orders[column]):
+            if expanded.get(f"{id_pedido}_{seccion}", False):
+                for key in map(s3_key_from_url, split_attachment_urls(attachments_value)):
+                    if key:
+                        object_keys.append(key)
+                        thumbnail_key = get_attachment_thumbnail_key(s3_client_instance, key)
+                        if thumbnail_key:
+                            object_keys.append(thumbnail_key)
+    if object_keys:
+        presign_s3_download_urls(s3_client_instance, object_keys)
+
+# --- Attachment Index (ID_Pedido -> S3 prefix) ---
+ATTACHMENT_INDEX_PATH = os.path.join(LOCAL_CACHE_DIR, 'indice_adjuntos.json')
+ATTACHMENT_INDEX_REFRESH_SECONDS = 5 * 60 # Listado incremental de objetos nuevos o modificados
+ATTACHMENT_INDEX_FULL_REBUILD_SECONDS = 6 * 60 * 60 # Listado completo para detectar borrados
+# Margen bajo la marca de LastModified: objetos cuya subida terminó mientras se listaba o con la hora
+# de S3 ligeramente atrasada
+ATTACHMENT_INDEX_WATERMARK_OVERLAP_SECONDS = 10 * 60
+ATTACHMENT_INDEX_VERSION = 3 # Cambiarlo obliga a reconstruir los índices guardados con otro formato
+
+def _empty_attachment_index():
+    return {
+        'version': ATTACHMENT_INDEX_VERSION,
+        'bucket': S3_BUCKET_NAME,
+        'prefix': S3_ATTACHMENT_PREFIX,
+        'thumbnail_prefix': S3_THUMBNAIL_PREFIX,
+        # ID_Pedido -> {'prefix': ..., 'objects': {s3_key: {'size', 'etag', 'last_modified'}}, 'thumbnails': {s3_key: clave de la miniatura}}
+        'orders': {},
+        'watermark': '',    # LastModified más reciente listado en S3 (ISO 8601 en UTC)
+        'last_refresh': 0.0,
+        'last_full_build': 0.0,
+    }
+
+def _add_object_to_attachment_index(index, s3_key, size=None, etag=None, last_modified=None):
+    """
+    Registra un objeto de S3 en el índice. Solo se indexan claves del tipo <prefijo><ID_Pedido>/<archivo>
+    y sus miniaturas bajo S3_THUMBNAIL_PREFIX.
+    """
+    thumbnail_key = None
+    if s3_key.startswith(index['thumbnail_prefix']) and s3_key.endswith(THUMBNAIL_EXTENSION):
+        thumbnail_key = s3_key
+        s3_key = s3_key[len(index['thumbnail_prefix']):-len(THUMBNAIL_EXTENSION)]
+    relative_key = s3_key[len(index['prefix']):] if s3_key.startswith(index['prefix']) else None
+    if not relative_key or '/' not in relative_key:
+        return
+    pedido_id = relative_key.split('/', 1)[0]
+    if not pedido_id:
+        return
+    if isinstance(last_modified, datetime):
+        last_modified = last_modified.isoformat()
+    order = index['orders'].setdefault(pedido_id, {'prefix': f"{index['prefix']}{pedido_id}/", 'objects': {}, 'thumbnails': {}})
+    if thumbnail_key:
+        order['thumbnails'][s3_key] = thumbnail_key
+        return
+    order['objects'][s3_key] = {
+        'size': size,
+        'etag': etag.strip('"') if etag else None,
+        'last_modified': last_modified,
+    }
+
+def _list_attachment_objects(s3_client_instance, prefix):
+    """Lista (paginado) los objetos bajo `prefix`."""
+    paginator = s3_client_instance.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+def _list_indexable_objects(s3_client_instance, watermark=''):
+    """
+    Lista los objetos de S3_ATTACHMENT_PREFIX y sus miniaturas. Con `watermark` (marca del índice),
+    solo retorna los modificados desde ATTACHMENT_INDEX_WATERMARK_OVERLAP_SECONDS antes de ella:
+    así también se ven los archivos nuevos en carpetas de pedidos que ya existían.
+    Retorna (objetos, marca nueva).
+    """
+    since = None
+    if watermark:
+        since = datetime.fromisoformat(watermark) - timedelta(seconds=ATTACHMENT_INDEX_WATERMARK_OVERLAP_SECONDS)
+    objects = []
+    for prefix in (S3_ATTACHMENT_PREFIX, f"{S3_THUMBNAIL_PREFIX}{S3_ATTACHMENT_PREFIX}"):
+        for obj in _list_attachment_objects(s3_client_instance, prefix):
+            last_modified = obj.get('LastModified')
+            if last_modified is not None:
+                last_modified = last_modified.astimezone(timezone.utc)
+                watermark = max(watermark, last_modified.isoformat())
+                if since is not None and last_modified < since:
+                    continue
+            objects.append(obj)
+    return objects, watermark
+
+def build_attachment_index(s3_client_instance):
+    """Construye el índice de adjuntos desde cero con un listado paginado de S3_ATTACHMENT_PREFIX y sus miniaturas."""
+    index = _empty_attachment_index()
+    objects, index['watermark'] = _list_indexable_objects(s3_client_instance)
+    for obj in objects:
+        _add_object_to_attachment_index(index, obj['Key'], obj.get('Size'), obj.get('ETag'), obj.get('LastModified'))
+    index['last_refresh'] = index['last_full_build'] = time.time()
+    return index
+
+def _save_attachment_index(index):
+    """Guarda el índice en disco (escritura atómica) para no reconstruirlo al reiniciar."""
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{ATTACHMENT_INDEX_PATH}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, ATTACHMENT_INDEX_PATH)
+
+def _load_attachment_index():
+    """Carga el índice guardado en disco, o None si no existe o es de otro formato, bucket o prefijo."""
+    try:
+        with open(ATTACHMENT_INDEX_PATH, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
         return None
-    
-    # Lista de posibles prefijos para probar
-    possible_prefixes = [
-        f"{parent_prefix}{folder_name}/", # Ej: adjuntos_pedidos/PED-20231026123456-ABCD/
-        f"{parent_prefix}{folder_name}",   # Ej: adjuntos_pedidos/PED-20231026123456-ABCD (sin barra al final)
-        f"{folder_name}/",                 # Si la carpeta del pedido es directamente la raíz del bucket
-        folder_name                        # Si la carpeta del pedido es directamente la raíz del bucket sin barra
-    ]
-    
-    for pedido_prefix in possible_prefixes:
+    if (
+        index.get('version') != ATTACHMENT_INDEX_VERSION
+        or index.get('bucket') != S3_BUCKET_NAME
+        or index.get('prefix') != S3_ATTACHMENT_PREFIX
+        or index.get('thumbnail_prefix') != S3_THUMBNAIL_PREFIX
+    ):
+        return None
+    return index
+
+@st.cache_resource
+def get_attachment_index(_s3_client_instance):
+    """
+    Índice compartido ID_Pedido -> prefijo y objetos de S3. Se carga desde disco si existe; lo
+    construye y actualiza el hilo de start_attachment_index_refresher, así que la ejecución del
+    script nunca lista S3. Mientras no se construye por primera vez, 'data' está vacío y 'ready' es False.
+    """
+    index = _load_attachment_index()
+    return {
+        'lock': threading.Lock(),
+        'data': index or _empty_attachment_index(),
+        'ready': index is not None,
+        'error': None,        # Error de la última actualización (o None)
+        'last_attempt': 0.0,
+        'refreshing': False,  # El hilo está listando S3
+        'refresher': None,
+    }
+
+@trace_span('s3.indice_adjuntos')
+def _refresh_attachment_index(state, s3_client_instance):
+    """
+    Actualiza el índice: la primera vez y cada ATTACHMENT_INDEX_FULL_REBUILD_SECONDS lo reconstruye
+    por completo; si no, agrega los objetos modificados desde su marca de LastModified.
+    S3 se lista sin tomar state['lock']; el lock solo se toma para publicar el resultado.
+    No usa st.*: los errores se propagan a quien llama.
+    """
+    now = time.time()
+    if not state['ready'] or now - state['data']['last_full_build'] >= ATTACHMENT_INDEX_FULL_REBUILD_SECONDS:
+        index = build_attachment_index(s3_client_instance)
+        with state['lock']:
+            state['data'] = index
+            state['ready'] = True
+            _save_attachment_index(index)
+        return
+    objects, watermark = _list_indexable_objects(s3_client_instance, state['data']['watermark'])
+    with state['lock']:
+        index = state['data']
+        for obj in objects:
+            _add_object_to_attachment_index(index, obj['Key'], obj.get('Size'), obj.get('ETag'), obj.get('LastModified'))
+        index['watermark'] = max(index['watermark'], watermark)
+        index['last_refresh'] = now
+        _save_attachment_index(index)
+
+def _attachment_index_refresher_loop(state, s3_client_instance):
+    """
+    Hilo de actualización del índice de adjuntos: lo actualiza cada ATTACHMENT_INDEX_REFRESH_SECONDS
+    y termina si la caché se descartó (por ejemplo, con "Clear cache").
+    """
+    while get_attachment_index(s3_client_instance) is state:
+        last = max(state['data']['last_refresh'], state['last_attempt'])
+        wait = last + ATTACHMENT_INDEX_REFRESH_SECONDS - time.time()
+        if wait > 0:
+            state['refreshing'] = False
+            time.sleep(min(wait, ATTACHMENT_INDEX_REFRESH_SECONDS))
+            continue
+        state['refreshing'] = True
         try:
-            # Intentar listar objetos con el prefijo, limitando a 1 para verificar existencia
-            response = s3_client_instance.list_objects_v2(
-                Bucket=S3_BUCKET_NAME,
-                Prefix=pedido_prefix,
-                MaxKeys=1
+            _refresh_attachment_index(state, s3_client_instance)
+            state['error'] = None
+        except Exception as e:
+            state['error'] = e
+        state['last_attempt'] = time.time()
+
+def start_attachment_index_refresher(s3_client_instance):
+    """
+    Inicia, una sola vez por proceso, el hilo que construye y actualiza el índice de adjuntos.
+    Retorna el estado del índice (ver get_attachment_index).
+    """
+    state = get_attachment_index(s3_client_instance)
+    with state['lock']:
+        if state['refresher'] is None or not state['refresher'].is_alive():
+            state['refreshing'] = True # Hasta que el hilo vea si le toca actualizar
+            state['refresher'] = threading.Thread(
+                target=_attachment_index_refresher_loop,
+                args=(state, s3_client_instance),
+                name="s3-attachment-index",
+                daemon=True,
             )
-            
-            # Si hay contenido, significa que el prefijo es válido
-            if 'Contents' in response and response['Contents']:
-                return pedido_prefix
-            
-        except Exception:
-            # Si hay un error (ej. prefijo inválido en S3, aunque poco probable con list_objects), ignorar y probar el siguiente
-            continue
-    
-    # Si no se encuentra nada con los prefijos directos, hacer una búsqueda más general
-    # Esto es más lento y solo se debería ejecutar si los intentos directos fallan
-    try:
-        response = s3_client_instance.list_objects_v2(
-            Bucket=S3_BUCKET_NAME,
-            MaxKeys=1000 # Limitar para evitar una lista excesivamente grande
-        )
-        
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                # Buscar si el nombre de la carpeta (ID_Pedido) está en la clave del objeto
-                if folder_name in obj['Key']:
-                    # Extraer el prefijo de la carpeta del pedido
-                    if '/' in obj['Key']:
-                        prefix_parts = obj['Key'].split('/')[:-1] # Obtener todas las partes excepto el nombre del archivo
-                        return '/'.join(prefix_parts) + '/' # Reconstruir el prefijo con la barra al final
-                    else:
-                        # Si es un archivo directamente en la raíz con el nombre del pedido, esto es un caso límite.
-                        # Mejor devolver el propio folder_name si es un archivo suelto, o None si no es una "carpeta".
-                        # Para este contexto de subcarpetas, si no hay '/', no es una subcarpeta.
-                        return None
-        return None # No se encontró ninguna subcarpeta que coincida
-    except Exception as e:
-        st.warning(f"⚠️ Advertencia: Error durante la búsqueda general de prefijo de S3 para '{folder_name}': {e}")
+            state['refresher'].start()
+    return state
+
+def register_attachment_object(s3_client_instance, s3_key, size=None, etag=None, persist=True):
+    """
+    Añade al índice un objeto que la propia aplicación acaba de subir.
+    Con persist=False no se guarda en disco (para registrar muchos objetos y guardar una sola vez).
+    """
+    state = get_attachment_index(s3_client_instance)
+    with state['lock']:
+        _add_object_to_attachment_index(state['data'], s3_key, size, etag, datetime.now().astimezone())
+        if persist:
+            _save_attachment_index(state['data'])
+
+def save_attachment_index(s3_client_instance):
+    """Guarda en disco el estado actual del índice de adjuntos."""
+    state = get_attachment_index(s3_client_instance)
+    with state['lock']:
+        _save_attachment_index(state['data'])
+
+def get_pedido_attachment_objects(s3_client_instance, pedido_id):
+    """Retorna los objetos de S3 indexados para un pedido ({s3_key: metadatos}), sin consultar S3."""
+    order = get_attachment_index(s3_client_instance)['data']['orders'].get(pedido_id)
+    return order['objects'] if order else {}
+
+def get_attachment_thumbnail_key(s3_client_instance, s3_key):
+    """Retorna la clave de la miniatura de un adjunto si existe según el índice, sin consultar S3."""
+    pedido_id = s3_key[len(S3_ATTACHMENT_PREFIX):].split('/', 1)[0]
+    order = get_attachment_index(s3_client_instance)['data']['orders'].get(pedido_id)
+    return order['thumbnails'].get(s3_key) if order else None
+
+def find_pedido_subfolder_prefix(s3_client_instance, parent_prefix, folder_name):
+    """
+    Retorna el prefijo de S3 de la subcarpeta de un pedido usando el índice de adjuntos,
+    sin consultar S3. El índice cubre las subcarpetas de S3_ATTACHMENT_PREFIX.
+    """
+    if not s3_client_instance or parent_prefix != S3_ATTACHMENT_PREFIX:
         return None
+    order = get_attachment_index(s3_client_instance)['data']['orders'].get(folder_name)
+    return order['prefix'] if order else None
+
+
+# --- Image Thumbnails ---
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+THUMBNAIL_EXTENSION = '.webp'
+THUMBNAIL_MAX_SIZE = (300, 300) # El doble del ancho mostrado (150 px) para pantallas de alta densidad
+THUMBNAIL_QUALITY = 75
+THUMBNAIL_BACKFILL_MAX_WORKERS = 4
+
+def is_image_file(file_name):
+    return file_name.lower().endswith(IMAGE_EXTENSIONS)
+
+def thumbnail_key_for(s3_key):
+    """Clave de S3 de la miniatura de un adjunto (ej. miniaturas/adjuntos_pedidos/PED-1/foto.jpg.webp)."""
+    return f"{S3_THUMBNAIL_PREFIX}{s3_key}{THUMBNAIL_EXTENSION}"
+
+def make_thumbnail_bytes(image_bytes):
+    """Genera una miniatura WebP de como máximo THUMBNAIL_MAX_SIZE a partir del contenido de una imagen."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        thumbnail = ImageOps.exif_transpose(image) # Respetar la orientación de las fotos de teléfono
+        thumbnail.thumbnail(THUMBNAIL_MAX_SIZE)
+        if thumbnail.mode not in ('RGB', 'RGBA'):
+            thumbnail = thumbnail.convert('RGBA' if 'A' in thumbnail.getbands() else 'RGB')
+        output = io.BytesIO()
+        thumbnail.save(output, format='WEBP', quality=THUMBNAIL_QUALITY)
+        return output.getvalue()
+
+def create_attachment_thumbnail(s3_client_instance, s3_key, image_bytes, persist_index=True):
+    """Genera y sube la miniatura de una imagen, y la registra en el índice de adjuntos."""
+    thumbnail_key = thumbnail_key_for(s3_key)
+    thumbnail_bytes = make_thumbnail_bytes(image_bytes)
+    s3_client_instance.put_object(
+        Bucket=S3_BUCKET_NAME,
+        Key=thumbnail_key,
+        Body=thumbnail_bytes,
+        ContentType='image/webp',
+        CacheControl='max-age=31536000' # La miniatura de una clave nunca cambia
+    )
+    register_attachment_object(s3_client_instance, thumbnail_key, size=len(thumbnail_bytes), persist=persist_index)
+    return thumbnail_key
+
+def list_attachments_missing_thumbnails(s3_client_instance):
+    """Retorna las claves de las imágenes indexadas que todavía no tienen miniatura."""
+    index = get_attachment_index(s3_client_instance)['data']
+    return [
+        s3_key
+        for order in index['orders'].values()
+        for s3_key in order['objects']
+        if is_image_file(s3_key) and s3_key not in order['thumbnails']
+    ]
 
+def backfill_thumbnails(s3_client_instance, object_keys, progress_callback=None):
+    """
+    Genera en paralelo las miniaturas de imágenes ya subidas (descarga el original, lo reduce y
+    sube la miniatura). `progress_callback(hechas, total)` se llama desde el hilo que invoca la función.
+    Retorna (creadas, fallidas).
+    """
+    def _backfill_one(s3_key):
+        response = s3_client_instance.get_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
+        create_attachment_thumbnail(s3_client_instance, s3_key, response['Body'].read(), persist_index=False)
+
+    created = failed = 0
+    with ThreadPoolExecutor(max_workers=THUMBNAIL_BACKFILL_MAX_WORKERS) as executor:
+        futures = [executor.submit(_backfill_one, s3_key) for s3_key in object_keys]
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+                created += 1
+            except Exception:
+                failed += 1
+            if progress_callback:
+                progress_callback(done, len(futures))
+    save_attachment_index(s3_client_instance)
+    return created, failed
+
+# --- Attachment Downloads ---
+ATTACHMENT_BYTES_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Tope total de la caché de descargas
+ATTACHMENT_BYTES_CACHE_MAX_ITEM_BYTES = 16 * 1024 * 1024 # Archivos más grandes no se guardan en caché
+ATTACHMENT_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
 
-def display_attachments(s3_client_instance, attachment_urls, pedido_id_for_prefix):
-    """Muestra adjuntos con botones de descarga y miniaturas para imágenes."""
+@st.cache_resource
+def get_attachment_bytes_cache():
+    """Caché LRU compartida de contenidos de adjuntos, acotada por tamaño total."""
+    return {'lock': threading.Lock(), 'items': OrderedDict(), 'total_bytes': 0}
+
+def _attachment_bytes_cache_get(cache_key):
+    cache = get_attachment_bytes_cache()
+    with cache['lock']:
+        content = cache['items'].get(cache_key)
+        if content is not None:
+            cache['items'].move_to_end(cache_key)
+        return content
+
+def _attachment_bytes_cache_put(cache_key, content):
+    if len(content) > ATTACHMENT_BYTES_CACHE_MAX_ITEM_BYTES:
+        return
+    cache = get_attachment_bytes_cache()
+    with cache['lock']:
+        if cache_key in cache['items']:
+            return
+        cache['items'][cache_key] = content
+        cache['total_bytes'] += len(content)
+        while cache['total_bytes'] > ATTACHMENT_BYTES_CACHE_MAX_BYTES:
+            _, evicted = cache['items'].popitem(last=False)
+            cache['total_bytes'] -= len(evicted)
+
+def fetch_attachment_bytes(s3_client_instance, s3_key=None, url=None):
+    """
+    Descarga el contenido de un adjunto en bloques, desde S3 (si se conoce la clave) o desde su URL.
+    Los contenidos de S3 se guardan en caché por clave y ETag, de modo que un archivo reemplazado
+    nunca se sirve desde la caché.
+    """
+    if s3_key:
+        etag = None
+        order_objects = get_pedido_attachment_objects(s3_client_instance, s3_key[len(S3_ATTACHMENT_PREFIX):].split('/', 1)[0])
+        if s3_key in order_objects:
+            etag = order_objects[s3_key]['etag']
+        if not etag:
+            etag = s3_client_instance.head_object(Bucket=S3_BUCKET_NAME, Key=s3_key)['ETag'].strip('"')
+        cache_key = (s3_key, etag)
+        content = _attachment_bytes_cache_get(cache_key)
+        if content is None:
+            response = s3_client_instance.get_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
+            buffer = bytearray()
+            for chunk in response['Body'].iter_chunks(chunk_size=ATTACHMENT_DOWNLOAD_CHUNK_BYTES):
+                buffer.extend(chunk)
+            content = bytes(buffer)
+            _attachment_bytes_cache_put(cache_key, content)
+        return content
+
+    cache_key = (url, None)
+    content = _attachment_bytes_cache_get(cache_key)
+    if content is None:
+        buffer = bytearray()
+        start = time.perf_counter()
+        status_code = 599 # Sin respuesta: error de conexión
+        try:
+            with requests.get(url, stream=True, timeout=30) as response:
+                status_code = response.status_code
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=ATTACHMENT_DOWNLOAD_CHUNK_BYTES):
+                    buffer.extend(chunk)
+        finally:
+            record_api_call('http', 'get', time.perf_counter() - start, status_code=status_code)
+        content = bytes(buffer)
+        _attachment_bytes_cache_put(cache_key, content)
+    return content
+
+@trace_span('render.adjuntos')
+def display_attachments(s3_client_instance, attachment_urls, pedido_id_for_prefix, seccion="pedido"):
+    """
+    Muestra adjuntos con miniaturas para imágenes y botones de descarga.
+    El contenido de un archivo solo se descarga cuando el usuario lo pide.
+    Se dibuja dentro de la tarjeta del pedido (render_order_card): expandir o descargar solo la vuelve a dibujar a ella.
+    `seccion` distingue los adjuntos del pedido de los de surtido de un mismo pedido.
+    """
     if not attachment_urls:
         st.info("No hay adjuntos para este pedido.")
         return
@@ -313,8 +3010,7 @@ def display_attachments(s3_client_instance, attachment_urls, pedido_id_for_prefi
             file_name = match.group(1) if match else "Archivo Desconocido"
             
             # Intentar obtener la clave de S3 de la URL
-            s3_key_match = re.search(r'\.amazonaws\.com/([^?]+)', url)
-            s3_key = s3_key_match.group(1) if s3_key_match else None
+            s3_key = s3_key_from_url(url)
 
             if s3_key:
                 clean_attachment_info.append({'name': file_name, 's3_key': s3_key, 'url': url})
@@ -324,10 +3020,11 @@ def display_attachments(s3_client_instance, attachment_urls, pedido_id_for_prefi
 
 
     # Usar st.session_state para controlar la expansión
-    if st.session_state["expanded_attachments"].get(pedido_id_for_prefix, False):
-        if st.button("Contraer Adjuntos", key=f"collapse_att_{pedido_id_for_prefix}"):
-            st.session_state["expanded_attachments"][pedido_id_for_prefix] = False
-            st.rerun() # Recargar para aplicar el cambio
+    expand_key = f"{pedido_id_for_prefix}_{seccion}"
+    if st.session_state["expanded_attachments"].get(expand_key, False):
+        if st.button("Contraer Adjuntos", key=f"collapse_att_{expand_key}"):
+            st.session_state["expanded_attachments"][expand_key] = False
+            rerun_order_card() # Volver a dibujar solo la tarjeta del pedido
         
         cols = st.columns(3) # Para organizar los archivos en columnas
         col_idx = 0
@@ -341,42 +3038,51 @@ def display_attachments(s3_client_instance, attachment_urls, pedido_id_for_prefi
                 st.markdown(f"**{file_name}**")
                 
                 # Determinar si es una imagen para mostrar miniatura
-                is_image = file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))
+                is_image = is_image_file(file_name)
                 
-                if s3_key and s3_client_instance and requests: # Asegúrate de que requests esté disponible
+                if s3_key and s3_client_instance:
                     # Generar URL de descarga firmada si tenemos la clave S3 y el cliente S3
                     download_url = get_s3_file_download_url(s3_client_instance, s3_key)
-                    if download_url:
-                        if is_image:
-                            st.image(download_url, caption=file_name, width=150) # Miniatura
-                        
+                else:
+                    # Si no tenemos S3_key, intentamos usar la URL original directamente
+                    download_url = original_url
+
+                if not download_url:
+                    st.warning(f"No se pudo generar URL de descarga para {file_name}.")
+                else:
+                    if is_image:
+                        # Mostrar la miniatura generada si existe; el original queda para la descarga
+                        thumbnail_key = get_attachment_thumbnail_key(s3_client_instance, s3_key) if s3_key else None
+                        thumbnail_url = get_s3_file_download_url(s3_client_instance, thumbnail_key) if thumbnail_key else None
+                        st.image(thumbnail_url or download_url, caption=file_name, width=150) # Miniatura
+
+                    download_id = s3_key or original_url
+                    if s3_key is None and requests is None:
+                        st.markdown(f"[Descargar {file_name}]({download_url})", unsafe_allow_html=True) # Enlace directo
+                    elif download_id in st.session_state["requested_downloads"]:
                         try:
-                            # Intenta descargar el contenido solo si requests está disponible
-                            file_content = requests.get(download_url).content
+                            # Solo se descarga el contenido cuando el usuario lo pidió (y se reutiliza de la caché)
+                            file_content = fetch_attachment_bytes(s3_client_instance, s3_key=s3_key, url=original_url)
                             st.download_button(
-                                label=f"Descargar {file_name}",
+                                label=f"Guardar {file_name}",
                                 data=file_content,
                                 file_name=file_name,
-                                key=f"download_{s3_key}",
+                                key=f"download_{seccion}_{download_id}",
                                 use_container_width=True
                             )
                         except Exception as e:
                             st.error(f"❌ Error al descargar contenido para botón para {file_name}: {e}")
                             st.markdown(f"[Descargar {file_name}]({download_url})", unsafe_allow_html=True) # Enlace directo como fallback
-                    else:
-                        st.warning(f"No se pudo generar URL de descarga para {file_name}.")
-                else:
-                    # Si no tenemos S3_key o requests no está, intentamos usar la URL original directamente
-                    if is_image:
-                        st.image(original_url, caption=file_name, width=150) # Miniatura
-                    st.markdown(f"[Descargar {file_name}]({original_url})", unsafe_allow_html=True) # Enlace directo
+                    elif st.button(f"Descargar {file_name}", key=f"request_download_{seccion}_{download_id}", use_container_width=True):
+                        st.session_state["requested_downloads"].add(download_id)
+                        rerun_order_card() # Volver a dibujar la tarjeta con el botón de guardado
 
             col_idx = (col_idx + 1) % 3 # Mover a la siguiente columna
 
     else:
-        if st.button(f"Ver {len(clean_attachment_info)} Adjuntos", key=f"expand_att_{pedido_id_for_prefix}"):
-            st.session_state["expanded_attachments"][pedido_id_for_prefix] = True
-            st.rerun() # Recargar para expandir
+        if st.button(f"Ver {len(clean_attachment_info)} Adjuntos", key=f"expand_att_{expand_key}"):
+            st.session_state["expanded_attachments"][expand_key] = True
+            rerun_order_card() # Volver a dibujar la tarjeta expandida
         
 
 def get_current_week_dates():
@@ -401,27 +3107,258 @@ def ordenar_pedidos_custom(df):
     if df.empty:
         return df
 
-    # Asegurarse de que 'Fecha_Entrega' es de tipo fecha
-    df['Fecha_Entrega_dt'] = pd.to_datetime(df['Fecha_Entrega'], errors='coerce')
+    # Ordenar por Tipo_Envio_Orden y luego por Fecha_Entrega_dt (ascendente); ambas vienen precalculadas
+    return df.sort_values(by=['Tipo_Envio_Orden', 'Fecha_Entrega_dt'], ascending=[True, True], kind='stable')
+
+# --- Paged Order Lists ---
+PAGE_SIZE_OPTIONS = [10, 20, 50]
+TIPO_ENVIO_FILTER_OPTIONS = ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"]
+TURNOS = ["☀️ Local Mañana", "🌙 Local Tarde", "🌵 Saltillo", "📦 Pasa a Bodega", "N/A"] # N/A para foráneos/garantías etc.
+
+def icono_turno(turno_val, default="🚚"):
+    """Icono de un turno (el valor por defecto se usa para N/A)."""
+    return "☀️" if "Mañana" in turno_val else "🌙" if "Tarde" in turno_val else "🌵" if "Saltillo" in turno_val else "📦" if "Bodega" in turno_val else default
+
+def _set_page_cursor(page_key, page):
+    st.session_state["page_cursors"][page_key] = page
+
+def render_pager(page_key, total_items):
+    """
+    Dibuja el paginador de una lista (si tiene más de una página) y retorna el inicio y el
+    tamaño de la página actual. El cursor de página se guarda en la sesión por lista.
+    """
+    page_size = st.session_state.get("page_size", PAGE_SIZE_OPTIONS[1])
+    total_pages = max(1, math.ceil(total_items / page_size))
+    page = min(st.session_state["page_cursors"].get(page_key, 1), total_pages)
+    st.session_state["page_cursors"][page_key] = page
+    start = (page - 1) * page_size
+
+    if total_pages > 1:
+        col_prev, col_info, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            st.button("◀ Anterior", key=f"page_prev_{page_key}", disabled=page <= 1,
+                      on_click=_set_page_cursor, args=(page_key, page - 1), use_container_width=True)
+        with col_info:
+            st.caption(f"Página {page} de {total_pages} · Pedidos {start + 1}–{min(start + page_size, total_items)} de {total_items}")
+        with col_next:
+            st.button("Siguiente ▶", key=f"page_next_{page_key}", disabled=page >= total_pages,
+                      on_click=_set_page_cursor, args=(page_key, page + 1), use_container_width=True)
+    return start, page_size
+
+def history_page(df_main, partitions, desde, hasta, estados, page_index, page_size):
+    """
+    Página `page_index` del historial. El cursor con el que empieza cada página ya vista se guarda
+    en la sesión (se reinicia al cambiar el rango, los estados o el tamaño de página), así que ir a
+    la página siguiente o a la anterior lee solo esa página.
+    """
+    filter_key = (desde, hasta, tuple(estados), page_size)
+    state = st.session_state["history_cursors"]
+    if state.get('filter') != filter_key:
+        state.clear()
+        state.update(filter=filter_key, cursors=[None])
+    cursors = state['cursors']
+    while len(cursors) <= page_index:
+        # Página a la que no se llegó desde la anterior (p. ej. una sesión nueva): se recorren las previas
+        _, cursor = query_order_history(df_main, partitions, desde, hasta, estados, after=cursors[-1], limit=page_size)
+        if cursor is None:
+            break
+        cursors.append(cursor)
+    page_index = min(page_index, len(cursors) - 1)
+    page, cursor = query_order_history(df_main, partitions, desde, hasta, estados, after=cursors[page_index], limit=page_size)
+    if cursor is not None and len(cursors) == page_index + 1:
+        cursors.append(cursor)
+    return page
+
+@trace_span('render.lista')
+def render_paged_orders(df_main, positions, page_key, categoria, icono, worksheet, headers):
+    """
+    Dibuja solo la página actual de una lista de pedidos, con su paginador.
+    `positions` son las posiciones de los pedidos en df_main, ya en orden de presentación.
+    El cursor de página se guarda en la sesión por lista (pestaña y turno).
+    """
+    if st.session_state.get("bulk_mode"):
+        render_bulk_actions(df_main, positions, page_key, worksheet, headers)
+    start, page_size = render_pager(page_key, len(positions))
+    generation = get_sheet_snapshot_cache(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)['generation']
+    df_page = load_order_details(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, df_main.iloc[positions[start:start + page_size]])
+    st.session_state["visible_orders"].update(df_page['ID_Pedido'])
+
+    # Firmar de una vez las URLs de los adjuntos expandidos de la página antes de dibujarla
+    prefetch_attachment_urls(s3_client, df_page)
+
+    for orden, (idx, row) in enumerate(df_page.iterrows(), start=start + 1):
+        render_order_card(df_main, row, generation, orden, categoria, icono, worksheet, headers)
 
-    # Definir el orden personalizado para 'Tipo_Envio'
-    orden_tipo_envio = {
-        "📍 Pedido Local": 0,
-        "🚚 Pedido Foráneo": 1,
-        "🛠 Garantía": 2,
-        "🔁 Devolución": 3,
-        "📬 Solicitud de guía": 4
+def rerun_order_card():
+    """
+    Vuelve a ejecutar solo la tarjeta del pedido (render_order_card). Solo se llama desde las acciones
+    de la tarjeta, que llegan en una ejecución del fragmento. Si Streamlit juntó el clic con una
+    ejecución completa de la página ya pedida, no se vuelve a ejecutar nada: esa ejecución sigue y
+    la tarjeta muestra los valores nuevos en la siguiente. Las acciones que mueven el pedido a otra
+    pestaña usan st.rerun() en su lugar.
+    """
+    ctx = get_script_run_ctx()
+    if ctx is not None and ctx.fragment_ids_this_run:
+        st.rerun(scope="fragment")
+
+@st.fragment
+def render_order_card(df_main, row, generation, orden, categoria, icono, worksheet, headers):
+    """
+    Tarjeta de un pedido como fragmento: sus acciones y sus adjuntos vuelven a ejecutar solo esta
+    tarjeta (ver rerun_order_card), no toda la página. Al volver a ejecutarse, si la copia
+    cambió desde `generation` (p. ej. por la escritura de la acción), vuelve a leer el pedido por ID_Pedido.
+    Las acciones que cambian qué pedidos muestra cada pestaña (el Estado) vuelven a ejecutar toda la página.
+    """
+    cache = get_sheet_snapshot_cache(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+    if cache['generation'] != generation:
+        # El aviso de cambios (render_live_feed) no vuelve a dibujar la página por esta tarjeta
+        st.session_state["card_generations"][row['ID_Pedido']] = cache['generation']
+        current_row = get_order_row(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, row['ID_Pedido'])
+        if current_row is None:
+            st.markdown("---")
+            st.info(f"El pedido {row['ID_Pedido']} ya no está en la hoja.")
+            return
+        row = current_row
+    mostrar_pedido(df_main, row.name, row, orden, categoria, icono, worksheet, headers)
+
+ESTADO_OPTIONS = ["🔴 Pendiente", "🟡 En Proceso", "✅ Completado", "❌ Cancelado"] # Estados que se pueden asignar
+BULK_ACTIONS = {'estado': "Cambiar estado", 'surtidor': "Asignar surtidor", 'nota': "Agregar nota"}
+
+def _order_cell_update(headers, row_index, col_name, value, id_pedido=None):
+    """Una celda en el formato de batch_update_gsheet_cells."""
+    return {
+        'range': gspread.utils.rowcol_to_a1(row_index, headers.index(col_name) + 1),
+        'values': [[value]],
+        'id_pedido': id_pedido,
     }
-    df['Tipo_Envio_Orden'] = df['Tipo_Envio'].map(orden_tipo_envio)
 
-    # Ordenar por Tipo_Envio_Orden y luego por Fecha_Entrega_dt (ascendente)
-    df_sorted = df.sort_values(by=['Tipo_Envio_Orden', 'Fecha_Entrega_dt'], ascending=[True, True])
+def estado_cell_updates(headers, row_index, new_estado, id_pedido=None, now=None):
+    """
+    Celdas a escribir para cambiar el Estado de un pedido. Si el estado cambia a "Completado",
+    también registra Fecha_Completado (solo la fecha) y Hora_Proceso (fecha y hora completas).
+    """
+    updates = [_order_cell_update(headers, row_index, 'Estado', new_estado, id_pedido)]
+    if new_estado == "✅ Completado":
+        current_time_str = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        updates.append(_order_cell_update(headers, row_index, 'Fecha_Completado', current_time_str.split(' ')[0], id_pedido))
+        updates.append(_order_cell_update(headers, row_index, 'Hora_Proceso', current_time_str, id_pedido))
+    return updates
+
+def bulk_order_updates(df_orders, headers, accion, valor):
+    """
+    Celdas a escribir para aplicar una acción masiva ('estado', 'surtidor' o 'nota') a los pedidos
+    de `df_orders`, cada una con su 'id_pedido'. Se omiten los pedidos que ya tienen ese estado o surtidor.
+    """
+    updates = []
+    now = datetime.now() # La misma hora para todo el lote
+    for id_pedido, row_index, estado, surtidor, notas in zip(
+        df_orders['ID_Pedido'], df_orders['_gsheet_row_index'], df_orders['Estado'], df_orders['Surtidor'], df_orders['Notas']
+    ):
+        if accion == 'estado' and estado != valor:
+            updates += estado_cell_updates(headers, row_index, valor, id_pedido, now)
+        elif accion == 'surtidor' and surtidor != valor:
+            updates.append(_order_cell_update(headers, row_index, 'Surtidor', valor, id_pedido))
+        elif accion == 'nota':
+            updates.append(_order_cell_update(headers, row_index, 'Notas', f"{notas}\n{valor}" if notas else valor, id_pedido))
+    return updates
+
+def _apply_bulk_action(df_main, positions, page_key, worksheet, headers):
+    """
+    Callback del botón de acciones masivas: escribe la acción elegida en todos los pedidos seleccionados
+    con una sola llamada a batch_update_gsheet_cells. Streamlit vuelve a ejecutar la app una sola vez al terminar.
+    """
+    if st.session_state.get(f"bulk_all_{page_key}"):
+        selected_positions = positions
+    else:
+        selected_ids = set(st.session_state.get(f"bulk_sel_{page_key}", []))
+        selected_positions = [pos for pos in positions if df_main['ID_Pedido'].iat[pos] in selected_ids]
+    accion = st.session_state[f"bulk_action_{page_key}"]
+    valor = st.session_state.get(f"bulk_value_{page_key}_{accion}", "")
+    if not len(selected_positions):
+        st.session_state["bulk_results"][page_key] = ('warning', "⚠️ Selecciona al menos un pedido.")
+        return
+    if accion == 'nota' and not valor.strip():
+        st.session_state["bulk_results"][page_key] = ('warning', "⚠️ Escribe la nota que se agregará a los pedidos.")
+        return
 
-    # Eliminar columnas temporales
-    df_sorted = df_sorted.drop(columns=['Fecha_Entrega_dt', 'Tipo_Envio_Orden'])
+    updates = bulk_order_updates(df_main.iloc[selected_positions], headers, accion, valor.strip() if accion == 'nota' else valor)
+    pedidos_actualizados = len({update['id_pedido'] for update in updates})
+    if not updates:
+        st.session_state["bulk_results"][page_key] = ('info', "Los pedidos seleccionados ya tenían ese valor.")
+    elif batch_update_gsheet_cells(worksheet, updates):
+        st.session_state["bulk_results"][page_key] = (
+            'success', f"{BULK_ACTIONS[accion]}: se actualizaron {pedidos_actualizados} pedidos."
+        )
+        st.session_state[f"bulk_sel_{page_key}"] = []
+        st.session_state[f"bulk_all_{page_key}"] = False
+
+@trace_span('render.acciones_masivas')
+def render_bulk_actions(df_main, positions, page_key, worksheet, headers):
+    """Panel de acciones masivas de una lista de pedidos (se muestra con el modo de acciones masivas)."""
+    with st.expander(f"☑️ Acciones masivas ({len(positions)} pedidos en la lista)"):
+        result = st.session_state["bulk_results"].pop(page_key, None)
+        if result:
+            getattr(st, result[0])(result[1])
+
+        todos = st.checkbox(f"Seleccionar todos los pedidos de la lista ({len(positions)})", key=f"bulk_all_{page_key}")
+        ids = df_main['ID_Pedido'].to_numpy()[positions]
+        clientes = dict(zip(ids, df_main['Cliente'].to_numpy()[positions]))
+        st.multiselect(
+            "Pedidos seleccionados",
+            options=list(ids),
+            format_func=lambda id_pedido: f"{id_pedido} - {clientes.get(id_pedido, '')}",
+            key=f"bulk_sel_{page_key}",
+            disabled=todos,
+            placeholder="Elige los pedidos"
+        )
+        col_accion, col_valor = st.columns([1, 2])
+        with col_accion:
+            accion = st.selectbox("Acción", options=list(BULK_ACTIONS), format_func=BULK_ACTIONS.get, key=f"bulk_action_{page_key}")
+        with col_valor:
+            if accion == 'estado':
+                st.selectbox("Nuevo estado", ESTADO_OPTIONS, key=f"bulk_value_{page_key}_estado")
+            elif accion == 'surtidor':
+                surtidores = [""] + sorted(list(df_main['Vendedor_Registro'].unique()))
+                st.selectbox("Surtidor", surtidores, key=f"bulk_value_{page_key}_surtidor")
+            else:
+                st.text_input("Nota a agregar", key=f"bulk_value_{page_key}_nota")
+        st.button(
+            "Aplicar a los pedidos seleccionados", key=f"bulk_apply_{page_key}", type="primary",
+            on_click=_apply_bulk_action, args=(df_main, positions, page_key, worksheet, headers)
+        )
 
-    return df_sorted
+def _remember_radio_selection(key):
+    st.session_state[key] = st.session_state[f"{key}_radio"]
 
+def counted_radio(label, options, format_func, key):
+    """
+    st.radio horizontal cuyas etiquetas llevan conteos. Streamlit trata un radio con otras etiquetas
+    como un widget nuevo y lo regresa a la primera opción, así que la selección se guarda aparte en
+    st.session_state[key] (el widget usa la clave f"{key}_radio").
+    """
+    selected = st.session_state.get(key)
+    return st.radio(
+        label,
+        options=options,
+        index=options.index(selected) if selected in options else 0,
+        format_func=format_func,
+        key=f"{key}_radio",
+        on_change=_remember_radio_selection,
+        args=(key,),
+        horizontal=True,
+        label_visibility="collapsed"
+    )
+
+def render_turno_selector(partitions, key, **filters):
+    """Selector de turno (sustituye a las sub-pestañas) con los conteos del índice; retorna el turno elegido."""
+    return counted_radio(
+        "Turno",
+        options=TURNOS,
+        format_func=lambda t: f"{t} ({count_orders(partitions, turno=t, **filters)})",
+        key=key
+    )
+
+@trace_span('render.tarjeta')
 def mostrar_pedido(df_main, idx, row, orden, categoria, icono, worksheet, headers):
     """
     Muestra un pedido individual con sus detalles y botones de acción.
@@ -444,6 +3381,15 @@ def mostrar_pedido(df_main, idx, row, orden, categoria, icono, worksheet, header
 
     st.markdown(f"---")
     st.markdown(f"#### {icono} Pedido #{orden}: {id_pedido} - Cliente: {cliente} {f'(Folio: {folio_factura})' if folio_factura else ''}")
+
+    # Estado de las escrituras de este pedido en la cola de escritura diferida
+    write_status, write_error = get_gsheet_write_status(id_pedido)
+    if write_status == 'pending':
+        st.caption("⏳ Guardando cambios en Google Sheets...")
+    elif write_status == 'committed':
+        st.caption("✅ Cambios guardados en Google Sheets.")
+    elif write_status == 'error':
+        st.warning(f"⚠️ No se pudieron guardar los cambios de este pedido en Google Sheets: {write_error}")
     
     col1, col2, col3 = st.columns([1, 1, 1])
 
@@ -467,13 +3413,13 @@ def mostrar_pedido(df_main, idx, row, orden, categoria, icono, worksheet, header
     # Sección de Adjuntos
     if adjuntos:
         st.markdown("**Adjuntos del Pedido:**")
-        adjuntos_list = [url.strip() for url in adjuntos.split(',') if url.strip()]
+        adjuntos_list = split_attachment_urls(adjuntos)
         display_attachments(s3_client, adjuntos_list, id_pedido)
 
     if adjuntos_surtido:
         st.markdown("**Adjuntos de Surtido:**")
-        adjuntos_surtido_list = [url.strip() for url in adjuntos_surtido.split(',') if url.strip()]
-        display_attachments(s3_client, adjuntos_surtido_list, id_pedido)
+        adjuntos_surtido_list = split_attachment_urls(adjuntos_surtido)
+        display_attachments(s3_client, adjuntos_surtido_list, id_pedido, seccion="surtido")
 
 
     # --- Acciones de Estatus ---
@@ -494,370 +3440,454 @@ def mostrar_pedido(df_main, idx, row, orden, categoria, icono, worksheet, header
             key=f"surtidor_select_{id_pedido}"
         )
         if st.button("Asignar", key=f"assign_surtidor_btn_{id_pedido}"):
-            if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Surtidor', new_surtidor):
+            if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Surtidor', new_surtidor, id_pedido):
                 st.success(f"Surtidor '{new_surtidor}' asignado al pedido {id_pedido}.")
-                st.rerun()
+                rerun_order_card()
 
     # Actualizar Estado
     with col_acciones[1]:
-        # Opciones de estado permitidas según el estado actual
-        estado_options = [
-            "🔴 Pendiente",
-            "🟡 En Proceso",
-            "✅ Completado",
-            "❌ Cancelado"
-        ]
-        
         try:
-            current_estado_index = estado_options.index(estado)
+            current_estado_index = ESTADO_OPTIONS.index(estado)
         except ValueError:
             current_estado_index = 0 # Default si el estado actual no está en las opciones
 
         new_estado = st.selectbox(
             "Actualizar Estado",
-            options=estado_options,
+            options=ESTADO_OPTIONS,
             index=current_estado_index,
             key=f"estado_select_{id_pedido}"
         )
         if st.button("Actualizar", key=f"update_status_btn_{id_pedido}"):
             updates = []
             if new_estado != estado:
-                updates.append({
-                    'range': gspread.utils.rowcol_to_a1(gsheet_row_index, headers.index('Estado') + 1),
-                    'values': [[new_estado]]
-                })
-                # Si el estado cambia a "Completado", registrar Fecha_Completado y Hora_Proceso
-                if new_estado == "✅ Completado":
-                    current_time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    updates.append({
-                        'range': gspread.utils.rowcol_to_a1(gsheet_row_index, headers.index('Fecha_Completado') + 1),
-                        'values': [[current_time_str.split(' ')[0]]] # Solo la fecha
-                    })
-                    updates.append({
-                        'range': gspread.utils.rowcol_to_a1(gsheet_row_index, headers.index('Hora_Proceso') + 1),
-                        'values': [[current_time_str]] # Fecha y hora completas para Hora_Proceso
-                    })
+                updates = estado_cell_updates(headers, gsheet_row_index, new_estado)
             
-            if batch_update_gsheet_cells(worksheet, updates):
+            if batch_update_gsheet_cells(worksheet, updates, id_pedido):
                 st.success(f"Estado del pedido {id_pedido} actualizado a '{new_estado}'.")
-                st.rerun()
+                if updates:
+                    st.rerun() # El pedido cambia de pestaña: listas y conteos se vuelven a dibujar
+                rerun_order_card()
 
 
     # Actualizar Notas
     with col_acciones[2]:
-        new_notas = st.text_area("Notas Adicionales", value=notas, key=f"notas_text_{id_pedido}", height=50)
+        new_notas = st.text_area("Notas Adicionales", value=notas, key=f"notas_text_{id_pedido}", height=68)
         if st.button("Guardar Notas", key=f"save_notas_btn_{id_pedido}"):
-            if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Notas', new_notas):
+            if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Notas', new_notas, id_pedido):
                 st.success(f"Notas del pedido {id_pedido} actualizadas.")
-                st.rerun()
+                rerun_order_card()
     
-    # Subir Adjunto de Surtido
+    # Subir Adjuntos de Surtido (varios a la vez)
     with col_acciones[3]:
-        uploaded_surtido_file = st.file_uploader(
-            "Adjuntar de Surtido",
-            type=["pdf", "jpg", "jpeg", "png", "xlsx", "docx"],
-            key=f"surtido_file_uploader_{id_pedido}"
-        )
-        if uploaded_surtido_file:
-            if st.button("Subir Adjunto Surtido", key=f"upload_surtido_btn_{id_pedido}"):
-                file_extension = os.path.splitext(uploaded_surtido_file.name)[1]
-                # Crear una clave única para S3
-                s3_key = f"{S3_ATTACHMENT_PREFIX}{id_pedido}/{uploaded_surtido_file.name.replace(' ', '_').replace(file_extension, '')}_{uuid.uuid4().hex[:4]}{file_extension}"
-                success, file_url = upload_file_to_s3(s3_client, S3_BUCKET_NAME, uploaded_surtido_file, s3_key)
-                
-                if success:
-                    # Añadir la nueva URL a la lista existente de adjuntos de surtido
-                    current_adjuntos_surtido = adjuntos_surtido.split(',') if adjuntos_surtido else []
-                    current_adjuntos_surtido.append(file_url)
-                    updated_adjuntos_surtido_str = ','.join([url.strip() for url in current_adjuntos_surtido if url.strip()])
-                    
-                    if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Adjuntos_Surtido', updated_adjuntos_surtido_str):
-                        st.success(f"Adjunto de surtido para pedido {id_pedido} subido exitosamente.")
-                        st.rerun()
-                else:
-                    st.error(f"❌ Falló la subida del adjunto de surtido para pedido {id_pedido}.")
+        render_surtido_uploader(id_pedido, adjuntos_surtido, worksheet, headers, gsheet_row_index)
 
-def upload_file_to_s3(s3_client_instance, bucket_name, file_obj, s3_key):
-    """
-    Sube un archivo a un bucket de S3.
 
-    Args:
-        s3_client: El cliente S3 inicializado.
-        bucket_name: El nombre del bucket S3.
-        file_obj: El objeto de archivo cargado por st.file_uploader.
-        s3_key: La ruta completa y nombre del archivo en S3 (ej. 'pedido_id/filename.pdf').
+# --- Surtido Attachment Uploads ---
+SURTIDO_UPLOAD_TYPES = ["pdf", "jpg", "jpeg", "png", "xlsx", "docx"]
+SURTIDO_UPLOAD_MAX_WORKERS = 4 # Archivos que se suben a la vez (cada uno con get_s3_upload_config())
+UPLOAD_IMAGE_MAX_SIZE = (2560, 2560) # Suficiente para leer una nota o una etiqueta en la foto
+UPLOAD_IMAGE_JPEG_QUALITY = 85
+UPLOAD_IMAGE_MIN_BYTES = 1024 * 1024 # Las imágenes más pequeñas se suben tal cual
+UPLOAD_PROGRESS_POLL_SECONDS = 0.2
+
+def surtido_s3_key(pedido_id, file_name):
+    """Clave única de S3 para un adjunto de surtido (ej. adjuntos_pedidos/PED-1/foto_1a2b.jpg)."""
+    base_name, file_extension = os.path.splitext(file_name.replace(' ', '_'))
+    return f"{S3_ATTACHMENT_PREFIX}{pedido_id}/{base_name}_{uuid.uuid4().hex[:4]}{file_extension}"
 
-    Returns:
-        tuple: (True, URL del archivo) si tiene éxito, (False, None) en caso de error.
+def optimize_upload_image(file_name, content):
     """
+    Reduce a UPLOAD_IMAGE_MAX_SIZE y vuelve a comprimir las fotos grandes antes de subirlas
+    (JPEG si no tienen transparencia, PNG optimizado si la tienen).
+    Retorna (nombre, contenido); si no es una imagen, es pequeña o no se reduce, los originales.
+    """
+    if not Image or not is_image_file(file_name) or len(content) < UPLOAD_IMAGE_MIN_BYTES:
+        return file_name, content
     try:
-        file_obj.seek(0) # Asegúrate de que el puntero del archivo esté al principio
-        s3_client_instance.upload_fileobj(file_obj, bucket_name, s3_key)
-        # Generar la URL pública (o de acceso)
-        file_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
-        return True, file_url
-    except Exception as e:
-        st.error(f"❌ Error al subir el archivo '{s3_key}' a S3: {e}")
-        return False, None
+        with Image.open(io.BytesIO(content)) as image:
+            if getattr(image, 'is_animated', False):
+                return file_name, content
+            optimized = ImageOps.exif_transpose(image) # La orientación queda aplicada a los píxeles
+            optimized.thumbnail(UPLOAD_IMAGE_MAX_SIZE)
+            output = io.BytesIO()
+            base_name = os.path.splitext(file_name)[0]
+            if 'A' in optimized.getbands() or optimized.mode == 'P':
+                optimized.save(output, format='PNG', optimize=True)
+                optimized_name = f"{base_name}.png"
+            else:
+                optimized.convert('RGB').save(output, format='JPEG', quality=UPLOAD_IMAGE_JPEG_QUALITY, optimize=True)
+                optimized_name = f"{base_name}.jpg"
+    except Exception:
+        return file_name, content # Imagen que Pillow no puede leer: se sube sin cambios
+    if output.tell() >= len(content):
+        return file_name, content
+    return optimized_name, output.getvalue()
+
+def upload_surtido_files(s3_client_instance, pedido_id, files, optimize_images=True, progress_callback=None):
+    """
+    Sube en paralelo varios adjuntos de surtido de un pedido: hasta SURTIDO_UPLOAD_MAX_WORKERS archivos
+    a la vez y, en los grandes, sus partes en paralelo (get_s3_upload_config()). Con `optimize_images` las
+    fotos grandes se reducen antes de subirlas. Registra los objetos (y miniaturas) en el índice de
+    adjuntos, que se guarda una sola vez al final.
+    files: Lista de tuplas (nombre, contenido en bytes).
+    progress_callback(bytes enviados, bytes totales) se llama desde el hilo que invoca la función.
+    Retorna (URLs subidas en el orden de `files`, [(nombre, error), ...]). No usa st.*.
+    """
+    sent = {'bytes': 0}
+    sent_lock = threading.Lock()
+
+    def _count_bytes(transferred):
+        with sent_lock: # boto3 llama desde los hilos de cada parte
+            sent['bytes'] += transferred
+
+    def _upload_one(file_name, content):
+        s3_key = surtido_s3_key(pedido_id, file_name)
+        s3_client_instance.upload_fileobj(
+            io.BytesIO(content), S3_BUCKET_NAME, s3_key, Config=get_s3_upload_config(), Callback=_count_bytes
+        )
+        register_attachment_object(s3_client_instance, s3_key, size=len(content), persist=False)
+        if Image and is_image_file(s3_key):
+            try:
+                create_attachment_thumbnail(s3_client_instance, s3_key, content, persist_index=False)
+            except Exception:
+                pass # La miniatura es opcional; la tarea de mantenimiento puede generarla después
+        return f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
+
+    urls, errors = [], []
+    with ThreadPoolExecutor(max_workers=SURTIDO_UPLOAD_MAX_WORKERS) as executor:
+        if optimize_images:
+            files = list(executor.map(lambda file: optimize_upload_image(*file), files))
+        total_bytes = sum(len(content) for _, content in files) or 1
+        futures = [executor.submit(_upload_one, name, content) for name, content in files]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=UPLOAD_PROGRESS_POLL_SECONDS)
+            if progress_callback:
+                progress_callback(min(sent['bytes'], total_bytes), total_bytes)
+    for (file_name, _), future in zip(files, futures):
+        try:
+            urls.append(future.result())
+        except Exception as e:
+            errors.append((file_name, str(e)))
+    save_attachment_index(s3_client_instance)
+    return urls, errors
+
+def render_surtido_uploader(id_pedido, adjuntos_surtido, worksheet, headers, gsheet_row_index):
+    """
+    Subida de varios adjuntos de surtido a la vez, con barra de progreso y una sola escritura de
+    Adjuntos_Surtido con todas las URLs nuevas.
+    """
+    uploaded_files = st.file_uploader(
+        "Adjuntar de Surtido",
+        type=SURTIDO_UPLOAD_TYPES,
+        accept_multiple_files=True,
+        key=f"surtido_file_uploader_{id_pedido}"
+    )
+    if not uploaded_files:
+        return
+    optimize_images = st.checkbox(
+        "Reducir fotos antes de subir", value=True, key=f"surtido_optimize_{id_pedido}",
+        help=f"Las imágenes de más de {UPLOAD_IMAGE_MIN_BYTES // (1024 * 1024)} MB se reducen a {UPLOAD_IMAGE_MAX_SIZE[0]} px"
+    )
+    if not st.button(f"Subir {len(uploaded_files)} Adjunto(s) Surtido", key=f"upload_surtido_btn_{id_pedido}"):
+        return
+
+    progress_bar = st.progress(0.0, text=f"Subiendo {len(uploaded_files)} archivo(s)...")
+    urls, errors = upload_surtido_files(
+        s3_client, id_pedido,
+        [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files],
+        optimize_images=optimize_images,
+        progress_callback=lambda done, total: progress_bar.progress(
+            done / total, text=f"Subiendo {len(uploaded_files)} archivo(s)... {done / (1024 * 1024):.1f} de {total / (1024 * 1024):.1f} MB"
+        )
+    )
+    progress_bar.empty()
+    for file_name, error in errors:
+        st.error(f"❌ Falló la subida del adjunto de surtido '{file_name}' para pedido {id_pedido}: {error}")
+    if urls:
+        # Añadir las nuevas URLs a la lista existente de adjuntos de surtido, en una sola escritura
+        current_adjuntos_surtido = adjuntos_surtido.split(',') if adjuntos_surtido else []
+        current_adjuntos_surtido += urls
+        updated_adjuntos_surtido_str = ','.join([url.strip() for url in current_adjuntos_surtido if url.strip()])
+        if update_gsheet_cell(worksheet, headers, gsheet_row_index, 'Adjuntos_Surtido', updated_adjuntos_surtido_str, id_pedido):
+            st.success(f"{len(urls)} adjunto(s) de surtido para pedido {id_pedido} subidos exitosamente.")
+            if not errors:
+                rerun_order_card()
 
 
 # --- Main Application Logic ---
 df_main, worksheet_main, headers_main = load_data_from_gsheets(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+render_snapshot_status(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+
+# Aviso de cambios: generación de la copia con la que se dibuja esta ejecución y pedidos mostrados
+st.session_state["feed_generation"] = get_sheet_snapshot_cache(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)['generation']
+st.session_state["visible_orders"] = set()
+st.session_state["card_generations"] = {}
+render_live_feed(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME)
+
+# --- Mantenimiento ---
+with st.sidebar.expander("🛠️ Mantenimiento"):
+    if Image and st.button("Generar miniaturas faltantes", key="backfill_thumbnails_btn"):
+        missing_thumbnails = list_attachments_missing_thumbnails(s3_client)
+        if missing_thumbnails:
+            backfill_progress = st.progress(0.0, text=f"Generando {len(missing_thumbnails)} miniaturas...")
+            created, failed = backfill_thumbnails(
+                s3_client, missing_thumbnails,
+                progress_callback=lambda done, total: backfill_progress.progress(done / total)
+            )
+            st.success(f"Miniaturas generadas: {created}. Fallidas: {failed}.")
+        else:
+            st.info("Todas las imágenes ya tienen miniatura.")
+
+    st.divider()
+    archive_days = st.number_input(
+        "Archivar pedidos cerrados hace más de (días)",
+        min_value=7, value=ARCHIVE_AFTER_DAYS, step=1, key="archive_after_days"
+    )
+    if st.button("Archivar pedidos cerrados", key="archive_orders_btn"):
+        st.session_state["archive_confirm_days"] = int(archive_days)
+    # Eliminar filas de la hoja no se puede deshacer desde la app: se pide confirmación
+    if st.session_state.get("archive_confirm_days") == int(archive_days):
+        to_archive = len(closed_orders_to_archive(df_main, int(archive_days))) if not df_main.empty else 0
+        st.warning(
+            f"⚠️ Se moverán unos {to_archive} pedidos a '{ARCHIVE_WORKSHEET_NAME}' y se eliminarán de la hoja de pedidos."
+        )
+        confirm_col, cancel_col = st.columns(2)
+        if cancel_col.button("Cancelar", key="archive_cancel_btn"):
+            st.session_state.pop("archive_confirm_days", None)
+            st.rerun()
+        if confirm_col.button("Confirmar", key="archive_confirm_btn", type="primary"):
+            st.session_state.pop("archive_confirm_days", None)
+            try:
+                with st.spinner("Archivando pedidos completados y cancelados..."):
+                    archived_count = archive_closed_orders(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, int(archive_days))
+                if archived_count:
+                    st.success(f"📦 Se archivaron {archived_count} pedidos en '{ARCHIVE_WORKSHEET_NAME}'.")
+                else:
+                    st.info("No hay pedidos cerrados para archivar.")
+            except Exception as e:
+                st.error(f"❌ Error al archivar los pedidos: {e}")
+
+st.sidebar.selectbox("Pedidos por página", PAGE_SIZE_OPTIONS, index=1, key="page_size")
+st.sidebar.toggle("☑️ Acciones masivas", key="bulk_mode", help="Cambiar el estado, el surtidor o agregar una nota a varios pedidos a la vez")
+render_sheets_quota_notice()
+render_metrics_panel()
 
 if not df_main.empty:
     # FILTRADO Y PROCESAMIENTO DE DATOS
-    df_main['Fecha_Entrega_dt'] = pd.to_datetime(df_main['Fecha_Entrega'], errors='coerce')
-    
-    # Pedidos pendientes (que no están Completados o Cancelados)
-    df_pendientes = df_main[~df_main['Estado'].isin(['✅ Completado', '❌ Cancelado'])].copy()
+    # Todas las vistas leen del índice de particiones de la copia actual, sin volver a filtrar df_main
+    partitions = get_order_partitions(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, df_main)
+    st.session_state["feed_counts"] = partition_counts(partitions)
 
-    # Pedidos completados para el historial (últimos 30 días)
+    # Pedidos completados para el historial (últimos 30 días, en la hoja y en el archivo)
     # Definir la fecha de hace 30 días
     thirty_days_ago = datetime.now() - timedelta(days=30)
-    df_completados_historial = df_main[
-        (df_main['Estado'] == '✅ Completado') & 
-        (df_main['Fecha_Completado'] >= thirty_days_ago) # Filtrar por Fecha_Completado
-    ].sort_values(by='Fecha_Completado', ascending=False).copy()
-    
-    # Filtros para "Pendientes Hoy/Mañana"
-    today = datetime.now().date()
-    tomorrow = today + timedelta(days=1)
-
-    df_pendientes_hoy = df_pendientes[
-        (df_pendientes['Fecha_Entrega_dt'].dt.date == today)
-    ].copy()
-    
-    df_pendientes_manana = df_pendientes[
-        (df_pendientes['Fecha_Entrega_dt'].dt.date == tomorrow)
-    ].copy()
-
-    # Filtros para "Pendientes Pasados"
-    df_pendientes_pasados = df_pendientes[
-        (df_pendientes['Fecha_Entrega_dt'].dt.date < today)
-    ].copy()
-    
-    # Filtros para "En Proceso"
-    df_en_proceso = df_pendientes[
-        (df_pendientes['Estado'] == '🟡 En Proceso')
-    ].copy()
-
-    # Filtros para "Pendientes de Proceso" (Todo lo que no es Completado/Cancelado/En Proceso)
-    df_pendientes_proceso = df_pendientes[
-        ~df_pendientes['Estado'].isin(['🟡 En Proceso'])
-    ].copy()
+    completados_recientes = count_order_history(df_main, partitions, thirty_days_ago, datetime.now() + timedelta(days=1))
 
-    # Define las etiquetas de las pestañas antes de pasarlas a st.tabs
+    # Define las etiquetas de las pestañas
     tab_labels = [
-        f"⏳ Pendientes Hoy ({len(df_pendientes_hoy)})",
-        f"➡️ Pendientes Mañana ({len(df_pendientes_manana)})",
-        f"⏰ Pendientes Pasados ({len(df_pendientes_pasados)})",
-        f"⚙️ En Proceso ({len(df_en_proceso)})",
-        f"📦 Pendientes de Proceso ({len(df_pendientes_proceso)})",
-        f"✅ Historial Completados ({len(df_completados_historial)})"
+        f"⏳ Pendientes Hoy ({count_orders(partitions, estados=ESTADOS_ACTIVOS, fechas=['hoy'])})",
+        f"➡️ Pendientes Mañana ({count_orders(partitions, estados=ESTADOS_ACTIVOS, fechas=['manana'])})",
+        f"⏰ Pendientes Pasados ({count_orders(partitions, estados=ESTADOS_ACTIVOS, fechas=['pasado'])})",
+        f"⚙️ En Proceso ({count_orders(partitions, estados=['en_proceso'])})",
+        f"📦 Pendientes de Proceso ({count_orders(partitions, estados=['pendiente'])})",
+        f"✅ Historial Completados ({completados_recientes})"
     ]
 
-    # Initialize active_main_tab_index if not already set
-    if "active_main_tab_index" not in st.session_state:
-        st.session_state.active_main_tab_index = 0
-
-    # Define the on_change callback. It needs to be defined BEFORE st.tabs is called.
-    def update_main_tab_index():
-        # When a tab is clicked, st.session_state.main_tabs_app_a will hold the LABEL of the clicked tab.
-        # We find its index in our `tab_labels` list.
-        try:
-            st.session_state.active_main_tab_index = tab_labels.index(st.session_state.main_tabs_app_a)
-        except ValueError:
-            # Fallback in case the label isn't found (shouldn't happen with correct logic)
-            st.session_state.active_main_tab_index = 0
-
-    # Create the tabs. `st.tabs` returns a list of DeltaGenerator objects.
-    # `index` sets the initially selected tab.
-    # `on_change` updates the `active_main_tab_index` when a tab is clicked.
-    main_tabs_objects = st.tabs(tab_labels, key="main_tabs_app_a",
-                                 index=st.session_state.active_main_tab_index,
-                                 on_change=update_main_tab_index)
-
-    # Ahora usamos main_tabs_objects para controlar qué pestaña se muestra
-    with main_tabs_objects[0]: # ⏳ Pendientes Hoy
-        st.markdown("### Pedidos Pendientes para HOY")
+    # Selector de pestaña: a diferencia de st.tabs, permite dibujar solo la pestaña seleccionada.
+    # El índice elegido se conserva en st.session_state["active_main_tab_index"].
+    active_tab = counted_radio(
+        "Vista",
+        options=list(range(len(tab_labels))),
+        format_func=lambda i: tab_labels[i],
+        key="active_main_tab_index"
+    )
+
+    # Búsqueda de pedidos por cliente, folio, ID o palabras de notas/comentario
+    busqueda = st.text_input(
+        "🔍 Buscar pedido",
+        placeholder="Cliente, folio, ID del pedido o palabras de las notas o el comentario",
+        key="busqueda_pedidos"
+    )
+    if busqueda.strip():
+        pedidos_encontrados = search_orders(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME, df_main, busqueda)
+        st.markdown(f"### Resultados de la búsqueda ({len(pedidos_encontrados)})")
+        if len(pedidos_encontrados):
+            render_paged_orders(df_main, pedidos_encontrados, "busqueda", "Búsqueda", "🔍",
+                                worksheet_main, headers_main)
+        else:
+            st.info(f"No se encontraron pedidos para '{busqueda}'.")
+        # Mientras hay búsqueda no se dibuja la pestaña: sus tarjetas usarían las mismas claves de widgets
+        active_tab = None
+
+    if active_tab in (0, 1): # ⏳ Pendientes Hoy / ➡️ Pendientes Mañana
+        dia, fecha_bucket = ("HOY", 'hoy') if active_tab == 0 else ("MAÑANA", 'manana')
+        nombre_dia = "Hoy" if active_tab == 0 else "Mañana"
+        st.markdown(f"### Pedidos Pendientes para {dia}")
         
-        # Filtrar por Tipo de Envío para "Pendientes Hoy"
-        tipo_envio_hoy = st.selectbox(
-            "Filtrar por Tipo de Envío (Hoy)",
-            ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"],
-            key="filtro_tipo_envio_hoy"
+        # Filtrar por Tipo de Envío
+        tipo_envio_filtro = st.selectbox(
+            f"Filtrar por Tipo de Envío ({nombre_dia})",
+            TIPO_ENVIO_FILTER_OPTIONS,
+            key=f"filtro_tipo_envio_{fecha_bucket}"
         )
-        if tipo_envio_hoy != "Todos":
-            df_pendientes_hoy = df_pendientes_hoy[df_pendientes_hoy['Tipo_Envio'] == tipo_envio_hoy].copy()
+        filtros = {
+            'estados': ESTADOS_ACTIVOS,
+            'fechas': [fecha_bucket],
+            'tipo_envio': None if tipo_envio_filtro == "Todos" else tipo_envio_filtro,
+        }
 
-        if not df_pendientes_hoy.empty:
-            df_pendientes_hoy_sorted = ordenar_pedidos_custom(df_pendientes_hoy)
+        if count_orders(partitions, **filtros):
             # Organizar por Turno
-            turnos_hoy = ["☀️ Local Mañana", "🌙 Local Tarde", "🌵 Saltillo", "� Pasa a Bodega", "N/A"] # N/A para foráneos/garantías etc.
-            tab_titles_hoy = [f"{t} ({len(df_pendientes_hoy_sorted[df_pendientes_hoy_sorted['Turno'] == t])})" for t in turnos_hoy]
-            tabs_hoy = st.tabs(tab_titles_hoy, key="tabs_pendientes_hoy") # Usar un key único
-
-            for i, turno_val in enumerate(turnos_hoy):
-                with tabs_hoy[i]:
-                    pedidos_por_turno = df_pendientes_hoy_sorted[df_pendientes_hoy_sorted['Turno'] == turno_val]
-                    if not pedidos_por_turno.empty:
-                        for orden, (idx, row) in enumerate(pedidos_por_turno.iterrows(), start=1):
-                            icono = "☀️" if "Mañana" in turno_val else "🌙" if "Tarde" in turno_val else "🌵" if "Saltillo" in turno_val else "📦" if "Bodega" in turno_val else "🚚" # Icono más genérico para N/A
-                            mostrar_pedido(df_main, idx, row, orden, f"Pendientes Hoy - {turno_val}", icono, worksheet_main, headers_main)
-                    else:
-                        st.info(f"No hay pedidos pendientes para HOY en el turno: {turno_val}")
-        else:
-            st.info("No hay pedidos pendientes para HOY.")
-
-    with main_tabs_objects[1]: # ➡️ Pendientes Mañana
-        st.markdown("### Pedidos Pendientes para MAÑANA")
-        
-        # Filtrar por Tipo de Envío para "Pendientes Mañana"
-        tipo_envio_manana = st.selectbox(
-            "Filtrar por Tipo de Envío (Mañana)",
-            ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"],
-            key="filtro_tipo_envio_manana"
-        )
-        if tipo_envio_manana != "Todos":
-            df_pendientes_manana = df_pendientes_manana[df_pendientes_manana['Tipo_Envio'] == tipo_envio_manana].copy()
-
-        if not df_pendientes_manana.empty:
-            df_pendientes_manana_sorted = ordenar_pedidos_custom(df_pendientes_manana)
-            turnos_manana = ["☀️ Local Mañana", "🌙 Local Tarde", "🌵 Saltillo", "📦 Pasa a Bodega", "N/A"] # N/A para foráneos/garantías etc.
-            tab_titles_manana = [f"{t} ({len(df_pendientes_manana_sorted[df_pendientes_manana_sorted['Turno'] == t])})" for t in turnos_manana]
-            tabs_manana = st.tabs(tab_titles_manana, key="tabs_pendientes_manana") # Usar un key único
-
-            for i, turno_val in enumerate(turnos_manana):
-                with tabs_manana[i]:
-                    pedidos_por_turno = df_pendientes_manana_sorted[df_pendientes_manana_sorted['Turno'] == turno_val]
-                    if not pedidos_por_turno.empty:
-                        for orden, (idx, row) in enumerate(pedidos_por_turno.iterrows(), start=1):
-                            icono = "☀️" if "Mañana" in turno_val else "🌙" if "Tarde" in turno_val else "🌵" if "Saltillo" in turno_val else "📦" if "Bodega" in turno_val else "🚚"
-                            mostrar_pedido(df_main, idx, row, orden, f"Pendientes Mañana - {turno_val}", icono, worksheet_main, headers_main)
-                    else:
-                        st.info(f"No hay pedidos pendientes para MAÑANA en el turno: {turno_val}")
+            turno_val = render_turno_selector(partitions, key=f"turno_pendientes_{fecha_bucket}", **filtros)
+            pedidos_por_turno = select_order_positions(partitions, turno=turno_val, **filtros)
+            if len(pedidos_por_turno):
+                render_paged_orders(df_main, pedidos_por_turno, f"{fecha_bucket}_{turno_val}", f"Pendientes {nombre_dia} - {turno_val}",
+                                    icono_turno(turno_val), worksheet_main, headers_main)
+            else:
+                st.info(f"No hay pedidos pendientes para {dia} en el turno: {turno_val}")
         else:
-            st.info("No hay pedidos pendientes para MAÑANA.")
+            st.info(f"No hay pedidos pendientes para {dia}.")
 
-    with main_tabs_objects[2]: # ⏰ Pendientes Pasados
+    elif active_tab == 2: # ⏰ Pendientes Pasados
         st.markdown("### Pedidos Pendientes con Fecha de Entrega Pasada")
         
         # Filtrar por Tipo de Envío para "Pendientes Pasados"
         tipo_envio_pasados = st.selectbox(
             "Filtrar por Tipo de Envío (Pasados)",
-            ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"],
+            TIPO_ENVIO_FILTER_OPTIONS,
             key="filtro_tipo_envio_pasados"
         )
-        if tipo_envio_pasados != "Todos":
-            df_pendientes_pasados = df_pendientes_pasados[df_pendientes_pasados['Tipo_Envio'] == tipo_envio_pasados].copy()
+        pedidos_pasados = select_order_positions(
+            partitions, estados=ESTADOS_ACTIVOS, fechas=['pasado'],
+            tipo_envio=None if tipo_envio_pasados == "Todos" else tipo_envio_pasados
+        )
 
-        if not df_pendientes_pasados.empty:
-            df_pendientes_pasados_sorted = ordenar_pedidos_custom(df_pendientes_pasados)
-            for orden, (idx, row) in enumerate(df_pendientes_pasados_sorted.iterrows(), start=1):
-                mostrar_pedido(df_main, idx, row, orden, "Pendientes Pasados", "⏰", worksheet_main, headers_main)
+        if len(pedidos_pasados):
+            render_paged_orders(df_main, pedidos_pasados, "pasados", "Pendientes Pasados", "⏰",
+                                worksheet_main, headers_main)
         else:
             st.info("No hay pedidos pendientes con fecha de entrega pasada.")
 
-    with main_tabs_objects[3]: # ⚙️ En Proceso
+    elif active_tab == 3: # ⚙️ En Proceso
         st.markdown("### Pedidos Actualmente EN PROCESO")
         
         # Filtrar por Tipo de Envío para "En Proceso"
         tipo_envio_en_proceso = st.selectbox(
             "Filtrar por Tipo de Envío (En Proceso)",
-            ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"],
+            TIPO_ENVIO_FILTER_OPTIONS,
             key="filtro_tipo_envio_en_proceso"
         )
-        if tipo_envio_en_proceso != "Todos":
-            df_en_proceso = df_en_proceso[df_en_proceso['Tipo_Envio'] == tipo_envio_en_proceso].copy()
+        pedidos_en_proceso = select_order_positions(
+            partitions, estados=['en_proceso'],
+            tipo_envio=None if tipo_envio_en_proceso == "Todos" else tipo_envio_en_proceso
+        )
 
-        if not df_en_proceso.empty:
-            df_en_proceso_sorted = ordenar_pedidos_custom(df_en_proceso)
-            for orden, (idx, row) in enumerate(df_en_proceso_sorted.iterrows(), start=1):
-                mostrar_pedido(df_main, idx, row, orden, "En Proceso", "⚙️", worksheet_main, headers_main)
+        if len(pedidos_en_proceso):
+            render_paged_orders(df_main, pedidos_en_proceso, "en_proceso", "En Proceso", "⚙️",
+                                worksheet_main, headers_main)
         else:
             st.info("No hay pedidos actualmente en proceso.")
 
-    with main_tabs_objects[4]: # 📦 Pendientes de Proceso (Todo lo demás)
+    elif active_tab == 4: # 📦 Pendientes de Proceso (Todo lo demás)
         st.markdown("### Pedidos Pendientes de Ser Procesados (General)")
         st.info("Esta sección muestra todos los pedidos que no están 'Completados', 'Cancelados' ni 'En Proceso'.")
 
         # Filtrar por Tipo de Envío para "Pendientes de Proceso"
         tipo_envio_pendientes_proceso = st.selectbox(
             "Filtrar por Tipo de Envío (Pendientes de Proceso)",
-            ["Todos", "📍 Pedido Local", "🚚 Pedido Foráneo", "🛠 Garantía", "🔁 Devolución", "📬 Solicitud de guía"],
+            TIPO_ENVIO_FILTER_OPTIONS,
             key="filtro_tipo_envio_pendientes_proceso"
         )
-        if tipo_envio_pendientes_proceso != "Todos":
-            df_pendientes_proceso = df_pendientes_proceso[df_pendientes_proceso['Tipo_Envio'] == tipo_envio_pendientes_proceso].copy()
+        tipos_mostrados = (
+            TIPO_ENVIO_FILTER_OPTIONS[1:] if tipo_envio_pendientes_proceso == "Todos" else [tipo_envio_pendientes_proceso]
+        )
 
-        if not df_pendientes_proceso.empty:
-            df_pendientes_proceso_sorted = ordenar_pedidos_custom(df_pendientes_proceso)
+        if count_orders(partitions, estados=['pendiente']):
             # Mostrar primero los pedidos locales por turno
             st.subheader("Pedidos Locales")
-            turnos_proceso = ["☀️ Local Mañana", "🌙 Local Tarde", "🌵 Saltillo", "📦 Pasa a Bodega", "N/A"]
-            
-            for turno_val in turnos_proceso:
-                pedidos_local_turno = df_pendientes_proceso_sorted[
-                    (df_pendientes_proceso_sorted['Tipo_Envio'] == "📍 Pedido Local") & 
-                    (df_pendientes_proceso_sorted['Turno'] == turno_val)
-                ].copy()
-                
-                if not pedidos_local_turno.empty:
+            filtros_locales = {'estados': ['pendiente'], 'tipo_envio': "📍 Pedido Local"}
+            if "📍 Pedido Local" in tipos_mostrados and count_orders(partitions, **filtros_locales):
+                turno_val = render_turno_selector(partitions, key="turno_pendientes_proceso", **filtros_locales)
+                pedidos_local_turno = select_order_positions(partitions, turno=turno_val, **filtros_locales)
+                if len(pedidos_local_turno):
                     st.markdown(f"##### {turno_val} ({len(pedidos_local_turno)} pedidos)")
-                    for orden, (idx, row) in enumerate(pedidos_local_turno.iterrows(), start=1):
-                        icono = "☀️" if "Mañana" in turno_val else "🌙" if "Tarde" in turno_val else "🌵" if "Saltillo" in turno_val else "📦" if "Bodega" in turno_val else ""
-                        mostrar_pedido(df_main, idx, row, orden, "Pedido Local", icono, worksheet_main, headers_main)
-                # else:
-                #    st.info(f"No hay pedidos locales pendientes para el turno: {turno_val}")
+                    render_paged_orders(df_main, pedidos_local_turno, f"proceso_local_{turno_val}", "Pedido Local",
+                                        icono_turno(turno_val, default=""), worksheet_main, headers_main)
+                else:
+                    st.info(f"No hay pedidos locales pendientes para el turno: {turno_val}")
+            else:
+                st.info("No hay pedidos locales pendientes.")
 
             # Luego, el resto de los tipos de envío (Foráneos, Garantías, Devoluciones, Solicitudes de guía)
             st.subheader("Otros Tipos de Envío")
-            
-            foraneo_display = df_pendientes_proceso_sorted[(df_pendientes_proceso_sorted["Tipo_Envio"] == "🚚 Pedido Foráneo")].copy()
-            if not foraneo_display.empty:
-                for orden, (idx, row) in enumerate(foraneo_display.iterrows(), start=1):
-                    mostrar_pedido(df_main, idx, row, orden, "Pedido Foráneo", "🚚", worksheet_main, headers_main)
-            else:
-                st.info("No hay pedidos foráneos pendientes.")
-
-            garantias_display = df_pendientes_proceso_sorted[(df_pendientes_proceso_sorted["Tipo_Envio"] == "🛠 Garantía")].copy()
-            if not garantias_display.empty:
-                for orden, (idx, row) in enumerate(garantias_display.iterrows(), start=1):
-                    mostrar_pedido(df_main, idx, row, orden, "Garantía", "🛠", worksheet_main, headers_main)
-            else:
-                st.info("No hay garantías pendientes.")
-            
-            devoluciones_display = df_pendientes_proceso_sorted[(df_pendientes_proceso_sorted["Tipo_Envio"] == "🔁 Devolución")].copy()
-            if not devoluciones_display.empty:
-                for orden, (idx, row) in enumerate(devoluciones_display.iterrows(), start=1):
-                    mostrar_pedido(df_main, idx, row, orden, "Devolución", "🔁", worksheet_main, headers_main)
-            else:
-                st.info("No hay devoluciones pendientes.")
 
-            solicitudes_display = df_pendientes_proceso_sorted[(df_pendientes_proceso_sorted["Tipo_Envio"] == "📬 Solicitud de guía")].copy()
-            if not solicitudes_display.empty:
-                for orden, (idx, row) in enumerate(solicitudes_display.iterrows(), start=1):
-                    mostrar_pedido(df_main, idx, row, orden, "Solicitud de Guía", "📬", worksheet_main, headers_main)
-            else:
-                st.info("No hay solicitudes de guía.")
+            otros_tipos_envio = [
+                ("🚚 Pedido Foráneo", "Pedido Foráneo", "🚚", "No hay pedidos foráneos pendientes."),
+                ("🛠 Garantía", "Garantía", "🛠", "No hay garantías pendientes."),
+                ("🔁 Devolución", "Devolución", "🔁", "No hay devoluciones pendientes."),
+                ("📬 Solicitud de guía", "Solicitud de Guía", "📬", "No hay solicitudes de guía."),
+            ]
+            for tipo_envio_val, categoria, icono, mensaje_vacio in otros_tipos_envio:
+                pedidos_tipo = (
+                    select_order_positions(partitions, estados=['pendiente'], tipo_envio=tipo_envio_val)
+                    if tipo_envio_val in tipos_mostrados else []
+                )
+                if len(pedidos_tipo):
+                    render_paged_orders(df_main, pedidos_tipo, f"proceso_{categoria}", categoria, icono,
+                                        worksheet_main, headers_main)
+                else:
+                    st.info(mensaje_vacio)
 
         else:
             st.info("No hay pedidos pendientes de proceso.")
 
-    with main_tabs_objects[5]: # ✅ Historial Completados
+    elif active_tab == 5: # ✅ Historial Completados
         st.markdown("### Historial de Pedidos Completados")
-        if not df_completados_historial.empty:
-            st.dataframe(
-                df_completados_historial[[
-                    'ID_Pedido', 'Folio_Factura', 'Cliente', 'Estado', 'Vendedor_Registro',
-                    'Tipo_Envio', 'Fecha_Entrega', 'Fecha_Completado', 'Notas', 'Modificacion_Surtido',
-                    'Adjuntos', 'Adjuntos_Surtido', 'Turno'
-                ]].head(50),
-                use_container_width=True, hide_index=True
+        try:
+            # Traer los pedidos archivados por otros procesos (como mucho cada ARCHIVE_STORE_REFRESH_SECONDS)
+            refresh_archive_store(get_snapshot_worksheet(GOOGLE_SHEET_ID, GOOGLE_SHEET_WORKSHEET_NAME).spreadsheet)
+        except Exception as e:
+            st.warning(f"⚠️ No se pudo actualizar el archivo de pedidos desde Google Sheets: {e}")
+
+        col_rango, col_cancelados = st.columns([2, 1])
+        with col_rango:
+            hoy = datetime.now().date()
+            rango_historial = st.date_input(
+                "Fecha de cierre",
+                value=(hoy - timedelta(days=30), hoy),
+                max_value=hoy,
+                key="historial_rango"
             )
-            st.info("Mostrando los 50 pedidos completados más recientes. Puedes ajustar este límite si es necesario.")
+        with col_cancelados:
+            incluir_cancelados = st.checkbox("Incluir cancelados", key="historial_incluir_cancelados")
+
+        if len(rango_historial) == 2:
+            desde = datetime.combine(rango_historial[0], datetime.min.time())
+            hasta = datetime.combine(rango_historial[1], datetime.min.time()) + timedelta(days=1)
+            estados_historial = ('completado', 'cancelado') if incluir_cancelados else ('completado',)
+            total_historial = count_order_history(df_main, partitions, desde, hasta, estados_historial)
+            if total_historial:
+                start, page_size = render_pager("historial", total_historial)
+                st.dataframe(
+                    history_page(df_main, partitions, desde, hasta, estados_historial, start // page_size, page_size),
+                    use_container_width=True, hide_index=True
+                )
+                render_history_export(df_main, partitions, desde, hasta, estados_historial)
+            else:
+                st.info("No hay pedidos completados en el historial para ese rango de fechas.")
         else:
-            st.info("No hay pedidos completados en el historial.")
+            st.info("Selecciona la fecha final del rango.")
 
 else:
     st.info("No se encontraron datos de pedidos en la hoja de Google Sheets. Asegúrate de que los datos se están subiendo correctamente y que el ID de la hoja y el nombre de la pestaña son correctos.")
+
+# El índice de adjuntos lo construye y actualiza un hilo en segundo plano: un arranque en frío
+# no espera a importar boto3 ni a listar S3 para mostrar las listas
+attachment_index_state = start_attachment_index_refresher(s3_client)
+if attachment_index_state['error'] is not None:
+    st.warning(f"⚠️ Advertencia: Error al actualizar el índice de adjuntos de S3: {attachment_index_state['error']}")
+elif not attachment_index_state['ready']:
+    st.info("⏳ Indexando los adjuntos de S3; aparecerán en los pedidos en unos momentos.")
+
+end_rerun_trace()
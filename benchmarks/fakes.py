@@ -0,0 +1,315 @@
+"""
+Sustitutos locales de Google Sheets (gspread) y S3 (boto3) para medir la app sin red.
+
+Implementan solo las llamadas que usa la app y cuentan cada una en `API_CALLS`, para reportar
+cuántas solicitudes haría cada operación contra las APIs reales. Con `latency` (segundos) cada
+llamada espera ese tiempo para simular la red. Como en gspread, cada llamada a Google Sheets pasa
+por FakeGspreadClient.request con la ruta de la API real, así que la instrumentación y el
+regulador de cuota de la app (data_access.instrument_gspread_client) también se miden.
+"""
+import hashlib
+import io
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import quote
+
+import gspread
+import gspread.utils
+
+API_CALLS = Counter()
+_api_calls_lock = threading.Lock()
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+
+def _api_call(name, latency):
+    with _api_calls_lock:
+        API_CALLS[name] += 1
+    if latency:
+        time.sleep(latency)
+
+def _parse_a1_range(range_name, row_count, col_count):
+    """Convierte un rango A1 ('A2:C', 'B5', '1:1', 'A2:R10') en (fila1, fila2, col1, col2) en base 1."""
+    if '!' in range_name:
+        range_name = range_name.split('!', 1)[1]
+    start_col, start_row, end_col, end_row = re.fullmatch(
+        r'([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?', range_name
+    ).groups()
+    if end_col is None and end_row is None:
+        end_col, end_row = start_col, start_row
+
+    def column_number(letters, default):
+        return gspread.utils.a1_to_rowcol(f"{letters}1")[1] if letters else default
+
+    return (
+        int(start_row) if start_row else 1,
+        int(end_row) if end_row else row_count,
+        column_number(start_col, 1),
+        column_number(end_col, col_count),
+    )
+
+class FakeWorksheet:
+    """Hoja en memoria: una lista de filas (listas de cadenas), como la devuelve get_all_values()."""
+
+    def __init__(self, spreadsheet, title, rows, latency=0.0):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = [list(row) for row in rows]
+        self.id = len(spreadsheet.worksheets_)
+        self.latency = latency
+
+    def _col_count(self):
+        return max((len(row) for row in self.rows), default=0)
+
+    def _read(self, range_name):
+        # Igual que la API: sin filas ni celdas vacías al final
+        first_row, last_row, first_col, last_col = _parse_a1_range(range_name, len(self.rows), self._col_count())
+        values = []
+        for row in self.rows[first_row - 1:last_row]:
+            cells = row[first_col - 1:last_col]
+            while cells and cells[-1] == '':
+                cells = cells[:-1]
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def _write(self, row_index, col_index, value):
+        while len(self.rows) < row_index:
+            self.rows.append([])
+        row = self.rows[row_index - 1]
+        row.extend([''] * (col_index - len(row)))
+        row[col_index - 1] = str(value)
+
+    def get_all_values(self):
+        self.spreadsheet._request('sheets.get_all_values', 'get', f"/values/{quote(self.title)}")
+        col_count = self._col_count()
+        return [row + [''] * (col_count - len(row)) for row in self.rows]
+
+    def batch_get(self, ranges, **kwargs):
+        self.spreadsheet._request('sheets.batch_get', 'get', '/values:batchGet')
+        return [self._read(range_name) for range_name in ranges]
+
+    def get_values(self, range_name=None, **kwargs):
+        self.spreadsheet._request('sheets.get_values', 'get', f"/values/{quote(range_name or self.title)}")
+        return self._read(range_name) if range_name else self.get_all_values()
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet._request('sheets.update_cell', 'put', f"/values/{gspread.utils.rowcol_to_a1(row, col)}")
+        self._write(row, col, value)
+
+    def update_cells(self, cell_list, value_input_option='RAW'):
+        self.spreadsheet._request('sheets.update_cells', 'put', f"/values/{quote(self.title)}")
+        for cell in cell_list:
+            self._write(cell.row, cell.col, cell.value)
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        self.spreadsheet._request('sheets.append_rows', 'post', f"/values/{quote(self.title)}:append")
+        self.rows.extend([str(value) for value in row] for row in values)
+
+    def add_cols(self, cols):
+        self.spreadsheet._request('sheets.add_cols', 'post', ':batchUpdate')
+
+    def delete_rows(self, start_index, end_index=None):
+        self.spreadsheet._request('sheets.delete_rows', 'post', ':batchUpdate')
+        del self.rows[start_index - 1:end_index or start_index]
+
+class FakeSpreadsheet:
+    def __init__(self, spreadsheet_id, worksheets, latency=0.0):
+        self.id = spreadsheet_id
+        self.latency = latency
+        self.client = None # Lo asigna FakeGspreadClient
+        self.worksheets_ = {}
+        for title, rows in worksheets.items():
+            self.worksheets_[title] = FakeWorksheet(self, title, rows, latency)
+
+    def _request(self, name, method, path):
+        """Cuenta la llamada `name` y la envía por el cliente con la ruta de la API real."""
+        _api_call(name, 0)
+        if self.client is None:
+            time.sleep(self.latency)
+            return
+        self.client.request(method, f"{SHEETS_API_URL}/{self.id}{path}")
+
+    def _worksheet_for_range(self, range_name):
+        title, a1_range = range_name.split('!', 1)
+        return self.worksheets_[title.strip("'")], a1_range
+
+    def worksheet(self, title):
+        self._request('sheets.worksheet', 'get', '')
+        if title not in self.worksheets_:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets_[title]
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self._request('sheets.add_worksheet', 'post', ':batchUpdate')
+        self.worksheets_[title] = FakeWorksheet(self, title, [], self.latency)
+        return self.worksheets_[title]
+
+    def values_batch_get(self, ranges, params=None):
+        self._request('sheets.values_batch_get', 'get', '/values:batchGet')
+        value_ranges = []
+        for range_name in ranges:
+            worksheet, a1_range = self._worksheet_for_range(range_name)
+            value_ranges.append({'range': range_name, 'values': worksheet._read(a1_range)})
+        return {'valueRanges': value_ranges}
+
+    def values_batch_update(self, body=None, params=None):
+        self._request('sheets.values_batch_update', 'post', '/values:batchUpdate')
+        for item in body['data']:
+            worksheet, a1_range = self._worksheet_for_range(item['range'])
+            first_row, first_col = gspread.utils.a1_to_rowcol(a1_range.split(':')[0])
+            for row_offset, row_values in enumerate(item['values']):
+                for col_offset, value in enumerate(row_values):
+                    worksheet._write(first_row + row_offset, first_col + col_offset, value)
+        return {}
+
+    def batch_update(self, body):
+        self._request('sheets.batch_update', 'post', ':batchUpdate')
+        for request in body['requests']:
+            if 'deleteDimension' in request:
+                dimension_range = request['deleteDimension']['range']
+                worksheet = next(w for w in self.worksheets_.values() if w.id == dimension_range['sheetId'])
+                del worksheet.rows[dimension_range['startIndex']:dimension_range['endIndex']]
+        return {}
+
+class _FakeResponse:
+    status_code = 200
+
+    def json(self):
+        return {}
+
+class FakeGspreadClient:
+    def __init__(self, spreadsheets, latency=0.0):
+        self.spreadsheets = {spreadsheet.id: spreadsheet for spreadsheet in spreadsheets}
+        self.latency = latency
+        for spreadsheet in spreadsheets:
+            spreadsheet.client = self
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        """Solicitud HTTP, como gspread.Client.request: solo simula la latencia de la red."""
+        if self.latency:
+            time.sleep(self.latency)
+        return _FakeResponse()
+
+    def open_by_key(self, key):
+        _api_call('sheets.open_by_key', 0)
+        self.request('get', f"{SHEETS_API_URL}/{key}")
+        return self.spreadsheets[key]
+
+class _StreamingBody:
+    def __init__(self, content):
+        self._stream = io.BytesIO(content)
+
+    def read(self, amt=-1):
+        return self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        pass
+
+class _FakeS3Events:
+    """Registro de eventos de botocore (client.meta.events): la app mide cada operación con before-call/after-call."""
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self.handlers:
+            if event_name == name or event_name.startswith(f"{name}."):
+                handler(event_name=event_name, **kwargs)
+
+class FakeS3Client:
+    """Bucket en memoria con la parte de la API de boto3 que usa la app."""
+
+    def __init__(self, latency=0.0):
+        self.objects = {}
+        self.latency = latency
+        self.meta = SimpleNamespace(events=_FakeS3Events())
+
+    def _call(self, name, operation, http_method):
+        """Cuenta la llamada `name` y emite los eventos de botocore de la operación, como un cliente real."""
+        model = SimpleNamespace(name=operation, http={'method': http_method})
+        context = {}
+        self.meta.events.emit(f"before-call.s3.{operation}", model=model, params={}, context=context)
+        _api_call(name, self.latency)
+        self.meta.events.emit(
+            f"after-call.s3.{operation}", model=model, context=context, http_response=_FakeResponse(), parsed={}
+        )
+
+    def put_object_bytes(self, key, content):
+        """Agrega un objeto sin contar una llamada (para preparar los datos del benchmark)."""
+        self.objects[key] = {
+            'Body': content,
+            'ETag': f'"{hashlib.md5(content).hexdigest()}"',
+            'LastModified': datetime.now().astimezone(),
+            'Size': len(content),
+        }
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Callback=None, Config=None):
+        self._call('s3.upload_fileobj', 'PutObject', 'PUT')
+        content = fileobj.read()
+        self.put_object_bytes(key, content)
+        if Callback:
+            Callback(len(content))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('s3.put_object', 'PutObject', 'PUT')
+        self.put_object_bytes(Key, Body if isinstance(Body, bytes) else Body.read())
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        _api_call('s3.generate_presigned_url', 0) # Se firma localmente, sin red
+        return f"https://fake-s3.local/{Params['Key']}?firma={uuid.uuid4().hex[:8]}&expira={ExpiresIn}"
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, StartAfter='', ContinuationToken=None, **kwargs):
+        self._call('s3.list_objects_v2', 'ListObjectsV2', 'GET')
+        keys = sorted(key for key in self.objects if key.startswith(Prefix) and key > StartAfter)
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = keys[start:start + MaxKeys]
+        response = {'KeyCount': len(page), 'IsTruncated': start + MaxKeys < len(keys)}
+        if page:
+            response['Contents'] = [
+                {key_name: self.objects[key][key_name] for key_name in ('ETag', 'LastModified', 'Size')} | {'Key': key}
+                for key in page
+            ]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class _Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    page = client.list_objects_v2(ContinuationToken=token, **kwargs)
+                    yield page
+                    if not page['IsTruncated']:
+                        break
+                    token = page['NextContinuationToken']
+
+        return _Paginator()
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('s3.get_object', 'GetObject', 'GET')
+        obj = self.objects[Key]
+        return {'Body': _StreamingBody(obj['Body']), 'ETag': obj['ETag'], 'ContentLength': obj['Size']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('s3.head_object', 'HeadObject', 'HEAD')
+        obj = self.objects[Key]
+        return {'ETag': obj['ETag'], 'ContentLength': obj['Size'], 'LastModified': obj['LastModified']}
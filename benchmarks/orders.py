@@ -0,0 +1,89 @@
+"""
+Generador de pedidos sintéticos para los benchmarks, con proporciones parecidas a las reales:
+la mayoría de los pedidos viejos ya están completados, los recientes siguen pendientes o en
+proceso, los locales llevan turno y una parte tiene adjuntos en S3.
+"""
+import random
+from datetime import datetime, timedelta
+
+HEADERS = [
+    'ID_Pedido', 'Folio_Factura', 'Hora_Registro', 'Vendedor_Registro', 'Cliente',
+    'Tipo_Envio', 'Fecha_Entrega', 'Comentario', 'Notas', 'Modificacion_Surtido',
+    'Adjuntos', 'Adjuntos_Surtido', 'Estado', 'Estado_Pago', 'Fecha_Completado',
+    'Hora_Proceso', 'Turno', 'Surtidor'
+]
+TIPOS_ENVIO = {
+    "📍 Pedido Local": 55,
+    "🚚 Pedido Foráneo": 30,
+    "🛠 Garantía": 6,
+    "🔁 Devolución": 5,
+    "📬 Solicitud de guía": 4,
+}
+TURNOS_LOCALES = {"☀️ Local Mañana": 40, "🌙 Local Tarde": 35, "🌵 Saltillo": 15, "📦 Pasa a Bodega": 10}
+ESTADOS_RECIENTES = {"🔴 Pendiente": 50, "🟡 En Proceso": 25, "✅ Completado": 22, "❌ Cancelado": 3}
+ESTADOS_VIEJOS = {"✅ Completado": 90, "❌ Cancelado": 6, "🔴 Pendiente": 3, "🟡 En Proceso": 1}
+VENDEDORES = ["Ana López", "Luis Martínez", "Mario Ruiz", "Sofía Núñez", "Jorge Peña", "Carmen Ortiz"]
+CLIENTES = ["Ferretería", "Tlapalería", "Materiales", "Constructora", "Plomería", "Eléctrica"]
+APELLIDOS = ["García", "Hernández", "López", "Muñoz", "Pérez", "Sánchez", "Ramírez", "Torres"]
+NOTAS = ["", "", "", "Entregar por la tarde", "Cliente recoge en mostrador", "Llamar antes de entregar"]
+DIAS_DE_HISTORIA = 120
+DIAS_RECIENTES = 3 # Pedidos de los últimos días que todavía suelen estar abiertos
+S3_URL_PREFIX = "https://bucket.s3.us-east-1.amazonaws.com/"
+S3_ATTACHMENT_PREFIX = 'adjuntos_pedidos/'
+
+def _choice(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+def generate_orders(row_count, seed=2024, now=None):
+    """
+    Genera `row_count` pedidos. Retorna (filas, claves_s3): las filas incluyen los encabezados
+    (como get_all_values()) y claves_s3 son los adjuntos que las filas mencionan, para crearlos
+    en el S3 local. Con la misma semilla y `now` el resultado es siempre el mismo.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    rows = [list(HEADERS)]
+    s3_keys = []
+    for i in range(row_count):
+        hora_registro = now - timedelta(days=rng.random() * DIAS_DE_HISTORIA)
+        id_pedido = f"PED-{hora_registro:%Y%m%d%H%M%S}-{i:06d}"
+        tipo_envio = _choice(rng, TIPOS_ENVIO)
+        reciente = now - hora_registro < timedelta(days=DIAS_RECIENTES)
+        estado = _choice(rng, ESTADOS_RECIENTES if reciente else ESTADOS_VIEJOS)
+        fecha_entrega = hora_registro + timedelta(days=rng.randint(0, 4))
+
+        adjuntos = []
+        if rng.random() < 0.7:
+            adjuntos = [f"{S3_ATTACHMENT_PREFIX}{id_pedido}/factura_{n}.pdf" for n in range(rng.randint(1, 3))]
+        adjuntos_surtido = []
+        fecha_completado = hora_proceso = surtidor = ''
+        if estado in ("🟡 En Proceso", "✅ Completado"):
+            surtidor = rng.choice(VENDEDORES)
+            hora_proceso = (hora_registro + timedelta(hours=rng.randint(1, 30))).strftime('%Y-%m-%d %H:%M:%S')
+        if estado == "✅ Completado":
+            fecha_completado = min(fecha_entrega, now).strftime('%Y-%m-%d')
+            if rng.random() < 0.4:
+                adjuntos_surtido = [f"{S3_ATTACHMENT_PREFIX}{id_pedido}/surtido_{rng.randint(1000, 9999)}.jpg"]
+        s3_keys += adjuntos + adjuntos_surtido
+
+        rows.append([
+            id_pedido,
+            f"F{100000 + i}" if rng.random() < 0.8 else '',
+            hora_registro.strftime('%Y-%m-%d %H:%M:%S'),
+            rng.choice(VENDEDORES),
+            f"{rng.choice(CLIENTES)} {rng.choice(APELLIDOS)} {rng.randint(1, 500)}",
+            tipo_envio,
+            fecha_entrega.strftime('%Y-%m-%d'),
+            f"Pedido de {rng.randint(1, 40)} piezas" if rng.random() < 0.5 else '',
+            rng.choice(NOTAS),
+            '',
+            ','.join(S3_URL_PREFIX + key for key in adjuntos),
+            ','.join(S3_URL_PREFIX + key for key in adjuntos_surtido),
+            estado,
+            "✅ Pagado" if rng.random() < 0.6 else "🔴 No Pagado",
+            fecha_completado,
+            hora_proceso,
+            _choice(rng, TURNOS_LOCALES) if tipo_envio == "📍 Pedido Local" else '',
+            surtidor,
+        ])
+    return rows, s3_keys
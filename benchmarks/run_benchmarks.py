@@ -0,0 +1,347 @@
+"""
+Mide los tiempos de la app contra sustitutos locales de Google Sheets y S3 (benchmarks/fakes.py)
+con pedidos sintéticos (benchmarks/orders.py), sin credenciales ni red.
+
+Uso, desde la raíz del repositorio:
+    python benchmarks/run_benchmarks.py                        # 1k, 10k y 100k pedidos
+    python benchmarks/run_benchmarks.py --rows 10000 --repeat 3
+    python benchmarks/run_benchmarks.py --latency 0.15         # Simula 150 ms por llamada a la API
+
+Los tiempos de importación se miden en procesos nuevos (filas = 0): el de data_access, que no
+debe cargar los SDK, y el de los SDK que la app difiere hasta su primer uso.
+
+Cada resultado (mediana, mínimo y llamadas a la API por ejecución) se agrega a
+benchmarks/results.jsonl con el commit medido, y se compara con la medición anterior del mismo
+benchmark, tamaño y latencia: los que son más de REGRESSION_THRESHOLD más lentos se marcan.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import runpy
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from unittest import mock
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+import fakes # noqa: E402
+import orders # noqa: E402
+
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR) # La copia de la app importa data_access desde el repositorio
+import data_access # noqa: E402
+APP_PATH = os.path.join(REPO_DIR, '# app_a-d.py')
+RESULTS_PATH = os.path.join(BENCHMARKS_DIR, 'results.jsonl')
+DEFAULT_ROW_COUNTS = [1_000, 10_000, 100_000]
+REGRESSION_THRESHOLD = 0.20 # Más lento que la medición anterior en esta proporción...
+REGRESSION_MIN_SECONDS = 0.005 # ...y en al menos este tiempo (evita falsas alarmas en tiempos de microsegundos)
+SEARCH_QUERIES = ["garcia", "ferreteria munoz", "F100123", "llamar entregar"]
+DEFERRED_SDK_MODULES = ['gspread', 'google.oauth2.service_account', 'boto3', 'boto3.s3.transfer']
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+print(time.perf_counter() - start)
+print(','.join(name for name in {forbidden!r} if name in sys.modules))
+"""
+SECRETS = {
+    'google_credentials': '{}',
+    'aws_access_key_id': 'benchmark',
+    'aws_secret_access_key': 'benchmark',
+    'aws_region': 'us-east-1',
+    's3_bucket_name': 'bucket',
+}
+
+class BenchmarkEnvironment:
+    """
+    Copia de la app en un directorio temporal (su caché en disco queda ahí) con Google Sheets y S3
+    locales cargados con `row_count` pedidos sintéticos.
+    """
+
+    def __init__(self, row_count, latency):
+        self.row_count = row_count
+        self.workdir = tempfile.mkdtemp(prefix=f"benchmark_{row_count}_")
+        self.app_path = os.path.join(self.workdir, 'app.py')
+        shutil.copyfile(APP_PATH, self.app_path)
+        os.makedirs(os.path.join(self.workdir, '.streamlit'))
+        with open(os.path.join(self.workdir, '.streamlit', 'secrets.toml'), 'w', encoding='utf-8') as f:
+            f.writelines(f'{key} = "{value}"\n' for key, value in SECRETS.items())
+
+        rows, s3_keys = orders.generate_orders(row_count)
+        self.spreadsheet = fakes.FakeSpreadsheet(
+            '1aWkSelodaz0nWfQx7FZAysGnIYGQFJxAN7RO3YgCiZY', {'datos_pedidos': rows}, latency
+        )
+        self.gspread_client = fakes.FakeGspreadClient([self.spreadsheet], latency)
+        self.s3_client = fakes.FakeS3Client(latency)
+        for s3_key in s3_keys:
+            self.s3_client.put_object_bytes(s3_key, b'%PDF-1.4 benchmark')
+        self.patches = [
+            mock.patch('gspread.authorize', return_value=self.gspread_client),
+            mock.patch('boto3.client', return_value=self.s3_client),
+            mock.patch('google.oauth2.service_account.Credentials.from_service_account_info', return_value=object()),
+        ]
+
+    def __enter__(self):
+        self.previous_cwd = os.getcwd()
+        os.chdir(self.workdir) # st.secrets lee .streamlit/secrets.toml del directorio actual
+        for patch in self.patches:
+            patch.start()
+        st.cache_resource.clear()
+        refill_sheets_quota()
+        # Ejecutar el script una vez en modo "bare" para tener sus funciones a mano. Con el mismo
+        # __name__ que le da AppTest, para que ambos compartan las cachés de st.cache_resource
+        # (su clave incluye el módulo) y wait_for_refresher vea los hilos que inicia el script
+        self.app = runpy.run_path(self.app_path, run_name='__main__')
+        return self
+
+    def __exit__(self, *exc_info):
+        st.cache_resource.clear() # Detiene los hilos de actualización de esta copia
+        for patch in reversed(self.patches):
+            patch.stop()
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def snapshot_cache(self):
+        return self.app['get_sheet_snapshot_cache'](self.spreadsheet.id, 'datos_pedidos')
+
+    def reset(self, keep_disk_snapshot=False):
+        """Simula un proceso nuevo: sin cachés en memoria y, si se pide, sin la copia en disco."""
+        self.wait_for_refresher() # Un hilo que se queda sin caché sigue trabajando hasta terminar
+        st.cache_resource.clear()
+        if not keep_disk_snapshot:
+            shutil.rmtree(os.path.join(self.workdir, '.cache'), ignore_errors=True)
+
+    def wait_for_refresher(self, timeout=300):
+        """
+        Espera a que los hilos de fondo (actualización de la copia, índice de búsqueda e índice de
+        adjuntos) terminen lo que tienen en curso, para no medirlo en la siguiente repetición, y
+        aplaza la siguiente sincronización periódica un intervalo completo.
+        """
+        cache = self.snapshot_cache()
+        attachment_index = self.app['get_attachment_index'](self.s3_client)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with cache['cond']:
+                snapshot_idle = not cache['refreshing'] and not cache['refresh_requested']
+                refresher_alive = cache['refresher'] is not None and cache['refresher'].is_alive()
+                # Al arrancar, el hilo construye el índice de búsqueda fuera de 'refreshing'
+                search_idle = (
+                    not refresher_alive or cache['df'] is None or cache['search']['generation'] == cache['generation']
+                )
+                if snapshot_idle and search_idle and not attachment_index['refreshing']:
+                    cache['last_attempt'] = time.time()
+                    return
+            time.sleep(0.01)
+
+    def load(self):
+        return self.app['load_data_from_gsheets'](self.spreadsheet.id, 'datos_pedidos')
+
+    def new_app_test(self):
+        app_test = AppTest.from_file(self.app_path, default_timeout=600)
+        for key, value in SECRETS.items():
+            app_test.secrets[key] = value
+        return app_test
+
+def refill_sheets_quota():
+    """
+    Llena los buckets del regulador de cuota de Google Sheets de la app. Las llamadas a los sustitutos
+    pasan por el regulador igual que en producción, pero cada medición empieza con la cuota de un
+    minuto completa: así se mide su costo y no las esperas que dejaron las mediciones anteriores.
+    """
+    governor = data_access.get_sheets_quota_governor()
+    with governor['cond']:
+        for bucket in governor['buckets'].values():
+            bucket['tokens'] = bucket['capacity']
+        governor['rate_factor'] = 1.0
+        governor['blocked_until'] = 0.0
+        governor['cond'].notify_all()
+
+def measure(name, func, repeat, setup=None, teardown=None):
+    """Ejecuta `func` `repeat` veces y retorna sus tiempos y las llamadas a la API por ejecución."""
+    timings = []
+    calls_before = Counter(fakes.API_CALLS)
+    for _ in range(repeat):
+        refill_sheets_quota()
+        if setup:
+            setup()
+        gc.collect() # Que no se mida la basura de las ejecuciones anteriores
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        if teardown:
+            teardown()
+    calls = Counter(fakes.API_CALLS)
+    calls.subtract(calls_before)
+    return {
+        'benchmark': name,
+        'median_s': round(statistics.median(timings), 6),
+        'min_s': round(min(timings), 6),
+        'repeat': repeat,
+        'api_calls': {call: round(count / repeat, 2) for call, count in sorted(calls.items()) if count},
+    }
+
+def measure_import(name, modules, repeat, forbidden=()):
+    """
+    Importa `modules` en `repeat` procesos nuevos y retorna sus tiempos. Falla si alguno de los
+    módulos de `forbidden` quedó cargado (por ejemplo, un SDK que debía importarse en su primer uso).
+    """
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_PROBE.format(modules=modules, forbidden=list(forbidden))],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        if output[1]:
+            raise RuntimeError(f"Importar {', '.join(modules)} cargó {output[1]}, que debía cargarse en su primer uso")
+        timings.append(float(output[0]))
+    return {
+        'benchmark': name,
+        'median_s': round(statistics.median(timings), 6),
+        'min_s': round(min(timings), 6),
+        'repeat': repeat,
+        'api_calls': {},
+    }
+
+def run_import_benchmarks(repeat):
+    return [
+        measure_import('import:data_access', ['data_access'], repeat, forbidden=DEFERRED_SDK_MODULES),
+        measure_import('import:sdk_diferidos', DEFERRED_SDK_MODULES, repeat),
+    ]
+
+def tab_filters(app, partitions):
+    """Los conteos de las etiquetas y las selecciones de cada pestaña, como en el flujo principal."""
+    activos = app['ESTADOS_ACTIVOS']
+    count_orders, select_order_positions = app['count_orders'], app['select_order_positions']
+    for fechas in (['hoy'], ['manana'], ['pasado']):
+        count_orders(partitions, estados=activos, fechas=fechas)
+        for turno in app['TURNOS']:
+            select_order_positions(partitions, estados=activos, fechas=fechas, turno=turno)
+    for estados in (['en_proceso'], ['pendiente']):
+        count_orders(partitions, estados=estados)
+        for tipo_envio in app['TIPO_ENVIO_FILTER_OPTIONS'][1:]:
+            select_order_positions(partitions, estados=estados, tipo_envio=tipo_envio)
+
+def run_benchmarks(env, repeat):
+    app = env.app
+    results = []
+    results.append(measure(
+        'load_data_from_gsheets:cold', env.load, repeat,
+        setup=env.reset, teardown=env.wait_for_refresher
+    ))
+    results.append(measure(
+        'load_data_from_gsheets:disk', env.load, repeat,
+        setup=lambda: env.reset(keep_disk_snapshot=True), teardown=env.wait_for_refresher
+    ))
+    results.append(measure('load_data_from_gsheets:warm', env.load, repeat * 10))
+
+    df, _, _ = env.load()
+    env.wait_for_refresher()
+    results.append(measure('ordenar_pedidos_custom', lambda: app['ordenar_pedidos_custom'](df), repeat))
+    results.append(measure('build_order_partitions', lambda: app['build_order_partitions'](df), repeat))
+    partitions = app['get_order_partitions'](env.spreadsheet.id, 'datos_pedidos', df)
+    results.append(measure('tab_filters', lambda: tab_filters(app, partitions), repeat))
+    search = lambda: [app['search_orders'](env.spreadsheet.id, 'datos_pedidos', df, query) for query in SEARCH_QUERIES]
+    results.append(measure('search_orders:first', search, 1, setup=lambda: env.snapshot_cache().update(
+        search=app['_empty_search_index']()
+    )))
+    results.append(measure('search_orders:warm', search, repeat))
+
+    # Ejecuciones completas del script (lo que espera un usuario al abrir la app o al hacer clic)
+    app_test = env.new_app_test()
+    results.append(measure('script:first_run', app_test.run, 1, setup=env.reset, teardown=env.wait_for_refresher))
+    # Reinicio del proceso con la copia en disco: lo que espera el primer usuario tras un despliegue
+    restarted_app_test = env.new_app_test()
+    results.append(measure(
+        'script:first_run_disk', restarted_app_test.run, 1,
+        setup=lambda: env.reset(keep_disk_snapshot=True), teardown=env.wait_for_refresher
+    ))
+    results.append(measure('script:rerun', app_test.run, repeat))
+    tabs = iter(range(repeat * 6))
+    results.append(measure(
+        'script:tab_switch',
+        lambda: app_test.radio(key='active_main_tab_index_radio').set_value(next(tabs) % 6).run(),
+        repeat * 2
+    ))
+    if app_test.exception:
+        raise RuntimeError(f"La app falló durante el benchmark: {app_test.exception[0].message}")
+    return results
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--', APP_PATH], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_previous_results():
+    """Última medición guardada de cada (benchmark, filas, latencia)."""
+    previous = {}
+    if os.path.exists(RESULTS_PATH):
+        with open(RESULTS_PATH, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    previous[(record['benchmark'], record['rows'], record['latency_s'])] = record
+    return previous
+
+def report(records, previous):
+    """Imprime la tabla de resultados. Retorna los benchmarks que empeoraron respecto a la medición anterior."""
+    regressions = []
+    print(f"{'benchmark':<32}{'filas':>8}{'mediana':>12}{'anterior':>12}{'cambio':>9}  llamadas API")
+    for record in records:
+        before = previous.get((record['benchmark'], record['rows'], record['latency_s']))
+        change = ''
+        if before:
+            ratio = record['median_s'] / before['median_s'] - 1 if before['median_s'] else 0
+            change = f"{ratio:+.0%}"
+            if ratio > REGRESSION_THRESHOLD and record['median_s'] - before['median_s'] > REGRESSION_MIN_SECONDS:
+                change += " ⚠️"
+                regressions.append(record)
+        calls = ', '.join(f"{call}={count:g}" for call, count in record['api_calls'].items())
+        before_ms = f"{before['median_s'] * 1000:.1f}ms" if before else '-'
+        print(f"{record['benchmark']:<32}{record['rows']:>8}{record['median_s'] * 1000:>10.1f}ms{before_ms:>12}{change:>9}  {calls}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROW_COUNTS, help="Tamaños de la hoja a medir")
+    parser.add_argument('--repeat', type=int, default=5, help="Repeticiones de cada medición (se reporta la mediana)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Segundos de espera simulada por llamada a la API")
+    parser.add_argument('--no-save', action='store_true', help=f"No agregar los resultados a {os.path.basename(RESULTS_PATH)}")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Salir con error si algún benchmark empeoró")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING) # Avisos de Streamlit por ejecutar fuera de `streamlit run`
+    previous = load_previous_results()
+    run_info = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'latency_s': args.latency}
+    records = [{**run_info, 'rows': 0, **result} for result in run_import_benchmarks(args.repeat)]
+    for row_count in args.rows:
+        with BenchmarkEnvironment(row_count, args.latency) as env:
+            records += [{**run_info, 'rows': row_count, **result} for result in run_benchmarks(env, args.repeat)]
+
+    regressions = report(records, previous)
+    if not args.no_save:
+        with open(RESULTS_PATH, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+Acceso a Google Sheets y S3 de la Bandeja de Pedidos TD: clientes, métricas de las llamadas
+y regulador de la cuota de Google Sheets.
+
+Se puede importar sin efectos en Streamlit (no usa st.*) y sin cargar los SDK: gspread,
+google-auth y boto3 se importan y los clientes se crean la primera vez que se usan
+(ver LazyModule y LazyClient), para que un arranque en frío dibuje los pedidos sin esperarlos.
+El estado (métricas y cuota) es del proceso y lo comparten todas las sesiones.
+"""
+import importlib
+import importlib.util
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# --- Tracing and API Metrics ---
+TRACE_SPAN_SAMPLES = 2000 # Duraciones recientes que se guardan por span para calcular p50/p95
+TRACE_RERUN_SAMPLES = 500
+API_CALL_WINDOW_SECONDS = 10 * 60 # Historial de llamadas para las tasas por minuto
+SHEETS_READ_QUOTA_PER_MINUTE = 60 # Cuota de Google Sheets por usuario (la cuenta de servicio) y minuto
+SHEETS_WRITE_QUOTA_PER_MINUTE = 60
+METRICS_EXPORT_INTERVAL_SECONDS = 15
+
+_trace_metrics = {
+    'lock': threading.Lock(),
+    'spans': {},              # nombre -> deque con las últimas duraciones (s)
+    'span_counts': Counter(), # nombre -> veces desde el inicio del proceso
+    'api_calls': deque(),     # (timestamp, servicio, escritura) de los últimos API_CALL_WINDOW_SECONDS
+    'api_totals': Counter(),  # 'servicio.operación' -> llamadas desde el inicio del proceso
+    'api_errors': Counter(),  # 'servicio.código' -> respuestas con error
+    'reruns': deque(maxlen=TRACE_RERUN_SAMPLES), # Duraciones (s) de los últimos reruns
+    'sessions': {},           # ID de sesión -> {'reruns', 'api_calls', 'last_seen'}
+    'last_export': 0.0,
+}
+
+def get_trace_metrics():
+    """
+    Métricas compartidas por todas las sesiones y los hilos del proceso: duraciones de los spans
+    (llamadas a Google Sheets, S3 y HTTP, y fases de dibujo), duración de cada rerun y llamadas a las APIs.
+    """
+    return _trace_metrics
+
+_trace_context = threading.local() # Traza del rerun en curso (solo en el hilo del script)
+
+def current_rerun_trace():
+    return getattr(_trace_context, 'rerun', None)
+
+def set_current_rerun_trace(trace):
+    """Asocia al hilo actual la traza del rerun (o None) a la que se suman los spans y las llamadas."""
+    _trace_context.rerun = trace
+
+def finish_rerun_trace(trace, finished_at):
+    """Cierra una traza de rerun y la suma a las métricas del proceso."""
+    trace['finished_at'] = finished_at
+    with _trace_metrics['lock']:
+        _trace_metrics['reruns'].append(finished_at - trace['started_at'])
+        session = _trace_metrics['sessions'].setdefault(trace['session_id'], {'reruns': 0, 'api_calls': Counter(), 'last_seen': 0.0})
+        session['reruns'] += 1
+        session['api_calls'].update(trace['api_calls'])
+        session['last_seen'] = finished_at
+
+def record_span(name, duration):
+    """Registra la duración de un span en las métricas del proceso y en la traza del rerun en curso."""
+    metrics = get_trace_metrics()
+    with metrics['lock']:
+        if name not in metrics['spans']:
+            metrics['spans'][name] = deque(maxlen=TRACE_SPAN_SAMPLES)
+        metrics['spans'][name].append(duration)
+        metrics['span_counts'][name] += 1
+    trace = current_rerun_trace()
+    if trace is not None:
+        trace['spans'][name] += duration
+        trace['last_activity'] = time.time()
+
+@contextmanager
+def trace_span(name):
+    """Mide un bloque (`with trace_span('render.tarjeta'):`) o una función (como decorador)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+def record_api_call(service, operation, duration, write=False, status_code=None):
+    """Registra una llamada a una API externa: su span, la tasa por minuto y los errores."""
+    now = time.time()
+    metrics = get_trace_metrics()
+    with metrics['lock']:
+        metrics['api_calls'].append((now, service, write))
+        while metrics['api_calls'][0][0] < now - API_CALL_WINDOW_SECONDS:
+            metrics['api_calls'].popleft()
+        metrics['api_totals'][f"{service}.{operation}"] += 1
+        if status_code is not None and status_code >= 400:
+            metrics['api_errors'][f"{service}.{status_code}"] += 1
+    record_span(f"{service}.{operation}", duration)
+    trace = current_rerun_trace()
+    if trace is not None:
+        trace['api_calls'][service] += 1
+
+def api_calls_per_minute(service, write=None):
+    """Llamadas a `service` en el último minuto (solo escrituras o lecturas si se indica `write`)."""
+    metrics = get_trace_metrics()
+    since = time.time() - 60
+    with metrics['lock']:
+        return sum(
+            1 for timestamp, call_service, call_write in metrics['api_calls']
+            if timestamp >= since and call_service == service and (write is None or call_write == write)
+        )
+
+_SHEETS_OPERATIONS = [ # Operación de la API de Google Sheets según la ruta de la solicitud
+    (re.compile(r'/values:batchGet$'), 'values_batch_get'),
+    (re.compile(r'/values:batchUpdate$'), 'values_batch_update'),
+    (re.compile(r'/values/[^/]+:append$'), 'values_append'),
+    (re.compile(r'/values/[^/]+$'), 'values'),
+    (re.compile(r':batchUpdate$'), 'batch_update'),
+    (re.compile(r'/spreadsheets/[^/:]+$'), 'metadata'),
+]
+
+def sheets_operation_name(method, endpoint):
+    path = endpoint.split('?', 1)[0]
+    for pattern, operation in _SHEETS_OPERATIONS:
+        if pattern.search(path):
+            return f"{operation}_{method.lower()}" if operation == 'values' else operation
+    return method.lower()
+
+def instrument_gspread_client(client):
+    """
+    Mide todas las solicitudes HTTP de un cliente de gspread (todas pasan por client.request).
+    Las lecturas (GET) y escrituras se cuentan por separado contra la cuota de Google Sheets, y
+    cada solicitud espera su turno en el regulador de cuota (ver acquire_sheets_quota).
+    """
+    request = getattr(client, 'request', None)
+    if request is None:
+        return client
+
+    def traced_request(method, endpoint, *args, **kwargs):
+        write = method.lower() != 'get'
+        acquire_sheets_quota(write)
+        start = time.perf_counter()
+        status_code = None
+        retry_after = None
+        try:
+            return request(method, endpoint, *args, **kwargs)
+        except Exception as e: # gspread.exceptions.APIError trae la respuesta HTTP
+            response = getattr(e, 'response', None)
+            status_code = getattr(response, 'status_code', None)
+            retry_after = getattr(response, 'headers', {}).get('Retry-After')
+            raise
+        finally:
+            record_api_call(
+                'sheets', sheets_operation_name(method, endpoint), time.perf_counter() - start,
+                write=write, status_code=status_code
+            )
+            report_sheets_quota_result(write, status_code, retry_after)
+
+    client.request = traced_request
+    return client
+
+def instrument_s3_client(client):
+    """Mide cada operación de un cliente de boto3 con sus eventos before-call/after-call."""
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return client
+
+    def _before_call(model, context, **kwargs):
+        context['trace_started_at'] = time.perf_counter()
+        context['trace_model'] = model # after-call-error no recibe el modelo
+
+    def _record(model, context, status_code):
+        record_api_call(
+            's3', model.name if model else 'error',
+            time.perf_counter() - context.get('trace_started_at', time.perf_counter()),
+            write=bool(model) and model.http['method'] not in ('GET', 'HEAD'),
+            status_code=status_code
+        )
+
+    def _after_call(model, context, http_response=None, **kwargs):
+        _record(model, context, getattr(http_response, 'status_code', None) or 599)
+
+    def _after_call_error(exception=None, context=None, **kwargs):
+        context = context or {}
+        _record(context.get('trace_model'), context, 599) # Sin respuesta: error de conexión
+
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    events.register('after-call-error.s3', _after_call_error)
+    return client
+
+def latency_percentiles(samples, quantiles=(50, 95)):
+    return np.percentile(np.fromiter(samples, dtype=float), quantiles) if samples else [float('nan')] * len(quantiles)
+
+def export_metrics(path, force=False):
+    """
+    Escribe las métricas en `path` (formato de texto de Prometheus), como mucho cada
+    METRICS_EXPORT_INTERVAL_SECONDS. Los errores se ignoran.
+    """
+    metrics = get_trace_metrics()
+    now = time.time()
+    with metrics['lock']:
+        if not force and now - metrics['last_export'] < METRICS_EXPORT_INTERVAL_SECONDS:
+            return
+        metrics['last_export'] = now
+        reruns = list(metrics['reruns'])
+        spans = {name: list(samples) for name, samples in metrics['spans'].items()}
+        api_totals = dict(metrics['api_totals'])
+        api_errors = dict(metrics['api_errors'])
+        session_count = len(metrics['sessions'])
+    lines = ["# TYPE app_rerun_seconds summary"]
+    for quantile, value in zip(('0.5', '0.95'), latency_percentiles(reruns)):
+        lines.append(f'app_rerun_seconds{{quantile="{quantile}"}} {value:.6f}')
+    lines.append(f"app_rerun_seconds_count {len(reruns)}")
+    lines.append("# TYPE app_span_seconds summary")
+    for name, samples in sorted(spans.items()):
+        for quantile, value in zip(('0.5', '0.95'), latency_percentiles(samples)):
+            lines.append(f'app_span_seconds{{span="{name}",quantile="{quantile}"}} {value:.6f}')
+    lines.append("# TYPE app_api_calls_total counter")
+    for name, count in sorted(api_totals.items()):
+        service, operation = name.split('.', 1)
+        lines.append(f'app_api_calls_total{{service="{service}",operation="{operation}"}} {count}')
+    lines.append("# TYPE app_api_errors_total counter")
+    for name, count in sorted(api_errors.items()):
+        service, status_code = name.split('.', 1)
+        lines.append(f'app_api_errors_total{{service="{service}",status="{status_code}"}} {count}')
+    lines.append("# TYPE app_sheets_calls_per_minute gauge")
+    lines.append(f'app_sheets_calls_per_minute{{kind="read"}} {api_calls_per_minute("sheets", write=False)}')
+    lines.append(f'app_sheets_calls_per_minute{{kind="write"}} {api_calls_per_minute("sheets", write=True)}')
+    lines.append(f"app_sessions {session_count}")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+# --- Google Sheets Quota Governor ---
+SHEETS_QUOTA_USER_RESERVE = 10 # Solicitudes por minuto que las tareas de fondo no pueden usar
+SHEETS_QUOTA_MAX_WAIT_SECONDS = 30 # Espera máxima de una solicitud del usuario; después se envía de todos modos
+SHEETS_QUOTA_BACKOFF_BASE_SECONDS = 2.0
+SHEETS_QUOTA_BACKOFF_MAX_SECONDS = 64.0
+SHEETS_QUOTA_MIN_RATE_FACTOR = 0.25 # Tras varios 429 se baja el ritmo hasta la cuarta parte de la cuota
+SHEETS_QUOTA_RECOVERY_STEP = 0.05 # Fracción del ritmo que se recupera por cada solicitud exitosa
+
+def _new_sheets_quota_governor():
+    """
+    Regulador de cuota de Google Sheets compartido por todas las sesiones y los hilos del proceso:
+    un token bucket para lecturas y otro para escrituras, que se rellenan al ritmo de la cuota
+    por minuto. Las solicitudes del usuario (escrituras de la cola, lecturas de la página) tienen
+    prioridad sobre las de fondo (el hilo de actualización de la copia): estas no usan los últimos
+    SHEETS_QUOTA_USER_RESERVE tokens y ceden el turno mientras haya solicitudes del usuario esperando.
+    Ante un 429 se pausan todas las solicitudes con backoff exponencial y se reduce el ritmo,
+    que se recupera poco a poco con cada solicitud exitosa.
+    """
+    now = time.monotonic()
+    return {
+        'cond': threading.Condition(),
+        'buckets': {
+            kind: {'capacity': float(quota), 'tokens': float(quota), 'rate': quota / 60.0, 'updated_at': now}
+            for kind, quota in (('read', SHEETS_READ_QUOTA_PER_MINUTE), ('write', SHEETS_WRITE_QUOTA_PER_MINUTE))
+        },
+        'rate_factor': 1.0,
+        'blocked_until': 0.0, # time.monotonic() hasta el que no se envía ninguna solicitud
+        'consecutive_429': 0,
+        'total_429': 0,
+        'waiting': Counter(), # (tipo, carril) -> solicitudes esperando token
+    }
+
+_sheets_quota_governor = _new_sheets_quota_governor()
+
+def get_sheets_quota_governor():
+    return _sheets_quota_governor
+
+_quota_context = threading.local() # Carril de prioridad del hilo actual
+
+@contextmanager
+def sheets_quota_lane(lane):
+    """Marca las solicitudes a Google Sheets del bloque como 'usuario' (por omisión) o 'fondo'."""
+    previous = getattr(_quota_context, 'lane', 'usuario')
+    _quota_context.lane = lane
+    try:
+        yield
+    finally:
+        _quota_context.lane = previous
+
+def _refill_quota_bucket(bucket, rate_factor, now):
+    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate'] * rate_factor)
+    bucket['updated_at'] = now
+
+def acquire_sheets_quota(write):
+    """
+    Espera un token de lectura o escritura para el carril del hilo actual.
+    Las solicitudes del usuario esperan como mucho SHEETS_QUOTA_MAX_WAIT_SECONDS; las de fondo,
+    lo que haga falta. Retorna los segundos de espera.
+    """
+    governor = get_sheets_quota_governor()
+    kind = 'write' if write else 'read'
+    lane = getattr(_quota_context, 'lane', 'usuario')
+    reserve = SHEETS_QUOTA_USER_RESERVE if lane == 'fondo' else 0
+    start = time.monotonic()
+    with governor['cond']:
+        governor['waiting'][(kind, lane)] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                bucket = governor['buckets'][kind]
+                _refill_quota_bucket(bucket, governor['rate_factor'], now)
+                if lane == 'usuario' and now - start >= SHEETS_QUOTA_MAX_WAIT_SECONDS:
+                    break
+                if now < governor['blocked_until']:
+                    wait = governor['blocked_until'] - now
+                elif lane == 'fondo' and governor['waiting'][(kind, 'usuario')]:
+                    wait = 1.0 # Ceder el turno; el carril del usuario avisa al tomar su token
+                elif bucket['tokens'] >= 1 + reserve:
+                    bucket['tokens'] -= 1
+                    break
+                else:
+                    wait = (1 + reserve - bucket['tokens']) / (bucket['rate'] * governor['rate_factor'])
+                if lane == 'usuario':
+                    wait = min(wait, start + SHEETS_QUOTA_MAX_WAIT_SECONDS - now)
+                governor['cond'].wait(timeout=wait)
+        finally:
+            governor['waiting'][(kind, lane)] -= 1
+            governor['cond'].notify_all()
+    waited = time.monotonic() - start
+    if waited >= 0.01:
+        record_span(f"sheets.espera_cuota.{lane}", waited)
+    return waited
+
+def report_sheets_quota_result(write, status_code, retry_after=None):
+    """
+    Ajusta el regulador con el resultado de una solicitud: un 429 pausa todas las solicitudes
+    (Retry-After o backoff exponencial con jitter), vacía el bucket y reduce el ritmo a la mitad;
+    una respuesta exitosa recupera SHEETS_QUOTA_RECOVERY_STEP del ritmo.
+    """
+    governor = get_sheets_quota_governor()
+    with governor['cond']:
+        if status_code == 429:
+            governor['consecutive_429'] += 1
+            governor['total_429'] += 1
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = min(
+                    SHEETS_QUOTA_BACKOFF_BASE_SECONDS * 2 ** (governor['consecutive_429'] - 1), SHEETS_QUOTA_BACKOFF_MAX_SECONDS
+                ) + random.uniform(0, 1)
+            now = time.monotonic()
+            governor['blocked_until'] = max(governor['blocked_until'], now + delay)
+            governor['rate_factor'] = max(SHEETS_QUOTA_MIN_RATE_FACTOR, governor['rate_factor'] / 2)
+            bucket = governor['buckets']['write' if write else 'read']
+            _refill_quota_bucket(bucket, governor['rate_factor'], now)
+            bucket['tokens'] = 0.0
+        elif status_code is None:
+            governor['consecutive_429'] = 0
+            governor['rate_factor'] = min(1.0, governor['rate_factor'] + SHEETS_QUOTA_RECOVERY_STEP)
+        governor['cond'].notify_all()
+
+def sheets_quota_state():
+    """Foto del regulador para la interfaz: tokens disponibles, ritmo, pausa y solicitudes en espera."""
+    governor = get_sheets_quota_governor()
+    with governor['cond']:
+        now = time.monotonic()
+        state = {
+            'rate_factor': governor['rate_factor'],
+            'paused_for': max(0.0, governor['blocked_until'] - now),
+            'total_429': governor['total_429'],
+            'waiting': dict(governor['waiting']),
+        }
+        for kind, bucket in governor['buckets'].items():
+            _refill_quota_bucket(bucket, governor['rate_factor'], now)
+            state[kind] = (bucket['tokens'], bucket['capacity'])
+    return state
+
+# --- Lazy Imports and Clients ---
+class LazyModule:
+    """Módulo que se importa en el primer acceso a uno de sus atributos (desde cualquier hilo)."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name) # El lock de importación evita cargas dobles
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+def optional_module(name):
+    """LazyModule de `name`, o None si la librería no está instalada (sin importarla)."""
+    return LazyModule(name) if importlib.util.find_spec(name) is not None else None
+
+class LazyClient:
+    """
+    Cliente que se crea con `factory` en su primer uso y luego delega en él. Si la creación falla,
+    el error llega a quien lo usó y se reintenta en el siguiente uso.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+    def __bool__(self):
+        return True # `if not s3_client` no debe crear el cliente
+
+GOOGLE_SHEETS_SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+def create_gspread_client(credentials_info):
+    """Autentica un cliente de gspread con la cuenta de servicio `credentials_info` (dict) e instrumentado."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    creds = Credentials.from_service_account_info(credentials_info, scopes=GOOGLE_SHEETS_SCOPES)
+    return instrument_gspread_client(gspread.authorize(creds))
+
+def create_s3_client(aws_access_key_id, aws_secret_access_key, region_name):
+    """Crea un cliente de S3 instrumentado."""
+    import boto3
+    s3 = boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=region_name
+    )
+    return instrument_s3_client(s3)
@@ -0,0 +1,23 @@
+"""
+Fixtures de las pruebas: la app corre en modo "bare" contra los sustitutos locales de Google Sheets
+y S3 de los benchmarks (benchmarks/fakes.py), en un directorio temporal con su propia caché en disco.
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+from run_benchmarks import BenchmarkEnvironment # noqa: E402
+
+TEST_ROW_COUNT = 300
+WORKSHEET_NAME = 'datos_pedidos'
+
+@pytest.fixture
+def app_env():
+    """Entorno con la app cargada (env.app es su espacio de nombres) y TEST_ROW_COUNT pedidos sintéticos."""
+    with BenchmarkEnvironment(TEST_ROW_COUNT, latency=0.0) as env:
+        env.load()
+        env.wait_for_refresher()
+        yield env
@@ -0,0 +1,42 @@
+"""Archivado de pedidos cerrados: confirmación en la barra lateral y verificación de la copia local."""
+from contextlib import closing
+
+import pytest
+
+from conftest import WORKSHEET_NAME
+
+def _sheet_ids(env):
+    return [row[0] for row in env.spreadsheet.worksheets_[WORKSHEET_NAME].rows[1:]]
+
+def _archived_ids(app):
+    with closing(app['_open_archive_db']()) as conn:
+        return {row[0] for row in conn.execute("SELECT id_pedido FROM pedidos_archivados")}
+
+def test_archive_button_asks_for_confirmation(app_env):
+    app = app_env.app
+    to_archive = set(app['closed_orders_to_archive'](app_env.snapshot_cache()['df'])['ID_Pedido'])
+    assert to_archive
+    rows_before = _sheet_ids(app_env)
+
+    app_test = app_env.new_app_test()
+    app_test.run()
+    app_test.button(key="archive_orders_btn").click().run()
+    assert _sheet_ids(app_env) == rows_before # El primer clic solo pide confirmación
+    assert any("se eliminarán de la hoja" in warning.value for warning in app_test.warning)
+
+    app_test.button(key="archive_confirm_btn").click().run()
+    assert not app_test.exception
+    assert [id_pedido for id_pedido in rows_before if id_pedido not in to_archive] == _sheet_ids(app_env)
+    assert to_archive <= _archived_ids(app)
+
+def test_archive_keeps_rows_missing_from_local_copy(app_env, monkeypatch):
+    app = app_env.app
+    archive_globals = app['archive_closed_orders'].__globals__
+    store_archived_rows = archive_globals['_store_archived_rows']
+    # La copia local pierde un pedido (por ejemplo, otro proceso reemplazó el archivo SQLite)
+    monkeypatch.setitem(archive_globals, '_store_archived_rows', lambda conn, headers, rows: store_archived_rows(conn, headers, rows[:-1]))
+    rows_before = _sheet_ids(app_env)
+
+    with pytest.raises(RuntimeError, match="copia local del archivo"):
+        app['archive_closed_orders'](app_env.spreadsheet.id, WORKSHEET_NAME)
+    assert _sheet_ids(app_env) == rows_before
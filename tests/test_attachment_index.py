@@ -0,0 +1,32 @@
+"""Índice de adjuntos de S3: construcción en segundo plano y actualización incremental."""
+import time
+from datetime import datetime, timedelta
+
+def _ready_attachment_index(env, timeout=30):
+    app = env.app
+    state = app['start_attachment_index_refresher'](app['s3_client'])
+    deadline = time.time() + timeout
+    while not state['ready'] and time.time() < deadline:
+        time.sleep(0.01)
+    assert state['ready'], state['error']
+    return state
+
+def test_incremental_refresh_finds_new_files_in_existing_folders(app_env):
+    app = app_env.app
+    state = _ready_attachment_index(app_env)
+    pedido_id, order = next(iter(state['data']['orders'].items()))
+    old_key = next(iter(order['objects']))
+
+    # Archivo nuevo en la carpeta de un pedido que ya estaba indexado (su clave no va después de las demás)
+    new_key = f"{order['prefix']}000_nuevo.pdf"
+    app_env.s3_client.put_object_bytes(new_key, b'%PDF-1.4 nuevo')
+    # Un objeto anterior a la marca (menos el margen) no se vuelve a registrar
+    del order['objects'][old_key]
+    app_env.s3_client.objects[old_key]['LastModified'] = datetime.now().astimezone() - timedelta(days=1)
+
+    last_full_build = state['data']['last_full_build']
+    app['_refresh_attachment_index'](state, app['s3_client'])
+    assert state['data']['last_full_build'] == last_full_build # Fue una actualización incremental
+    objects = app['get_pedido_attachment_objects'](app['s3_client'], pedido_id)
+    assert new_key in objects
+    assert old_key not in objects
@@ -0,0 +1,135 @@
+"""Adjuntos de S3: caché de descargas, URLs pre-firmadas, miniaturas y subida de adjuntos de surtido."""
+import io
+import os
+import time
+
+import fakes
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+def _s3_calls(name):
+    return fakes.API_CALLS[f's3.{name}']
+
+def test_attachment_download_is_cached_by_key_and_etag(app_env):
+    app = app_env.app
+    s3_key = next(key for key in app_env.s3_client.objects if key.startswith(app['S3_ATTACHMENT_PREFIX']))
+    gets_before = _s3_calls('get_object')
+
+    assert app['fetch_attachment_bytes'](app['s3_client'], s3_key=s3_key) == b'%PDF-1.4 benchmark'
+    assert app['fetch_attachment_bytes'](app['s3_client'], s3_key=s3_key) == b'%PDF-1.4 benchmark'
+    assert _s3_calls('get_object') == gets_before + 1
+
+    # Un archivo reemplazado (otro ETag) nunca se sirve desde la caché
+    # (la app lo registra sin ETag al subirlo, y entonces lo consulta en S3)
+    app_env.s3_client.put_object_bytes(s3_key, b'%PDF-1.4 reemplazado')
+    app['register_attachment_object'](app['s3_client'], s3_key, persist=False)
+    assert app['fetch_attachment_bytes'](app['s3_client'], s3_key=s3_key) == b'%PDF-1.4 reemplazado'
+    assert _s3_calls('get_object') == gets_before + 2
+
+def test_attachment_cache_evicts_least_recently_used(app_env, monkeypatch):
+    app = app_env.app
+    monkeypatch.setitem(app['_attachment_bytes_cache_put'].__globals__, 'ATTACHMENT_BYTES_CACHE_MAX_BYTES', 10)
+    put, get = app['_attachment_bytes_cache_put'], app['_attachment_bytes_cache_get']
+    put(('a', None), b'1234')
+    put(('b', None), b'1234')
+    assert get(('a', None)) == b'1234' # 'b' pasa a ser el menos usado
+    put(('c', None), b'1234')
+    assert get(('b', None)) is None
+    assert get(('a', None)) == b'1234'
+    assert app['get_attachment_bytes_cache']()['total_bytes'] == 8
+
+def test_presigned_urls_are_reused_until_close_to_expiry(app_env):
+    app = app_env.app
+    keys = sorted(key for key in app_env.s3_client.objects if key.startswith(app['S3_ATTACHMENT_PREFIX']))[:3]
+    signs_before = _s3_calls('generate_presigned_url')
+
+    urls = app['presign_s3_download_urls'](app['s3_client'], keys + keys[:1]) # Claves repetidas se firman una vez
+    assert set(urls) == set(keys)
+    assert _s3_calls('generate_presigned_url') == signs_before + 3
+    assert app['presign_s3_download_urls'](app['s3_client'], keys) == urls
+    assert app['get_s3_file_download_url'](app['s3_client'], keys[0]) == urls[keys[0]]
+    assert _s3_calls('generate_presigned_url') == signs_before + 3
+
+    # A la URL le queda menos que el margen de renovación: se firma otra; las vencidas se descartan
+    cache = app['get_presigned_url_cache']()
+    with cache['lock']:
+        cache['urls'][keys[0]] = (urls[keys[0]], time.time() + app['S3_PRESIGNED_URL_RENEW_MARGIN_SECONDS'] - 1)
+        cache['urls']['adjuntos_pedidos/vencido.pdf'] = ('https://fake-s3.local/vencido', time.time() - 1)
+    renewed = app['presign_s3_download_urls'](app['s3_client'], keys)
+    assert renewed[keys[0]] != urls[keys[0]]
+    assert renewed[keys[1]] == urls[keys[1]]
+    assert _s3_calls('generate_presigned_url') == signs_before + 4
+    assert 'adjuntos_pedidos/vencido.pdf' not in cache['urls']
+
+def _png_bytes(size, mode='RGB'):
+    output = io.BytesIO()
+    Image.new(mode, size).save(output, format='PNG')
+    return output.getvalue()
+
+def test_thumbnail_fits_max_size_and_keeps_aspect_ratio(app_env):
+    app = app_env.app
+    with Image.open(io.BytesIO(app['make_thumbnail_bytes'](_png_bytes((1200, 600), mode='P')))) as thumbnail:
+        assert thumbnail.format == 'WEBP'
+        assert thumbnail.size == (300, 150)
+
+def test_backfill_creates_and_indexes_missing_thumbnails(app_env):
+    app = app_env.app
+    order = next(iter(app['get_attachment_index'](app['s3_client'])['data']['orders'].values()))
+    image_key = f"{order['prefix']}foto.png"
+    app_env.s3_client.put_object_bytes(image_key, _png_bytes((800, 800)))
+    app['register_attachment_object'](app['s3_client'], image_key, persist=False)
+    assert image_key in app['list_attachments_missing_thumbnails'](app['s3_client'])
+
+    progress = []
+    created, failed = app['backfill_thumbnails'](
+        app['s3_client'], [image_key, f"{order['prefix']}no_existe.png"],
+        progress_callback=lambda done, total: progress.append((done, total))
+    )
+    assert (created, failed) == (1, 1)
+    assert progress[-1] == (2, 2)
+    thumbnail_key = app['thumbnail_key_for'](image_key)
+    assert thumbnail_key in app_env.s3_client.objects
+    assert app['get_attachment_thumbnail_key'](app['s3_client'], image_key) == thumbnail_key
+    assert image_key not in app['list_attachments_missing_thumbnails'](app['s3_client'])
+
+def test_optimize_upload_image_only_shrinks_large_photos(app_env):
+    app = app_env.app
+    photo = io.BytesIO()
+    Image.frombytes('RGB', (3000, 1500), os.urandom(3000 * 1500 * 3)).save(photo, format='PNG')
+    name, content = app['optimize_upload_image']("foto grande.png", photo.getvalue())
+    assert name == "foto grande.jpg"
+    assert len(content) < len(photo.getvalue())
+    with Image.open(io.BytesIO(content)) as image:
+        assert image.size == (2560, 1280)
+
+    small = _png_bytes((100, 100))
+    assert app['optimize_upload_image']("foto.png", small) == ("foto.png", small)
+    assert app['optimize_upload_image']("factura.pdf", b'%PDF' * 300000)[0] == "factura.pdf"
+
+def test_upload_surtido_files_in_parallel(app_env, monkeypatch):
+    app = app_env.app
+    s3_client = app_env.s3_client
+    upload_fileobj = s3_client.upload_fileobj
+
+    def _upload_or_fail(fileobj, bucket, key, **kwargs):
+        if 'falla' in key:
+            raise RuntimeError("conexión perdida")
+        return upload_fileobj(fileobj, bucket, key, **kwargs)
+
+    monkeypatch.setattr(s3_client, 'upload_fileobj', _upload_or_fail)
+    files = [("guía 1.pdf", b'%PDF-1.4 guia'), ("falla.pdf", b'%PDF-1.4'), ("foto.png", _png_bytes((400, 400)))]
+    progress = []
+    urls, errors = app['upload_surtido_files'](
+        app['s3_client'], "PED-SURTIDO", files, progress_callback=lambda done, total: progress.append((done, total))
+    )
+
+    assert [url.rsplit('/', 1)[1].split('_')[0] for url in urls] == ["guía", "foto"]
+    assert errors == [("falla.pdf", "conexión perdida")]
+    assert progress and progress[-1][0] <= progress[-1][1]
+    objects = app['get_pedido_attachment_objects'](app['s3_client'], "PED-SURTIDO")
+    uploaded_keys = [url.split('.amazonaws.com/', 1)[1] for url in urls]
+    assert set(objects) == set(uploaded_keys)
+    image_key = uploaded_keys[1]
+    assert app['get_attachment_thumbnail_key'](app['s3_client'], image_key) == app['thumbnail_key_for'](image_key)
+    assert app['thumbnail_key_for'](image_key) in s3_client.objects
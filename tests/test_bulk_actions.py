@@ -0,0 +1,40 @@
+"""Acciones masivas: celdas a escribir para varios pedidos y su envío en una sola solicitud."""
+import fakes
+from conftest import WORKSHEET_NAME
+
+def _sheet_row(env, id_pedido):
+    rows = env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    return dict(zip(rows[0], next(row for row in rows[1:] if row[0] == id_pedido)))
+
+def test_bulk_updates_skip_orders_that_already_have_the_value(app_env):
+    app = app_env.app
+    cache = app_env.snapshot_cache()
+    df_orders = cache['df'].iloc[:3].copy()
+    df_orders['Estado'] = ["🔴 Pendiente", "✅ Completado", "🟡 En Proceso"]
+    df_orders['Notas'] = ["", "nota anterior", ""]
+
+    updates = app['bulk_order_updates'](df_orders, cache['headers'], 'estado', "✅ Completado")
+    assert {update['id_pedido'] for update in updates} == {df_orders['ID_Pedido'].iat[0], df_orders['ID_Pedido'].iat[2]}
+    assert len(updates) == 6 # Estado, Fecha_Completado y Hora_Proceso de cada uno
+    hora_proceso = {update['values'][0][0] for update in updates if update['values'][0][0].count(':') == 2}
+    assert len(hora_proceso) == 1 # La misma hora para todo el lote
+
+    notas = app['bulk_order_updates'](df_orders, cache['headers'], 'nota', "revisar")
+    assert [update['values'][0][0] for update in notas] == ["revisar", "nota anterior\nrevisar", "revisar"]
+
+def test_bulk_action_is_sent_in_one_request(app_env):
+    app = app_env.app
+    cache = app_env.snapshot_cache()
+    df_orders = cache['df'].iloc[10:15]
+    worksheet = app['get_snapshot_worksheet'](app_env.spreadsheet.id, WORKSHEET_NAME)
+    updates = app['bulk_order_updates'](df_orders, cache['headers'], 'surtidor', "Surtidor masivo")
+    assert len(updates) == 5
+
+    calls_before = fakes.API_CALLS['sheets.values_batch_update']
+    assert app['batch_update_gsheet_cells'](worksheet, updates)
+    queue = app['get_gsheet_write_queue']()
+    app['flush_gsheet_write_queue'](queue)
+    assert fakes.API_CALLS['sheets.values_batch_update'] == calls_before + 1
+    for id_pedido in df_orders['ID_Pedido']:
+        assert _sheet_row(app_env, id_pedido)['Surtidor'] == "Surtidor masivo"
+        assert app['get_gsheet_write_status'](id_pedido) == ('committed', None)
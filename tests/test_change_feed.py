@@ -0,0 +1,36 @@
+"""Registro de cambios de la copia: pedidos insertados, modificados y eliminados para el aviso de cambios."""
+from conftest import WORKSHEET_NAME
+
+def _sheet_rows(env):
+    return env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+
+def _add_order(env, template_position, id_pedido):
+    """Agrega al final de la hoja una copia del pedido de la fila `template_position` con otro ID."""
+    rows = _sheet_rows(env)
+    rows.append([id_pedido] + rows[template_position + 1][1:])
+
+def _refresh(env):
+    env.app['request_snapshot_refresh'](env.spreadsheet.id, WORKSHEET_NAME)
+    env.wait_for_refresher()
+
+def test_feed_combines_inserted_updated_and_removed(app_env):
+    app = app_env.app
+    cache = app_env.snapshot_cache()
+    seen = cache['generation']
+    rows = _sheet_rows(app_env)
+    updated_id, removed_id = rows[5][0], rows[-1][0]
+
+    _add_order(app_env, 0, "PED-NUEVO-1")
+    _refresh(app_env)
+    rows[5][rows[0].index('Notas')] = "cambio desde otra aplicación"
+    rows.pop() # El pedido nuevo se elimina enseguida: no aparece en el aviso
+    del rows[-1]
+    _add_order(app_env, 1, "PED-NUEVO-2")
+    _refresh(app_env)
+
+    with cache['lock']:
+        feed = app['snapshot_feed_since'](cache, seen)
+    assert feed['inserted'] == {"PED-NUEVO-2"}
+    assert feed['updated'] == {updated_id}
+    assert feed['removed'] == {removed_id}
+    assert set(feed['last_changed']) == {"PED-NUEVO-2", updated_id, removed_id}
@@ -0,0 +1,34 @@
+"""Instrumentación de los clientes de S3: llamadas exitosas y errores de conexión."""
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+from botocore.stub import Stubber
+
+import data_access
+
+def _s3_client(**kwargs):
+    return data_access.instrument_s3_client(boto3.client(
+        's3', aws_access_key_id='prueba', aws_secret_access_key='prueba', region_name='us-east-1',
+        config=Config(retries={'total_max_attempts': 1}, connect_timeout=1), **kwargs
+    ))
+
+def test_s3_call_is_recorded():
+    s3 = _s3_client()
+    metrics = data_access.get_trace_metrics()
+    before = metrics['api_totals']['s3.HeadObject']
+    with Stubber(s3) as stubber:
+        stubber.add_response('head_object', {'ContentLength': 3}, {'Bucket': 'bucket', 'Key': 'a.pdf'})
+        s3.head_object(Bucket='bucket', Key='a.pdf')
+    assert metrics['api_totals']['s3.HeadObject'] == before + 1
+
+def test_s3_connection_error_is_recorded():
+    # Nadie escucha en el puerto 9: la llamada falla sin respuesta HTTP (evento after-call-error)
+    s3 = _s3_client(endpoint_url='http://127.0.0.1:9')
+    metrics = data_access.get_trace_metrics()
+    totals_before = metrics['api_totals']['s3.PutObject']
+    errors_before = metrics['api_errors']['s3.599']
+    with pytest.raises(EndpointConnectionError):
+        s3.put_object(Bucket='bucket', Key='a.pdf', Body=b'%PDF')
+    assert metrics['api_totals']['s3.PutObject'] == totals_before + 1
+    assert metrics['api_errors']['s3.599'] == errors_before + 1
@@ -0,0 +1,45 @@
+"""Exportación del historial a Excel: detalles leídos por bloque y total con el filtro de Tipo_Envio."""
+import os
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import WORKSHEET_NAME
+
+pytest.importorskip('xlsxwriter')
+
+def test_export_reads_details_per_chunk_and_counts_with_filter(app_env, monkeypatch, tmp_path):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    assert app['archive_closed_orders'](sheet_id, WORKSHEET_NAME) # Parte del historial queda en el archivo
+    app_env.wait_for_refresher()
+    df, worksheet, headers = app_env.load()
+    partitions = app['get_order_partitions'](sheet_id, WORKSHEET_NAME, df)
+    desde, hasta = datetime.now() - timedelta(days=365), datetime.now() + timedelta(days=1)
+    estados = ('completado', 'cancelado')
+    tipo_envio = "🚚 Pedido Foráneo"
+
+    export_globals = app['export_order_history_xlsx'].__globals__
+    monkeypatch.setitem(export_globals, 'EXPORT_CHUNK_ROWS', 20)
+    fake_worksheet = app_env.spreadsheet.worksheets_[WORKSHEET_NAME]
+    original_batch_get = fake_worksheet.batch_get
+    read_ranges = []
+    def recording_batch_get(ranges, **kwargs):
+        read_ranges.extend(ranges)
+        return original_batch_get(ranges, **kwargs)
+    monkeypatch.setattr(fake_worksheet, 'batch_get', recording_batch_get)
+
+    progress = []
+    detail_errors = []
+    exported = app['export_order_history_xlsx'](
+        df, partitions, os.path.join(tmp_path, 'historial.xlsx'), desde, hasta, estados, tipo_envio=tipo_envio,
+        worksheet=worksheet, headers=headers, detail_errors=detail_errors,
+        progress_callback=lambda done, total: progress.append((done, total)),
+    )
+    assert not detail_errors
+    assert exported == app['count_order_history'](df, partitions, desde, hasta, estados, tipo_envio)
+    assert exported < app['count_order_history'](df, partitions, desde, hasta, estados)
+    assert all(total == exported for _, total in progress) # El total estimado ya considera el filtro
+    # Solo se leen las filas exportadas, nunca columnas completas de la hoja
+    assert read_ranges and all(re.search(r'\d+$', range_name) for range_name in read_ranges)
@@ -0,0 +1,31 @@
+"""Historial de pedidos cerrados: páginas por cursor sobre la copia viva y el archivo local."""
+from datetime import datetime, timedelta
+
+from conftest import WORKSHEET_NAME
+
+def test_history_pages_by_cursor(app_env):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    assert app['archive_closed_orders'](sheet_id, WORKSHEET_NAME, 10) # Parte del historial queda en el archivo
+    app_env.wait_for_refresher()
+    df, _, _ = app_env.load()
+    partitions = app['get_order_partitions'](sheet_id, WORKSHEET_NAME, df)
+    desde, hasta = datetime.now() - timedelta(days=365), datetime.now() + timedelta(days=1)
+    estados = ('completado', 'cancelado')
+    total = app['count_order_history'](df, partitions, desde, hasta, estados)
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = app['query_order_history'](df, partitions, desde, hasta, estados, after=cursor, limit=7)
+        pages.append(page)
+        if cursor is None:
+            break
+    assert all(len(page) == 7 for page in pages[:-1])
+    ids = [id_pedido for page in pages for id_pedido in page['ID_Pedido']]
+    assert len(ids) == len(set(ids)) == total
+    sources = {archivado for page in pages for archivado in page['Archivado']}
+    assert sources == {True, False} # Las páginas mezclan pedidos de la hoja y del archivo
+
+    everything, last_cursor = app['query_order_history'](df, partitions, desde, hasta, estados, limit=total + 1)
+    assert last_cursor is None
+    assert list(everything['ID_Pedido']) == ids
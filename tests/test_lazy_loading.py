@@ -0,0 +1,63 @@
+"""Carga diferida de los SDK de Google Sheets y S3 y de sus clientes."""
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import data_access
+from conftest import WORKSHEET_NAME
+
+DEFERRED_SDK_MODULES = ['gspread', 'google.oauth2.service_account', 'boto3']
+
+def test_data_access_import_defers_sdks():
+    probe = f"import sys, data_access; print(','.join(name for name in {DEFERRED_SDK_MODULES!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(data_access.__file__))
+    assert result.stdout.strip() == ""
+
+def test_lazy_client_created_once_on_first_use():
+    created = []
+    failures = [RuntimeError("sin red")]
+    def factory():
+        if failures:
+            raise failures.pop()
+        created.append(threading.current_thread().name)
+        return {'bucket': 'pedidos'}
+    client = data_access.LazyClient(factory)
+    assert client and not client.loaded # Comprobar el cliente no lo crea
+
+    with pytest.raises(RuntimeError):
+        client.get() # El error llega a quien lo usó...
+    threads = [threading.Thread(target=client.get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.loaded and len(created) == 1 # ...y el siguiente uso lo vuelve a intentar, una sola vez
+    assert list(client.keys()) == ['bucket']
+
+def test_optional_module_is_none_when_missing():
+    assert data_access.optional_module('modulo_que_no_existe') is None
+    assert data_access.optional_module('json').dumps([1]) == '[1]'
+
+def test_restart_from_disk_creates_clients_in_background(app_env, monkeypatch):
+    app_env.reset(keep_disk_snapshot=True)
+    created_in = []
+    for name in ('create_gspread_client', 'create_s3_client'):
+        factory = getattr(data_access, name)
+        def recording_factory(*args, _factory=factory, _name=name):
+            created_in.append((_name, threading.current_thread().name))
+            return _factory(*args)
+        monkeypatch.setattr(data_access, name, recording_factory)
+
+    app_test = app_env.new_app_test()
+    app_test.run()
+    assert not app_test.exception
+    assert any("Pedidos Pendientes" in markdown.value for markdown in app_test.markdown)
+    assert created_in == [] # La página se dibujó con la copia en disco, sin cargar gspread ni boto3
+
+    app_env.app['request_snapshot_refresh'](app_env.spreadsheet.id, WORKSHEET_NAME)
+    app_env.wait_for_refresher()
+    assert created_in == [('create_gspread_client', f"gsheet-snapshot-{WORKSHEET_NAME}")] # En el hilo de fondo
@@ -0,0 +1,59 @@
+"""Acciones de la tarjeta de un pedido: vuelven a ejecutar solo la tarjeta o, si el pedido cambia de pestaña, la página."""
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import WORKSHEET_NAME
+
+EN_PROCESO_TAB = 3
+
+def _sheet_value(env, id_pedido, col_name):
+    rows = env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    row = next(row for row in rows[1:] if row[0] == id_pedido)
+    return row[rows[0].index(col_name)]
+
+def _open_en_proceso_tab(env):
+    app_test = env.new_app_test()
+    app_test.run()
+    app_test.radio(key="active_main_tab_index_radio").set_value(EN_PROCESO_TAB).run()
+    return app_test
+
+def _first_card_id(app_test):
+    return next(button.key for button in app_test.button if button.key.startswith("save_notas_btn_"))[len("save_notas_btn_"):]
+
+@pytest.mark.parametrize("fragment_ids, expected", [(['tarjeta'], [{'scope': "fragment"}]), ([], [])])
+def test_rerun_order_card_is_fragment_scoped(app_env, monkeypatch, fragment_ids, expected):
+    app = app_env.app
+    card_globals = app['rerun_order_card'].__globals__
+    reruns = []
+    monkeypatch.setitem(card_globals, 'get_script_run_ctx', lambda: SimpleNamespace(fragment_ids_this_run=fragment_ids))
+    monkeypatch.setattr(app['st'], 'rerun', lambda **kwargs: reruns.append(kwargs))
+
+    app['rerun_order_card']()
+    # Nunca se vuelve a ejecutar toda la página desde aquí, ni siquiera si el clic llegó en una ejecución completa
+    assert reruns == expected
+
+def test_card_action_in_full_run(app_env):
+    app_test = _open_en_proceso_tab(app_env)
+    id_pedido = _first_card_id(app_test)
+
+    app_test.text_area(key=f"notas_text_{id_pedido}").input("nota desde la tarjeta")
+    app_test.button(key=f"save_notas_btn_{id_pedido}").click().run()
+    assert not app_test.exception
+    assert any(id_pedido in success.value for success in app_test.success)
+    app_env.app['flush_gsheet_write_queue'](app_env.app['get_gsheet_write_queue']())
+    assert _sheet_value(app_env, id_pedido, 'Notas') == "nota desde la tarjeta"
+
+def test_estado_change_reruns_page(app_env):
+    app_test = _open_en_proceso_tab(app_env)
+    en_proceso_label = app_test.radio(key="active_main_tab_index_radio").options[EN_PROCESO_TAB]
+    id_pedido = _first_card_id(app_test)
+
+    app_test.selectbox(key=f"estado_select_{id_pedido}").set_value("✅ Completado")
+    app_test.button(key=f"update_status_btn_{id_pedido}").click().run()
+    assert not app_test.exception
+    # El pedido sale de la pestaña: la página completa se volvió a dibujar con los conteos nuevos
+    assert app_test.radio(key="active_main_tab_index_radio").options[EN_PROCESO_TAB] != en_proceso_label
+    assert f"save_notas_btn_{id_pedido}" not in [button.key for button in app_test.button]
+    app_env.app['flush_gsheet_write_queue'](app_env.app['get_gsheet_write_queue']())
+    assert _sheet_value(app_env, id_pedido, 'Estado') == "✅ Completado"
@@ -0,0 +1,65 @@
+"""Columnas de detalle (adjuntos y modificaciones de surtido): fuera de la copia, leídas por página."""
+import gspread
+
+from conftest import WORKSHEET_NAME
+
+def _sheet_value(env, id_pedido, col_name):
+    rows = env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    row = next(row for row in rows[1:] if row[0] == id_pedido)
+    return row[rows[0].index(col_name)]
+
+def _record_reads(env, monkeypatch):
+    fake_worksheet = env.spreadsheet.worksheets_[WORKSHEET_NAME]
+    original_batch_get = fake_worksheet.batch_get
+    read_ranges = []
+    def recording_batch_get(ranges, **kwargs):
+        read_ranges.extend(ranges)
+        return original_batch_get(ranges, **kwargs)
+    monkeypatch.setattr(fake_worksheet, 'batch_get', recording_batch_get)
+    return read_ranges
+
+def test_details_read_only_for_requested_rows(app_env, monkeypatch):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    df, _, _ = app_env.load()
+    assert not set(app['DETAIL_COLUMNS']) & set(df.columns)
+    read_ranges = _record_reads(app_env, monkeypatch)
+    page = df.iloc[40:43]
+
+    details = app['load_order_details'](sheet_id, WORKSHEET_NAME, page)
+    for id_pedido, adjuntos, modificacion in zip(details['ID_Pedido'], details['Adjuntos'], details['Modificacion_Surtido']):
+        assert adjuntos == _sheet_value(app_env, id_pedido, 'Adjuntos')
+        assert modificacion == _sheet_value(app_env, id_pedido, 'Modificacion_Surtido')
+    read_rows = set()
+    for range_name in read_ranges:
+        cells = [gspread.utils.a1_to_rowcol(cell)[0] for cell in range_name.split('!')[-1].split(':')]
+        read_rows.update(range(cells[0], cells[-1] + 1))
+    assert read_rows == set(page['_gsheet_row_index'])
+
+    read_ranges.clear()
+    app['load_order_details'](sheet_id, WORKSHEET_NAME, page)
+    assert read_ranges == [] # La segunda página igual sale de la caché de detalles
+
+def test_details_follow_writes_and_sheet_edits(app_env, monkeypatch):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    df, worksheet, headers = app_env.load()
+    page = df.iloc[50:52]
+    id_pedido, row_index = page['ID_Pedido'].iat[0], page['_gsheet_row_index'].iat[0]
+    app['load_order_details'](sheet_id, WORKSHEET_NAME, page)
+
+    # Escritura de la app, todavía en la cola
+    assert app['update_gsheet_cell'](worksheet, headers, row_index, 'Modificacion_Surtido', "cambio en cola", id_pedido)
+    details = app['load_order_details'](sheet_id, WORKSHEET_NAME, app_env.load()[0].iloc[50:52])
+    assert details['Modificacion_Surtido'].iat[0] == "cambio en cola"
+    app['flush_gsheet_write_queue'](app['get_gsheet_write_queue']())
+
+    # Cambio hecho directamente en la hoja que la sincronización detecta en la fila
+    rows = app_env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    row = next(row for row in rows[1:] if row[0] == page['ID_Pedido'].iat[1])
+    row[rows[0].index('Notas')] = "editado fuera de la app"
+    row[rows[0].index('Adjuntos')] = "https://bucket.s3.us-east-1.amazonaws.com/nuevo.pdf"
+    app['request_snapshot_refresh'](sheet_id, WORKSHEET_NAME)
+    app_env.wait_for_refresher()
+    details = app['load_order_details'](sheet_id, WORKSHEET_NAME, app_env.load()[0].iloc[50:52])
+    assert details['Adjuntos'].iat[1] == "https://bucket.s3.us-east-1.amazonaws.com/nuevo.pdf"
@@ -0,0 +1,39 @@
+"""Listas de pedidos: solo se dibuja la pestaña seleccionada, y cada lista por páginas."""
+from conftest import WORKSHEET_NAME
+
+def _card_ids(app_test):
+    return [button.key[len("save_notas_btn_"):] for button in app_test.button if button.key.startswith("save_notas_btn_")]
+
+def _positions_ids(df, positions):
+    return list(df['ID_Pedido'].to_numpy()[positions])
+
+def test_only_selected_tab_is_rendered(app_env):
+    app = app_env.app
+    df, _, _ = app_env.load()
+    partitions = app['get_order_partitions'](app_env.spreadsheet.id, WORKSHEET_NAME, df)
+    pasados = _positions_ids(df, app['select_order_positions'](partitions, estados=app['ESTADOS_ACTIVOS'], fechas=['pasado']))
+
+    app_test = app_env.new_app_test()
+    app_test.run()
+    assert set(_card_ids(app_test)).isdisjoint(pasados) # La pestaña inicial es "Pendientes Hoy"
+    app_test.radio(key="active_main_tab_index_radio").set_value(2).run()
+    assert _card_ids(app_test) == pasados[:app['PAGE_SIZE_OPTIONS'][1]]
+
+def test_order_list_pages(app_env):
+    app = app_env.app
+    df, _, _ = app_env.load()
+    encontrados = _positions_ids(df, app['search_orders'](app_env.spreadsheet.id, WORKSHEET_NAME, df, "PED"))
+    page_size = app['PAGE_SIZE_OPTIONS'][0]
+    assert len(encontrados) > 2 * page_size
+
+    app_test = app_env.new_app_test()
+    app_test.run()
+    app_test.sidebar.selectbox(key="page_size").set_value(page_size)
+    app_test.text_input(key="busqueda_pedidos").input("PED").run()
+    assert _card_ids(app_test) == encontrados[:page_size] # Solo se dibuja la primera página
+
+    app_test.button(key="page_next_busqueda").click().run()
+    assert not app_test.exception
+    assert _card_ids(app_test) == encontrados[page_size:2 * page_size]
+    app_test.button(key="page_prev_busqueda").click().run()
+    assert _card_ids(app_test) == encontrados[:page_size]
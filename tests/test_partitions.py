@@ -0,0 +1,51 @@
+"""Índice de particiones de la copia: vistas de las pestañas, su orden y cuándo se recalcula."""
+from datetime import datetime
+
+import pandas as pd
+
+from conftest import WORKSHEET_NAME
+
+def _expected_positions(app, df, estados, fecha, tipo_envio=None):
+    """Posiciones que las pestañas mostraban filtrando y ordenando el DataFrame completo."""
+    today = pd.Timestamp(datetime.now().date())
+    dias = df['Fecha_Entrega_dt'].dt.normalize()
+    fecha_mask = {'hoy': dias == today, 'manana': dias == today + pd.Timedelta(days=1), 'pasado': dias < today}[fecha]
+    mask = df['Estado'].isin(estados) & fecha_mask
+    if tipo_envio is not None:
+        mask &= df['Tipo_Envio'] == tipo_envio
+    ordered = app['ordenar_pedidos_custom'](df.reset_index(drop=True)[mask.to_numpy()])
+    return list(ordered.index)
+
+def test_partitions_match_filtered_views(app_env):
+    app = app_env.app
+    df, _, _ = app_env.load()
+    partitions = app['get_order_partitions'](app_env.spreadsheet.id, WORKSHEET_NAME, df)
+    activos = ["🔴 Pendiente", "🟡 En Proceso"]
+    for fecha in ('hoy', 'manana', 'pasado'):
+        for tipo_envio in (None, "📍 Pedido Local", "🚚 Pedido Foráneo"):
+            positions = app['select_order_positions'](partitions, estados=app['ESTADOS_ACTIVOS'], fechas=[fecha], tipo_envio=tipo_envio)
+            assert list(positions) == _expected_positions(app, df, activos, fecha, tipo_envio)
+            assert app['count_orders'](partitions, estados=app['ESTADOS_ACTIVOS'], fechas=[fecha], tipo_envio=tipo_envio) == len(positions)
+    assert sum(app['partition_counts'](partitions).values()) == len(df)
+
+def test_partitions_rebuilt_only_for_partition_columns(app_env):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    cache = app_env.snapshot_cache()
+    df, worksheet, headers = app_env.load()
+    partitions = app['get_order_partitions'](sheet_id, WORKSHEET_NAME, df)
+    position = int(app['select_order_positions'](partitions, estados=['pendiente'])[0])
+    id_pedido = df['ID_Pedido'].iat[position]
+    row_index = df['_gsheet_row_index'].iat[position]
+
+    assert app['update_gsheet_cell'](worksheet, headers, row_index, 'Notas', "sin cambio de pestaña", id_pedido)
+    df, _, _ = app_env.load()
+    assert app['get_order_partitions'](sheet_id, WORKSHEET_NAME, df) is partitions # Notas no cambia los grupos
+
+    assert app['update_gsheet_cell'](worksheet, headers, row_index, 'Estado', "🟡 En Proceso", id_pedido)
+    df, _, _ = app_env.load()
+    rebuilt = app['get_order_partitions'](sheet_id, WORKSHEET_NAME, df)
+    assert rebuilt is not partitions and rebuilt is cache['partitions']
+    assert position in app['select_order_positions'](rebuilt, estados=['en_proceso'])
+    assert app['count_orders'](rebuilt, estados=['pendiente']) == app['count_orders'](partitions, estados=['pendiente']) - 1
+    app['flush_gsheet_write_queue'](app['get_gsheet_write_queue']())
@@ -0,0 +1,88 @@
+"""Regulador de cuota de Google Sheets: carriles del usuario y de fondo, y pausa ante un 429."""
+import threading
+import time
+
+import pytest
+
+import data_access
+from conftest import WORKSHEET_NAME
+
+@pytest.fixture
+def governor(monkeypatch):
+    """Regulador nuevo para cada prueba, con el bucket de lecturas que no se rellena solo."""
+    governor = data_access._new_sheets_quota_governor()
+    governor['buckets']['read']['rate'] = 1e-9
+    monkeypatch.setattr(data_access, '_sheets_quota_governor', governor)
+    return governor
+
+def _acquire_in_background(lane):
+    """Pide un token de lectura desde otro hilo en el carril `lane`; retorna el hilo."""
+    def acquire():
+        with data_access.sheets_quota_lane(lane):
+            data_access.acquire_sheets_quota(write=False)
+    thread = threading.Thread(target=acquire, daemon=True)
+    thread.start()
+    return thread
+
+def _set_tokens(governor, tokens):
+    with governor['cond']:
+        governor['buckets']['read']['tokens'] = tokens
+        governor['cond'].notify_all()
+
+def test_background_lane_leaves_user_reserve(governor):
+    _set_tokens(governor, data_access.SHEETS_QUOTA_USER_RESERVE + 0.5)
+    background = _acquire_in_background('fondo')
+    background.join(0.2)
+    assert background.is_alive() # No toma los tokens reservados al usuario...
+
+    data_access.acquire_sheets_quota(write=False) # ...que sí los puede usar
+    assert governor['buckets']['read']['tokens'] == pytest.approx(data_access.SHEETS_QUOTA_USER_RESERVE - 0.5)
+
+    _set_tokens(governor, data_access.SHEETS_QUOTA_USER_RESERVE + 1)
+    background.join(2)
+    assert not background.is_alive()
+
+def test_background_lane_yields_to_waiting_user(governor):
+    with governor['cond']:
+        governor['waiting'][('read', 'usuario')] += 1 # Una solicitud del usuario esperando token
+    background = _acquire_in_background('fondo')
+    background.join(0.2)
+    assert background.is_alive()
+    assert governor['waiting'][('read', 'fondo')] == 1
+
+    with governor['cond']:
+        governor['waiting'][('read', 'usuario')] -= 1
+        governor['cond'].notify_all()
+    background.join(2)
+    assert not background.is_alive()
+
+def test_rate_limited_response_pauses_all_lanes(governor):
+    data_access.report_sheets_quota_result(write=False, status_code=429, retry_after=0.3)
+    assert governor['rate_factor'] == 0.5
+    assert governor['buckets']['read']['tokens'] == 0
+    _set_tokens(governor, governor['buckets']['read']['capacity'])
+
+    start = time.monotonic()
+    data_access.acquire_sheets_quota(write=False)
+    assert time.monotonic() - start >= 0.25 # Hasta Retry-After, aunque haya tokens
+
+    data_access.report_sheets_quota_result(write=False, status_code=None)
+    assert governor['rate_factor'] == pytest.approx(0.5 + data_access.SHEETS_QUOTA_RECOVERY_STEP)
+    assert governor['consecutive_429'] == 0
+
+def test_refresher_uses_background_lane(app_env, monkeypatch):
+    lanes = []
+    acquire = data_access.acquire_sheets_quota
+    def recording_acquire(write):
+        lanes.append((threading.current_thread().name, data_access._quota_context.__dict__.get('lane', 'usuario')))
+        return acquire(write)
+    monkeypatch.setattr(data_access, 'acquire_sheets_quota', recording_acquire)
+
+    app_env.app['request_snapshot_refresh'](app_env.spreadsheet.id, WORKSHEET_NAME)
+    app_env.wait_for_refresher()
+    lanes_before = len(lanes)
+    df = app_env.snapshot_cache()['df']
+    app_env.app['load_order_details'](app_env.spreadsheet.id, WORKSHEET_NAME, df.iloc[:5]) # Lectura de la página
+    assert len(lanes) > lanes_before
+    assert {lane for name, lane in lanes if name.startswith('gsheet-snapshot')} == {'fondo'}
+    assert lanes[-1] == (threading.current_thread().name, 'usuario')
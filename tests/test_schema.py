@@ -0,0 +1,62 @@
+"""Esquema de la copia de pedidos: columnas categóricas, fechas analizadas y columnas precalculadas."""
+import pandas as pd
+
+def test_build_orders_dataframe_types_columns(app_env):
+    build = app_env.app['build_orders_dataframe']
+    headers = ['ID_Pedido', 'Tipo_Envio', 'Estado', 'Fecha_Entrega', 'Hora_Registro', 'Fecha_Completado']
+    rows = [
+        [' PED-1 ', '🚚 Pedido Foráneo', ' 🟡 Pendiente', '2026-10-20', '2026-10-17 08:30:00', ''],
+        ['PED-2', 'Otro tipo', '🟡 Pendiente ', '', '17/10/2026 09:15', '2026-10-18'],
+        ['PED-3', '📍 Pedido Local'], # La lectura por rango omite las celdas vacías del final
+    ]
+    df = build(headers, rows, [2, 3, 4])
+
+    assert df['ID_Pedido'].tolist() == ['PED-1', 'PED-2', 'PED-3']
+    assert df['_gsheet_row_index'].tolist() == [2, 3, 4]
+    assert isinstance(df['Estado'].dtype, pd.CategoricalDtype)
+    assert list(df['Estado'].cat.categories) == ['🟡 Pendiente', ''] # Sin espacios y sin duplicados
+    assert df['Surtidor'].dtype == 'category' # Columna que faltaba en la hoja
+    assert df['Tipo_Envio_Orden'].tolist() == [1, app_env.app['ORDEN_TIPO_ENVIO_DESCONOCIDO'], 0]
+    assert df['Fecha_Entrega'].tolist() == ['2026-10-20', '', '']
+    assert df['Fecha_Entrega_dt'].iat[0] == pd.Timestamp('2026-10-20')
+    assert pd.isna(df['Fecha_Entrega_dt'].iat[1])
+    # Una fecha con otro formato se analiza de forma flexible; las vacías quedan en NaT
+    assert df['Hora_Registro'].tolist()[:2] == [pd.Timestamp('2026-10-17 08:30:00'), pd.Timestamp('2026-10-17 09:15')]
+    assert pd.isna(df['Fecha_Completado'].iat[0])
+    assert pd.isna(df['Hora_Registro'].iat[2])
+
+def test_write_through_keeps_types_and_derived_columns(app_env):
+    app = app_env.app
+    cache = app_env.snapshot_cache()
+    df_before = cache['df']
+    headers = cache['headers']
+    worksheet = app['get_snapshot_worksheet'](app_env.spreadsheet.id, 'datos_pedidos')
+    app['patch_snapshot_cells'](worksheet, [
+        ((2, headers.index('Tipo_Envio') + 1), "🛠 Garantía"),
+        ((2, headers.index('Surtidor') + 1), " Surtidor nuevo "),
+        ((2, headers.index('Fecha_Entrega') + 1), "2026-12-24"),
+    ])
+
+    df = cache['df']
+    assert df is not df_before
+    assert df['Surtidor'].dtype == 'category'
+    assert df['Surtidor'].iat[0] == "Surtidor nuevo"
+    assert "Surtidor nuevo" not in df_before['Surtidor'].cat.categories
+    assert df['Tipo_Envio_Orden'].iat[0] == app['ORDEN_TIPO_ENVIO']["🛠 Garantía"]
+    assert df['Fecha_Entrega_dt'].iat[0] == pd.Timestamp('2026-12-24')
+
+def test_unify_categories_and_sort_without_mutating(app_env):
+    app = app_env.app
+    left = app['build_orders_dataframe'](['ID_Pedido', 'Tipo_Envio', 'Fecha_Entrega'], [
+        ['PED-1', '🔁 Devolución', '2026-10-20'],
+        ['PED-2', '📍 Pedido Local', '2026-10-22'],
+        ['PED-3', '📍 Pedido Local', '2026-10-21'],
+    ], [2, 3, 4])
+    right = app['build_orders_dataframe'](['ID_Pedido', 'Tipo_Envio'], [['PED-4', '🛠 Garantía']], [5])
+    app['unify_categories'](left, right)
+    combined = pd.concat([left, right], ignore_index=True)
+    assert combined['Tipo_Envio'].dtype == 'category'
+
+    ordered = app['ordenar_pedidos_custom'](combined)
+    assert ordered['ID_Pedido'].tolist() == ['PED-3', 'PED-2', 'PED-4', 'PED-1']
+    assert combined['ID_Pedido'].tolist() == ['PED-1', 'PED-2', 'PED-3', 'PED-4']
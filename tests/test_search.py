@@ -0,0 +1,54 @@
+"""Índice de búsqueda: lo construye el hilo de actualización, no la primera búsqueda."""
+import threading
+import time
+
+from conftest import WORKSHEET_NAME
+
+def test_refresher_builds_index_from_disk_snapshot_before_syncing(app_env, monkeypatch):
+    app = app_env.app
+    # La hoja no responde mientras el proceso nuevo arranca con la copia en disco
+    fake_worksheet = app_env.spreadsheet.worksheets_[WORKSHEET_NAME]
+    original_batch_get = fake_worksheet.batch_get
+    sheet_released = threading.Event()
+    def slow_batch_get(ranges, **kwargs):
+        sheet_released.wait(timeout=30)
+        return original_batch_get(ranges, **kwargs)
+    monkeypatch.setattr(fake_worksheet, 'batch_get', slow_batch_get)
+
+    app_env.reset(keep_disk_snapshot=True)
+    try:
+        app_env.load()
+        cache = app_env.snapshot_cache()
+        assert cache['source'] == 'disco'
+        deadline = time.time() + 30
+        while cache['search']['generation'] != cache['generation'] and time.time() < deadline:
+            time.sleep(0.01)
+        assert cache['search']['generation'] == cache['generation']
+    finally:
+        sheet_released.set()
+    app_env.wait_for_refresher()
+
+def test_search_after_full_sync_does_not_rebuild_index(app_env, monkeypatch):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    cache = app_env.snapshot_cache()
+    df = cache['df']
+    cliente = df['Cliente'].iat[0]
+    expected = set(df.index[df['Cliente'] == cliente])
+
+    app['_sync_snapshot'](cache, sheet_id, WORKSHEET_NAME, force_full=True)
+    search_globals = app['update_search_index'].__globals__
+    search_documents = search_globals['_search_documents']
+    indexed_rows = []
+    def counting_search_documents(rows):
+        indexed_rows.append(len(rows))
+        return search_documents(rows)
+    monkeypatch.setitem(search_globals, '_search_documents', counting_search_documents)
+
+    positions = app['search_orders'](sheet_id, WORKSHEET_NAME, cache['df'], cliente)
+    assert not indexed_rows # Usa el índice anterior; la recarga completa la indexa el hilo de actualización
+    assert expected <= set(positions)
+
+    app['update_search_index'](cache)
+    assert indexed_rows == [len(cache['df'])]
+    assert expected <= set(app['search_orders'](sheet_id, WORKSHEET_NAME, cache['df'], cliente))
@@ -0,0 +1,130 @@
+"""Copia en caché de la hoja de pedidos: carga desde disco y escrituras sobre ella."""
+from conftest import WORKSHEET_NAME
+
+def _sheet_value(env, id_pedido, col_name):
+    rows = env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    headers = rows[0]
+    row = next(row for row in rows[1:] if row[0] == id_pedido)
+    return row[headers.index(col_name)]
+
+def test_write_to_snapshot_loaded_from_disk(app_env):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    # Proceso nuevo con la copia que guardó la primera sincronización
+    app_env.reset(keep_disk_snapshot=True)
+    cache = app_env.snapshot_cache()
+    with cache['lock']:
+        assert app['_load_snapshot_from_disk'](cache, sheet_id, WORKSHEET_NAME)
+    df_before = cache['df']
+    id_pedido = df_before['ID_Pedido'].iat[5]
+    worksheet = app['get_snapshot_worksheet'](sheet_id, WORKSHEET_NAME)
+    headers = cache['headers']
+
+    row_index = app['locate_order_row'](sheet_id, WORKSHEET_NAME, id_pedido)
+    updates = [
+        {'range': app['gspread'].utils.rowcol_to_a1(row_index, headers.index(col) + 1), 'values': [[value]]}
+        for col, value in (('Estado', "🟡 En Proceso"), ('Surtidor', "Surtidor de prueba"), ('Notas', "nota de prueba"))
+    ]
+    assert app['batch_update_gsheet_cells'](worksheet, updates, id_pedido=id_pedido)
+
+    row = cache['df'].iloc[row_index - 2]
+    assert (row['Estado'], row['Surtidor'], row['Notas']) == ("🟡 En Proceso", "Surtidor de prueba", "nota de prueba")
+    assert df_before['Notas'].iat[5] != "nota de prueba" # La copia anterior no se modifica (copy-on-write)
+
+    app['flush_gsheet_write_queue'](app['get_gsheet_write_queue']())
+    assert _sheet_value(app_env, id_pedido, 'Estado') == "🟡 En Proceso"
+    assert _sheet_value(app_env, id_pedido, 'Notas') == "nota de prueba"
+
+def _edit_sheet(env, id_pedido, values):
+    """Modifica celdas directamente en la hoja, como otro usuario u otra aplicación."""
+    rows = env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    headers = rows[0]
+    row = next(row for row in rows[1:] if row[0] == id_pedido)
+    row.extend([''] * (len(headers) - len(row)))
+    for col_name, value in values.items():
+        row[headers.index(col_name)] = value
+
+def _refresh(env):
+    env.app['request_snapshot_refresh'](env.spreadsheet.id, WORKSHEET_NAME)
+    env.wait_for_refresher()
+
+def test_delta_sync_detects_edited_rows(app_env):
+    cache = app_env.snapshot_cache()
+    id_pedido = cache['df']['ID_Pedido'].iat[10]
+    last_full_sync = cache['last_full_sync']
+    _edit_sheet(app_env, id_pedido, {'Estado': "🟡 En Proceso", 'Notas': "editado fuera de la app"})
+
+    _refresh(app_env)
+    row = cache['df'].iloc[10]
+    assert (row['Estado'], row['Notas']) == ("🟡 En Proceso", "editado fuera de la app")
+    assert cache['last_full_sync'] == last_full_sync # Lo detectó la sincronización parcial
+
+def test_writes_stamp_version_column(app_env):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    rows = app_env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+    rows[0].append(app['GSHEET_VERSION_COLUMN'])
+    app_env.reset()
+    app_env.load()
+    app_env.wait_for_refresher()
+    cache = app_env.snapshot_cache()
+    id_pedido = cache['df']['ID_Pedido'].iat[3]
+    headers = cache['headers']
+
+    worksheet = app['get_snapshot_worksheet'](sheet_id, WORKSHEET_NAME)
+    row_index = app['locate_order_row'](sheet_id, WORKSHEET_NAME, id_pedido)
+    cell = app['gspread'].utils.rowcol_to_a1(row_index, headers.index('Notas') + 1)
+    assert app['batch_update_gsheet_cells'](worksheet, [{'range': cell, 'values': [["nota"]]}], id_pedido=id_pedido)
+    app['flush_gsheet_write_queue'](app['get_gsheet_write_queue']())
+    assert _sheet_value(app_env, id_pedido, app['GSHEET_VERSION_COLUMN'])
+
+    # Otra instancia de la app modifica otro pedido y marca su versión
+    other_id = cache['df']['ID_Pedido'].iat[20]
+    last_full_sync = cache['last_full_sync']
+    _edit_sheet(app_env, other_id, {'Notas': "desde otra instancia", app['GSHEET_VERSION_COLUMN']: "2026-01-01 00:00:00.000000"})
+    _refresh(app_env)
+    assert cache['df']['Notas'].iat[20] == "desde otra instancia"
+    assert cache['df']['Notas'].iat[3] == "nota"
+    assert cache['last_full_sync'] == last_full_sync
+
+def test_sync_keeps_writes_committed_during_read(app_env, monkeypatch):
+    app = app_env.app
+    sheet_id = app_env.spreadsheet.id
+    cache = app_env.snapshot_cache()
+    id_pedido = cache['df']['ID_Pedido'].iat[7]
+    headers = cache['headers']
+    worksheet = app['get_snapshot_worksheet'](sheet_id, WORKSHEET_NAME)
+    row_index = app['locate_order_row'](sheet_id, WORKSHEET_NAME, id_pedido)
+    cell = app['gspread'].utils.rowcol_to_a1(row_index, headers.index('Notas') + 1)
+    assert app['batch_update_gsheet_cells'](worksheet, [{'range': cell, 'values': [["escrita durante la lectura"]]}], id_pedido=id_pedido)
+
+    # La escritura se confirma justo después de que la sincronización leyó la hoja (con el valor anterior)
+    fake_worksheet = app_env.spreadsheet.worksheets_[WORKSHEET_NAME]
+    original_batch_get = fake_worksheet.batch_get
+    flushed = []
+    def batch_get_then_flush(ranges, **kwargs):
+        values = original_batch_get(ranges, **kwargs)
+        if not flushed:
+            flushed.append(True)
+            app['flush_gsheet_write_queue'](app['get_gsheet_write_queue']())
+        return values
+    monkeypatch.setattr(fake_worksheet, 'batch_get', batch_get_then_flush)
+
+    app['_sync_snapshot'](cache, sheet_id, WORKSHEET_NAME, force_full=True)
+    assert flushed
+    assert _sheet_value(app_env, id_pedido, 'Notas') == "escrita durante la lectura"
+    assert cache['df']['Notas'].iat[7] == "escrita durante la lectura"
+
+def test_disk_snapshot_saved_outside_lock(app_env, monkeypatch):
+    app = app_env.app
+    cache = app_env.snapshot_cache()
+    original_save = app['_save_snapshot_to_disk']
+    saves = []
+    def save_and_check_lock(snapshot, *args, **kwargs):
+        saves.append(cache['lock'].locked())
+        return original_save(snapshot, *args, **kwargs)
+    monkeypatch.setitem(app['_sync_snapshot'].__globals__, '_save_snapshot_to_disk', save_and_check_lock)
+
+    _edit_sheet(app_env, cache['df']['ID_Pedido'].iat[4], {'Notas': "cambio para guardar"})
+    app['_sync_snapshot'](cache, app_env.spreadsheet.id, WORKSHEET_NAME)
+    assert saves == [False]
@@ -0,0 +1,101 @@
+"""Cola de escritura diferida a Google Sheets: verificación de filas destino, reintentos y estado por pedido."""
+from types import SimpleNamespace
+
+from conftest import WORKSHEET_NAME
+
+def _sheet_rows(env):
+    return env.spreadsheet.worksheets_[WORKSHEET_NAME].rows
+
+def _sheet_value(env, id_pedido, col_name):
+    rows = _sheet_rows(env)
+    row = next(row for row in rows[1:] if row[0] == id_pedido)
+    return row[rows[0].index(col_name)]
+
+def _queue_note(env, position, value):
+    """Encola una nota para el pedido de la posición `position` de la copia y retorna su ID_Pedido."""
+    app = env.app
+    cache = env.snapshot_cache()
+    id_pedido = cache['df']['ID_Pedido'].iat[position]
+    worksheet = app['get_snapshot_worksheet'](env.spreadsheet.id, WORKSHEET_NAME)
+    row_index = app['locate_order_row'](env.spreadsheet.id, WORKSHEET_NAME, id_pedido)
+    cell = app['gspread'].utils.rowcol_to_a1(row_index, cache['headers'].index('Notas') + 1)
+    assert app['batch_update_gsheet_cells'](worksheet, [{'range': cell, 'values': [[value]]}], id_pedido=id_pedido)
+    return id_pedido
+
+def _api_error(app, status_code):
+    response = SimpleNamespace(
+        status_code=status_code, text="", json=lambda: {'error': {'code': status_code, 'message': "Quota exceeded"}}
+    )
+    return app['gspread'].exceptions.APIError(response)
+
+def _fail_batch_updates(env, monkeypatch, errors):
+    """values_batch_update lanza los errores de `errors` (uno por llamada) y después escribe normalmente."""
+    original_update = env.spreadsheet.values_batch_update
+    errors = list(errors)
+    def failing_update(body=None, params=None):
+        if errors:
+            raise errors.pop(0)
+        return original_update(body=body, params=params)
+    monkeypatch.setattr(env.spreadsheet, 'values_batch_update', failing_update)
+
+def test_quota_error_backs_off_and_retries(app_env, monkeypatch):
+    app = app_env.app
+    queue = app['get_gsheet_write_queue']()
+    _fail_batch_updates(app_env, monkeypatch, [_api_error(app, 429)])
+    id_pedido = _queue_note(app_env, 12, "primera")
+
+    delay = app['flush_gsheet_write_queue'](queue)
+    assert app['GSHEET_WRITE_BACKOFF_BASE_SECONDS'] <= delay <= app['GSHEET_WRITE_BACKOFF_BASE_SECONDS'] + 1
+    assert queue['attempt'] == 1
+    assert app['get_gsheet_write_status'](id_pedido)[0] == 'pending'
+    assert _sheet_value(app_env, id_pedido, 'Notas') != "primera"
+
+    # Una escritura más reciente de la misma celda gana sobre la que se reintenta
+    _queue_note(app_env, 12, "segunda")
+    assert app['flush_gsheet_write_queue'](queue) == 0
+    assert queue['attempt'] == 0
+    assert _sheet_value(app_env, id_pedido, 'Notas') == "segunda"
+    assert app['get_gsheet_write_status'](id_pedido)[0] == 'committed'
+    assert not queue['pending_ids']
+
+def test_write_error_after_retries(app_env, monkeypatch):
+    app = app_env.app
+    queue = app['get_gsheet_write_queue']()
+    monkeypatch.setitem(app['flush_gsheet_write_queue'].__globals__, 'GSHEET_WRITE_MAX_RETRIES', 1)
+    _fail_batch_updates(app_env, monkeypatch, [_api_error(app, 503), _api_error(app, 503)])
+    id_pedido = _queue_note(app_env, 15, "no se guarda")
+    other_id = _queue_note(app_env, 16, "tampoco")
+    assert set(queue['pending_ids']) == {id_pedido, other_id}
+
+    assert app['flush_gsheet_write_queue'](queue) > 0
+    assert app['flush_gsheet_write_queue'](queue) == 0 # Sin más reintentos
+    status, message = app['get_gsheet_write_status'](id_pedido)
+    assert status == 'error' and "Quota exceeded" in message
+    assert not queue['pending'] and not queue['pending_ids']
+    app_env.wait_for_refresher() # La copia en caché se recarga desde la hoja
+    assert _sheet_value(app_env, id_pedido, 'Notas') == app_env.snapshot_cache()['df']['Notas'].iat[15]
+
+def test_write_requeued_when_rows_move_during_write(app_env, monkeypatch):
+    app = app_env.app
+    queue = app['get_gsheet_write_queue']()
+    id_pedido = _queue_note(app_env, 30, "nota reubicada")
+    rows = _sheet_rows(app_env)
+    neighbour_id = rows[30][0] # Pedido de la fila anterior, que quedará en la fila destino
+
+    # Otra aplicación inserta una fila entre la verificación previa y la escritura
+    original_update = app_env.spreadsheet.values_batch_update
+    def insert_row_then_update(body=None, params=None):
+        if not any(row[0] == "PED-INSERTADO" for row in rows):
+            rows.insert(1, ["PED-INSERTADO"] + [''] * (len(rows[0]) - 1))
+        return original_update(body=body, params=params)
+    monkeypatch.setattr(app_env.spreadsheet, 'values_batch_update', insert_row_then_update)
+
+    app['flush_gsheet_write_queue'](queue)
+    assert _sheet_value(app_env, neighbour_id, 'Notas') == "nota reubicada" # Cayó en otro pedido...
+    assert app['get_gsheet_write_status'](id_pedido)[0] == 'pending' # ...y se volvió a encolar
+
+    app['flush_gsheet_write_queue'](queue)
+    assert _sheet_value(app_env, id_pedido, 'Notas') == "nota reubicada"
+    assert app['get_gsheet_write_status'](id_pedido)[0] == 'committed'
+    app_env.wait_for_refresher() # La copia en caché se pone al día con la fila insertada
+    assert app_env.snapshot_cache()['df']['ID_Pedido'].iat[0] == "PED-INSERTADO"